@@ -5,6 +5,7 @@ import argparse as ap
 from datetime import datetime
 from contextlib import contextmanager
 import pymysql
+from voyager_frame import remove_sidecars
 
 # pylint: disable=invalid-name
 
@@ -45,6 +46,12 @@ if __name__ == "__main__":
             """
         qry_args = (now,)
         with db_cursor() as cur:
+            cur.execute("SELECT ref_image_path FROM autoguider_ref WHERE valid_until IS NULL")
+            ref_paths = [row[0] for row in cur.fetchall()]
             cur.execute(qry, qry_args)
+        # remove the prepared references too, they must never outlive their reference
+        for ref_path in ref_paths:
+            for sidecar in remove_sidecars(ref_path):
+                print(f"Removed {sidecar}")
     else:
         print("Re-run with --all flag to confirm you want to disable them all")
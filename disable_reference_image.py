@@ -5,6 +5,7 @@ import argparse as ap
 from datetime import datetime
 from contextlib import contextmanager
 import pymysql
+from voyager_frame import remove_sidecars
 
 # pylint: disable=invalid-name
 
@@ -54,7 +55,7 @@ if __name__ == "__main__":
 
     # set valid until to now, to disable
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    qry = f"UPDATE autoguider_ref\nSET valid_until='{now}'\nWHERE field='{args.field}'\n"
+    where = f"WHERE field='{args.field}'\n"
 
     errors = 0
 
@@ -63,69 +64,76 @@ if __name__ == "__main__":
         print("Must specify a filter or % for all filters")
         errors += 1
     elif args.filter == "%":
-        qry = qry + "AND filter LIKE '%'\n"
+        where = where + "AND filter LIKE '%'\n"
     else:
-        qry = qry + f"AND filter='{args.filter}'\n"
+        where = where + f"AND filter='{args.filter}'\n"
     # check for xbin
     if args.xbin is None:
         print("Must specify an xbin or % for all x binning levels")
         errors += 1
     elif args.xbin == "%":
-        qry = qry + "AND xbin LIKE '%'\n"
+        where = where + "AND xbin LIKE '%'\n"
     else:
-        qry = qry + f"AND xbin={args.xbin}\n"
+        where = where + f"AND xbin={args.xbin}\n"
     # check for ybin
     if args.ybin is None:
         print("Must specify a ybin or % for all y binning levels")
         errors += 1
     elif args.ybin == "%":
-        qry = qry + "AND ybin LIKE '%'\n"
+        where = where + "AND ybin LIKE '%'\n"
     else:
-        qry = qry + f"AND ybin={args.ybin}\n"
+        where = where + f"AND ybin={args.ybin}\n"
     # check for xsize
     if args.xsize is None:
         print("Must specify an xsize or % for all x sizes")
         errors += 1
     elif args.xsize == "%":
-        qry = qry + "AND xsize LIKE '%'\n"
+        where = where + "AND xsize LIKE '%'\n"
     else:
-        qry = qry + f"AND xsize={args.xsize}\n"
+        where = where + f"AND xsize={args.xsize}\n"
     # check for ysize
     if args.ysize is None:
         print("Must specify a ysize or % for all y sizes")
         errors += 1
     elif args.ysize == "%":
-        qry = qry + "AND ysize LIKE '%'\n"
+        where = where + "AND ysize LIKE '%'\n"
     else:
-        qry = qry + f"AND ysize={args.ysize}\n"
+        where = where + f"AND ysize={args.ysize}\n"
     # check for xorigin
     if args.xorigin  is None:
         print("Must specify an xorigin or % for all x origins")
         errors += 1
     elif args.xorigin== "%":
-        qry = qry + "AND xorigin LIKE '%'\n"
+        where = where + "AND xorigin LIKE '%'\n"
     else:
-        qry = qry + f"AND xorigin={args.xorigin}\n"
+        where = where + f"AND xorigin={args.xorigin}\n"
     # check for yorigin
     if args.yorigin is None:
         print("Must specify a yorigin or % for all y origins")
         errors += 1
     elif args.yorigin == "%":
-        qry = qry + "AND yorigin LIKE '%'\n"
+        where = where + "AND yorigin LIKE '%'\n"
     else:
-        qry = qry + f"AND yorigin={args.yorigin}\n"
+        where = where + f"AND yorigin={args.yorigin}\n"
     # check for flip status
     if args.flip_status is None:
         print("Must specify a flip_status or % for all flip statuses")
         errors += 1
     elif args.flip_status == "%":
-        qry = qry + "AND flip_status LIKE '%'\n"
+        where = where + "AND flip_status LIKE '%'\n"
     else:
-        qry = qry + f"AND flip_status={args.flip_status}\n"
+        where = where + f"AND flip_status={args.flip_status}\n"
 
     if errors > 0:
         print("\nFIX ISSUES ABOVE AND RE-RUN THE COMMAND\n")
     else:
+        qry = f"UPDATE autoguider_ref\nSET valid_until='{now}'\n{where}"
         print(qry)
         with db_cursor() as cur:
+            cur.execute(f"SELECT ref_image_path FROM autoguider_ref\n{where}")
+            ref_paths = [row[0] for row in cur.fetchall()]
             cur.execute(qry)
+        # remove the prepared references too, they must never outlive their reference
+        for ref_path in ref_paths:
+            for sidecar in remove_sidecars(ref_path):
+                print(f"Removed {sidecar}")
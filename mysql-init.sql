@@ -32,12 +32,33 @@ CREATE TABLE IF NOT EXISTS autoguider_log (
    std_buff_x float not null,
    std_buff_y float not null,
    culled_max_shift_x int(1) not null,
-   culled_max_shift_y int(1) not null
+   culled_max_shift_y int(1) not null,
+   shift_quality float,
+   culled_quality int(1) not null default 0
+);
+
+CREATE TABLE IF NOT EXISTS autoguider_timing (
+   updated timestamp default current_timestamp on update current_timestamp,
+   comp_image_path text not null,
+   result text not null,
+   total_ms float not null,
+   queue_ms float not null,
+   ready_ms float not null,
+   header_ms float not null,
+   mount_status_ms float not null,
+   ref_lookup_ms float not null,
+   ref_store_ms float not null,
+   donuts_init_ms float not null,
+   measure_shift_ms float not null,
+   log_shifts_ms float not null,
+   pulse_guide_ms float not null
 );
 
 CREATE USER 'donuts'@'%';
 GRANT ALL PRIVILEGES ON donuts.autoguider_ref TO 'donuts'@'%' WITH GRANT OPTION;
 GRANT ALL PRIVILEGES ON donuts.autoguider_log TO 'donuts'@'%' WITH GRANT OPTION;
+GRANT ALL PRIVILEGES ON donuts.autoguider_timing TO 'donuts'@'%' WITH GRANT OPTION;
 GRANT ALL PRIVILEGES ON donuts.autoguider_ref TO 'donuts'@'localhost' WITH GRANT OPTION;
 GRANT ALL PRIVILEGES ON donuts.autoguider_log TO 'donuts'@'localhost' WITH GRANT OPTION;
+GRANT ALL PRIVILEGES ON donuts.autoguider_timing TO 'donuts'@'localhost' WITH GRANT OPTION;
 FLUSH PRIVILEGES;
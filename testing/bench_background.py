@@ -0,0 +1,82 @@
+"""
+Benchmark of sky background subtraction
+
+Compares donuts' tiled median background (remove_background)
+with the mesh background from voyager_background, alone and
+as part of measuring a frame with the donuts engine
+
+Usage: python testing/bench_background.py [--shape 4096 4096] [--mesh 64]
+"""
+import os
+import sys
+import time
+import tempfile
+import warnings
+import argparse as ap
+import numpy as np
+from donuts.image import Image
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# pylint: disable=wrong-import-position
+from voyager_background import MeshBackground
+from voyager_frame import load_frame, PreloadedDonuts
+from mock_voyager import make_star_field, write_frame
+from bench_shift import HEADER
+
+def timed(func, *args, repeat=3):
+    """
+    Best time of a few calls in ms
+    """
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best * 1000
+
+def arg_parse():
+    """
+    Parse the command line arguments
+    """
+    p = ap.ArgumentParser()
+    p.add_argument('--shape', type=int, nargs=2, default=(4096, 4096),
+                   help='ny nx of the frames')
+    p.add_argument('--mesh', type=int, default=64,
+                   help='mesh box size in pixels')
+    return p.parse_args()
+
+if __name__ == "__main__":
+    args = arg_parse()
+    warnings.simplefilter("ignore")
+    shape = tuple(args.shape)
+    yy, xx = np.mgrid[:shape[0], :shape[1]]
+    sky = 200 + 0.02 * xx + 0.01 * yy + 30 * np.sin(yy / 900.)
+    stars = make_star_field(shape, n_stars=shape[0] * shape[1] // 5000, sky=0)
+    data = (stars + sky).astype(np.uint16)
+    background = MeshBackground(mesh_size=args.mesh)
+    print(f"frame {shape[1]}x{shape[0]}, mesh {args.mesh} pix")
+
+    def donuts_background():
+        image = Image(np.ma.array(data))
+        image.raw_region = image.raw_image
+        image.remove_background()
+        return np.asarray(image.backsub_region)
+    def mesh_background():
+        return background.subtract(data.astype(np.float32))
+    for name, func in (("donuts", donuts_background), ("mesh", mesh_background)):
+        residual = func() - stars
+        print(f"{name:>6} background: {timed(func):7.1f} ms, "
+              f"residual rms {np.sqrt(np.mean((residual - np.median(residual))**2)):.2f}")
+
+    with tempfile.TemporaryDirectory() as folder:
+        ref_path = os.path.join(folder, "ref.fits")
+        check_path = os.path.join(folder, "check.fits")
+        write_frame(ref_path, data, HEADER)
+        write_frame(check_path, (make_star_field(shape, n_stars=shape[0] * shape[1] // 5000, sky=0,
+                                                 offset=(2.3, -1.7)) + sky).astype(np.uint16), HEADER)
+        for name, kwargs in (("donuts", {}), ("mesh", {"background": background})):
+            engine = PreloadedDonuts(load_frame(ref_path), subtract_bkg=True, **kwargs)
+            shift = engine.measure_shift(check_path)
+            per_frame = timed(engine.measure_shift, check_path)
+            print(f"{name:>6} background, donuts engine: per frame {per_frame:7.1f} ms, "
+                  f"shift x {shift.x.value:.3f} y {shift.y.value:.3f} (true -2.300 1.700)")
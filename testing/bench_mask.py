@@ -0,0 +1,89 @@
+"""
+Benchmark of boolean mask binning and subframe extraction
+
+Compares the row/column loops donuts used to bin the full
+frame mask on every reference change with the vectorised
+block reduce, and with a lookup in the Voyager mask cache
+
+Usage: python testing/bench_mask.py [--shape 6000 9000]
+"""
+import os
+import sys
+import time
+import argparse as ap
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# pylint: disable=wrong-import-position
+import voyager_utils as vutils
+import voyager_donuts
+
+def legacy_bin_boolean_mask(data, xbin, ybin):
+    """
+    How the mask used to be binned, a max over each block
+    done one row and then one binned column at a time
+    """
+    nrows, ncols = data.shape
+    n_binned_cols = ncols//xbin
+    n_binned_rows = nrows//ybin
+    x = np.zeros((nrows, n_binned_cols), dtype=np.uint16)
+    y = np.zeros((n_binned_rows, n_binned_cols), dtype=np.uint16)
+    for i in range(nrows):
+        x[i] = np.max(data[i][:n_binned_cols*xbin].reshape(n_binned_cols, xbin), axis=1)
+    for i in range(n_binned_cols):
+        y[:, i] = np.max(x[:, i][:n_binned_rows*ybin].reshape(n_binned_rows, ybin), axis=1)
+    return y
+
+def make_mask(shape, seed=42):
+    """
+    A full frame mask with some bad columns and hot pixels
+    """
+    rng = np.random.default_rng(seed)
+    mask = rng.random(shape) < 1e-4
+    mask[:, rng.integers(0, shape[1], 20)] = True
+    return mask.astype(np.uint8)
+
+def timed(func, *args, repeat=3):
+    """
+    Best time of a few calls in ms
+    """
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best * 1000
+
+def arg_parse():
+    """
+    Parse the command line arguments
+    """
+    p = ap.ArgumentParser()
+    p.add_argument('--shape', type=int, nargs=2, default=(6000, 9000),
+                   help='ny nx of the full frame mask')
+    return p.parse_args()
+
+if __name__ == "__main__":
+    args = arg_parse()
+    # Voyager converts the mask to boolean when it is loaded
+    mask = make_mask(tuple(args.shape)).astype(bool)
+    print(f"mask {mask.shape[1]}x{mask.shape[0]}")
+    for binning in (2, 3, 4):
+        assert np.array_equal(legacy_bin_boolean_mask(mask, binning, binning).astype(bool),
+                              vutils.bin_boolean_mask(mask, binning, binning))
+        legacy = timed(legacy_bin_boolean_mask, mask, binning, binning, repeat=1)
+        vectorised = timed(vutils.bin_boolean_mask, mask, binning, binning)
+        print(f"bin {binning}x{binning}: loops {legacy:.1f} ms vectorised {vectorised:.1f} ms "
+              f"({legacy/vectorised:.0f}x)")
+
+    # a reference change on a subframe, first time and cached
+    voyager = voyager_donuts.Voyager.__new__(voyager_donuts.Voyager)
+    voyager._full_frame_boolean_mask = mask # pylint: disable=protected-access
+    voyager._binned_masks = {} # pylint: disable=protected-access
+    voyager._subframe_masks = {} # pylint: disable=protected-access
+    # pylint: disable=protected-access
+    extract = voyager._Voyager__extract_image_pixel_mask
+    # pylint: enable=protected-access
+    subframe = (2, 2, False, 1024, 1024, 500, 500)
+    first = timed(extract, *subframe, repeat=1)
+    cached = timed(extract, *subframe, repeat=1000) * 1000
+    print(f"subframe mask 2x2: first {first:.1f} ms cached {cached:.1f} us")
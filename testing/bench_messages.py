@@ -0,0 +1,76 @@
+"""
+Micro-benchmark of message encoding and decoding
+
+Compares building a dict and calling json.dumps, as donuts
+used to for every message, with the pre-serialised templates,
+and the standard library json decoder with the fastest
+installed codec
+
+Usage: python testing/bench_messages.py
+"""
+import os
+import sys
+import json
+import time
+import uuid
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# pylint: disable=wrong-import-position
+from voyager_client import JsonCodec, VoyagerClient
+from voyager_donuts import Message
+
+N = 100000
+UID = str(uuid.uuid4())
+RECEIVED = [b'{"Event":"Polling","Timestamp":1652231344.88438,"Host":"DESKTOP-CNTF3JR","Inst":1}',
+            b'{"jsonrpc":"2.0","result":0,"id":123}',
+            b'{"Event":"RemoteActionResult","Timestamp":1652231345.1,"Host":"DESKTOP-CNTF3JR",'
+            b'"Inst":1,"UID":"8f0e6a4c-3b2d-4b1a-9f4e-2a6c1d7e9b30","ActionResultInt":4,'
+            b'"Motivo":"","ParamRet":{"FlipStatus":0}}']
+
+def per_call(func, n=N):
+    """
+    Mean time per call of func in microseconds
+    """
+    t0 = time.perf_counter()
+    for _ in range(n):
+        func()
+    return (time.perf_counter() - t0) / n * 1e6
+
+def pulse_guide_dumps():
+    """
+    How pulse guide commands used to be made
+    """
+    message = {"method": "RemotePulseGuide",
+               "params": {"UID": UID, "Direction": 2, "Duration": 350, "Parallelized": "true"},
+               "id": 12}
+    return (json.dumps(message) + "\r\n").encode('utf-8')
+
+def mount_status_dumps():
+    """
+    How mount status commands used to be made
+    """
+    message = {"method": "RemoteMountStatusGetInfo", "params": {"UID": UID}, "id": 12}
+    return (json.dumps(message) + "\r\n").encode('utf-8')
+
+def polling_dumps():
+    """
+    How keepalives used to be made
+    """
+    polling = {"Event": "Polling", "Timestamp": str(time.time()), "Host": "DESKTOP-CNTF3JR", "Inst": 1}
+    return (json.dumps(polling) + "\r\n").encode('utf-8')
+
+if __name__ == "__main__":
+    client = VoyagerClient("127.0.0.1", 5950, "DESKTOP-CNTF3JR", on_message=print)
+    print("encoding (us per message)      old   template")
+    rows = [("RemotePulseGuide", pulse_guide_dumps,
+             lambda: Message.pulse_guide(UID, 12, 2, 350).data + b"\r\n"),
+            ("RemoteMountStatusGetInfo", mount_status_dumps,
+             lambda: Message.get_mount_status(UID, 12).data + b"\r\n"),
+            ("Polling", polling_dumps, client.polling_str)]
+    for name, old, new in rows:
+        print(f"{name:28s} {per_call(old):6.2f} {per_call(new):8.2f}")
+
+    fast = JsonCodec()
+    print(f"\ndecoding (us per message)      json {fast.backend:>8s}")
+    for raw in RECEIVED:
+        name = json.loads(raw).get('Event', 'jsonrpc')
+        print(f"{name:28s} {per_call(lambda: json.loads(raw)):6.2f} {per_call(lambda: fast.loads(raw)):8.2f}")
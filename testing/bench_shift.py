@@ -0,0 +1,107 @@
+"""
+Benchmark and accuracy comparison of the shift engines
+
+Measures the same synthetic frames, shifted by known
+sub-pixel amounts, with every engine in SHIFT_ENGINES
+and reports the time per frame and the shift errors
+
+Usage: python testing/bench_shift.py [--shape 2048 2048] [--frames 20] [--binning 2]
+"""
+import os
+import sys
+import time
+import tempfile
+import warnings
+import argparse as ap
+from functools import partial
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# pylint: disable=wrong-import-position
+from voyager_frame import load_frame
+from voyager_shift import SHIFT_ENGINES, SoftwareBinned
+from mock_voyager import make_star_field, write_frame
+
+HEADER = {"OBJECT": "BENCH", "FILTER": "R", "EXPTIME": 10.0}
+
+def make_frames(folder, shape, n_frames, max_shift, n_stars, seed=42):
+    """
+    Write a reference and n_frames shifted frames
+
+    Returns
+    -------
+    ref_path : string
+        the reference frame
+    frames : list
+        (path, true x shift, true y shift), shifts in the donuts sign convention
+    """
+    rng = np.random.default_rng(seed)
+    ref_path = os.path.join(folder, "ref.fits")
+    write_frame(ref_path, make_star_field(shape, n_stars=n_stars), HEADER)
+    frames = []
+    for i in range(n_frames):
+        dx, dy = rng.uniform(-max_shift, max_shift, 2)
+        path = os.path.join(folder, f"frame_{i:03d}.fits")
+        write_frame(path, make_star_field(shape, n_stars=n_stars, offset=(dx, dy)), HEADER)
+        frames.append((path, -dx, -dy))
+    return ref_path, frames
+
+def measure(engine_name, ref_path, frames, binning=1):
+    """
+    Time and check one engine on the frames, binned
+    in software first if binning > 1
+
+    Returns
+    -------
+    init_ms : float
+        time to build the reference
+    per_frame_ms : float
+        median time to measure a frame
+    errors : array
+        (n_frames, 2) measured minus true x and y shifts
+    """
+    engine_class = SHIFT_ENGINES[engine_name]
+    if binning > 1:
+        engine_class = partial(SoftwareBinned, engine_class, binning=binning)
+    t0 = time.perf_counter()
+    engine = engine_class(load_frame(ref_path), subtract_bkg=True)
+    init_ms = (time.perf_counter() - t0) * 1000
+    times = []
+    errors = []
+    for path, true_x, true_y in frames:
+        frame = load_frame(path)
+        t0 = time.perf_counter()
+        shift = engine.measure_shift(frame)
+        times.append((time.perf_counter() - t0) * 1000)
+        errors.append((shift.x.value - true_x, shift.y.value - true_y))
+    return init_ms, np.median(times), np.array(errors)
+
+def arg_parse():
+    """
+    Parse the command line arguments
+    """
+    p = ap.ArgumentParser()
+    p.add_argument('--shape', type=int, nargs=2, default=(2048, 2048),
+                   help='ny nx of the frames')
+    p.add_argument('--frames', type=int, default=20,
+                   help='number of shifted frames')
+    p.add_argument('--max-shift', type=float, default=10.,
+                   help='largest shift in pixels')
+    p.add_argument('--stars', type=int, default=200,
+                   help='stars per frame')
+    p.add_argument('--binning', type=int, default=1,
+                   help='software binning before measuring')
+    return p.parse_args()
+
+if __name__ == "__main__":
+    args = arg_parse()
+    warnings.simplefilter("ignore")
+    with tempfile.TemporaryDirectory() as folder:
+        ref, shifted = make_frames(folder, tuple(args.shape), args.frames, args.max_shift, args.stars)
+        print(f"{args.frames} frames {args.shape[1]}x{args.shape[0]}, shifts up to {args.max_shift} pix")
+        for name in SHIFT_ENGINES:
+            init, per_frame, errs = measure(name, ref, shifted, args.binning)
+            rms = np.sqrt(np.mean(errs**2, axis=0))
+            worst = np.abs(errs).max(axis=0)
+            print(f"{name:>8}: reference {init:7.1f} ms, per frame {per_frame:7.1f} ms, "
+                  f"rms error x {rms[0]:.3f} y {rms[1]:.3f} pix, worst x {worst[0]:.3f} y {worst[1]:.3f} pix")
@@ -0,0 +1,657 @@
+"""
+Local stand in for Voyager's application server
+
+Speaks enough of Voyager's JSON-RPC and event protocol to
+exercise Voyager.run() end to end on Linux:
+
+   - Version and Polling events
+   - DonutsRecenterRequired / DonutsCalibrationRequired events
+   - jsonrpc acks and RemoteActionResult events for
+     RemotePulseGuide, RemoteMountStatusGetInfo,
+     RemoteCameraShot and RemoteActionAbort
+   - RemoteCameraShot writes a synthetic star field FITS
+
+A simple mount model moves the star field in response to
+pulse guides, so guide corrections have a measurable effect.
+Response latency, jitter, message coalescing and write
+fragmentation are all configurable.
+
+Run standalone against a donuts instance with e.g.:
+
+   python testing/mock_voyager.py --data-root /tmp/voyager_data \\
+       --recenters 50 --latency 0.02 --jitter 0.01 --coalesce 0.005
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse as ap
+import numpy as np
+from astropy.io import fits
+
+# pylint: disable=logging-fstring-interpolation
+# pylint: disable=too-many-instance-attributes
+# pylint: disable=too-many-arguments
+# pylint: disable=invalid-name
+
+def make_star_field(shape=(256, 256), n_stars=40, offset=(0., 0.), fwhm=3.0,
+                    sky=100., noise=5., seed=42):
+    """
+    Make a synthetic star field. Star positions are fixed by
+    the seed so frames with different offsets can be aligned
+
+    Parameters
+    ----------
+    shape : tuple, optional
+        (ny, nx) size of the image
+        default = (256, 256)
+    n_stars : int, optional
+        number of stars in the field
+        default = 40
+    offset : tuple, optional
+        (x, y) shift of the field in pixels
+        default = (0, 0)
+    fwhm : float, optional
+        star full width at half maximum in pixels
+        default = 3.0
+    sky : float, optional
+        sky background level
+        default = 100
+    noise : float, optional
+        gaussian read/sky noise level
+        default = 5
+    seed : int, optional
+        random seed for star positions and fluxes
+        default = 42
+
+    Returns
+    -------
+    data : array
+        float32 image of the star field
+
+    Raises
+    ------
+    None
+    """
+    rng = np.random.default_rng(seed)
+    ny, nx = shape
+    xs = rng.uniform(0, nx, n_stars) + offset[0]
+    ys = rng.uniform(0, ny, n_stars) + offset[1]
+    fluxes = rng.uniform(500, 20000, n_stars)
+    sigma = fwhm / 2.3548
+    yy, xx = np.mgrid[:ny, :nx]
+    data = np.full(shape, sky, dtype=np.float32)
+    for x, y, f in zip(xs, ys, fluxes):
+        # only paint a small box around each star to keep this quick
+        x0, x1 = int(max(x - 5*sigma, 0)), int(min(x + 5*sigma + 1, nx))
+        y0, y1 = int(max(y - 5*sigma, 0)), int(min(y + 5*sigma + 1, ny))
+        if x0 >= x1 or y0 >= y1:
+            continue
+        box = (xx[y0:y1, x0:x1] - x)**2 + (yy[y0:y1, x0:x1] - y)**2
+        data[y0:y1, x0:x1] += f * np.exp(-box / (2 * sigma**2))
+    data += np.random.default_rng().normal(0, noise, shape).astype(np.float32)
+    return data
+
+def write_frame(path, data, header_values):
+    """
+    Write a frame to disc with the supplied header cards
+
+    Parameters
+    ----------
+    path : string
+        where to write the FITS file
+    data : array
+        image data
+    header_values : dict
+        header keyword/value pairs
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    hdu = fits.PrimaryHDU(data)
+    for key, value in header_values.items():
+        hdu.header[key] = value
+    hdu.writeto(path, overwrite=True)
+
+class MockVoyager():
+    """
+    Scriptable mock of Voyager's application server
+    """
+    def __init__(self, path_map, host="127.0.0.1", port=0, latency=0.0, jitter=0.0,
+                 coalesce=0.0, fragment=0, poll_interval=5.0, flip_status=4,
+                 guide_directions=None, pixels_to_time=None, drift=(0., 0.),
+                 shape=(256, 256), header_values=None, seed=42, announce=None,
+                 hold=None, reject_overlap=False):
+        """
+        Initialise the mock server
+
+        Parameters
+        ----------
+        path_map : dict
+            maps Windows host path prefixes (as sent by donuts)
+            to local directories, e.g.
+            {"C:\\\\Voyager\\\\DonutsData": "/tmp/voyager_data"}
+        host : string, optional
+            address to listen on
+            default = 127.0.0.1
+        port : int, optional
+            port to listen on, 0 picks a free one
+            default = 0
+        latency : float, optional
+            mean delay in seconds before each response
+            default = 0
+        jitter : float, optional
+            responses are delayed by latency +/- up to jitter seconds
+            default = 0
+        coalesce : float, optional
+            if > 0, outgoing messages are buffered for this many
+            seconds and written together in one send
+            default = 0
+        fragment : int, optional
+            if > 0, each write is split into chunks of this many bytes
+            default = 0
+        poll_interval : float, optional
+            seconds between Polling events from the server
+            default = 5
+        flip_status : int, optional
+            FlipStatus reported by RemoteMountStatusGetInfo
+            default = 4 (FORK)
+        guide_directions : dict, optional
+            maps donuts guide directions (+x, -x, +y, -y) to
+            Voyager direction indexes. Should match the donuts config
+            default = {"+x": 0, "-x": 1, "+y": 2, "-y": 3}
+        pixels_to_time : dict, optional
+            ms of pulse guide per pixel for each direction
+            default = 100 ms/pixel in all directions
+        drift : tuple, optional
+            (x, y) pixels the field drifts between each frame
+            default = (0, 0)
+        shape : tuple, optional
+            (ny, nx) size of synthetic frames
+            default = (256, 256)
+        header_values : dict, optional
+            extra header cards for synthetic frames
+            default = None
+        seed : int, optional
+            random seed for the star field and jitter
+            default = 42
+        announce : float, optional
+            if set, send NewFITReady for each frame this many
+            seconds before the DonutsRecenterRequired, as Voyager does
+            default = None
+        hold : list, optional
+            command methods whose RemoteActionResult is held back
+            until release() is called with their UID, or the
+            command is aborted. The jsonrpc ack is still sent
+            default = None
+        reject_overlap : boolean, optional
+            reject a RemotePulseGuide sent while another
+            one is still running
+            default = False
+        """
+        self.path_map = path_map
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.coalesce = coalesce
+        self.fragment = fragment
+        self.poll_interval = poll_interval
+        self.flip_status = flip_status
+        if guide_directions is None:
+            guide_directions = {"+x": 0, "-x": 1, "+y": 2, "-y": 3}
+        self.guide_directions = guide_directions
+        if pixels_to_time is None:
+            pixels_to_time = {"+x": 100., "-x": 100., "+y": 100., "-y": 100.}
+        self.pixels_to_time = pixels_to_time
+        self.drift = drift
+        self.shape = shape
+        self.header_values = {"FILTER": "R", "OBJECT": "MOCK", "XBINNING": 1,
+                              "YBINNING": 1, "XORGSUBF": 0, "YORGSUBF": 0,
+                              "OBJCTRA": "12 00 00.00", "OBJCTDEC": "+00 00 00.00",
+                              "EXPTIME": 10.0}
+        if header_values is not None:
+            self.header_values.update(header_values)
+        self.seed = seed
+        self.announce = announce
+        self.hold = set(hold) if hold is not None else set()
+        self.reject_overlap = reject_overlap
+        self._random = random.Random(seed)
+
+        # where the mount has been pushed to, in pixels
+        self.offset = [0., 0.]
+
+        # everything donuts sent us, for checking in tests
+        self.received = []
+        self.commands = []
+        self.donuts_events = []
+        self.aborted = []
+        # most pulse guides ever running at once
+        self.max_n_pulsing = 0
+
+        # UID: future of (ActionResultInt, ParamRet) for held commands
+        self.held = {}
+
+        self._server = None
+        self._writers = []
+        self._tx_buffer = {}
+        self._flush_tasks = {}
+        self._poll_task = None
+        self._event_waiters = []
+        self._frame_id = 0
+        self._n_pulsing = 0
+
+    async def start(self):
+        """
+        Start listening. Sets self.port to the bound port
+        """
+        self._server = await asyncio.start_server(self.__handle_client, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._poll_task = asyncio.ensure_future(self.__poll_task())
+        logging.info(f"MOCK: listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        """
+        Stop the server and drop all clients
+        """
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+        for writer in list(self._writers):
+            await self.disconnect(writer)
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def disconnect(self, writer=None):
+        """
+        Drop a client connection, the most recent if not given.
+        Used to test reconnection
+        """
+        if writer is None:
+            writer = self._writers[-1]
+        if writer in self._writers:
+            self._writers.remove(writer)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+    async def wait_for_client(self, timeout=10):
+        """
+        Wait until at least one client is connected
+        """
+        t0 = time.monotonic()
+        while not self._writers:
+            if time.monotonic() - t0 > timeout:
+                raise TimeoutError("No client connected to mock Voyager")
+            await asyncio.sleep(0.01)
+
+    async def send_event(self, event, **kwargs):
+        """
+        Send an event to all connected clients
+
+        Parameters
+        ----------
+        event : string
+            name of the event
+        kwargs : dict
+            extra fields for the event
+        """
+        message = {"Event": event, "Timestamp": time.time(), "Host": "MOCK", "Inst": 1}
+        message.update(kwargs)
+        for writer in list(self._writers):
+            await self.__write(writer, message)
+
+    async def wait_for_donuts_event(self, names, timeout=30):
+        """
+        Wait for donuts to send one of the named events
+
+        Parameters
+        ----------
+        names : list
+            event names to wait for
+        timeout : float, optional
+            seconds to wait
+            default = 30
+
+        Returns
+        -------
+        event : dict
+            the event donuts sent
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._event_waiters.append((names, future))
+        return await asyncio.wait_for(future, timeout)
+
+    def new_frame(self):
+        """
+        Expose a synthetic frame at the current mount offset
+        plus drift and write it to the data folder
+
+        Returns
+        -------
+        host_path : string
+            Windows style path to the frame, as Voyager would send it
+        """
+        self.offset[0] += self.drift[0]
+        self.offset[1] += self.drift[1]
+        self._frame_id += 1
+        night = self.__night()
+        data_host_root = list(self.path_map.keys())[0]
+        host_path = f"{data_host_root}\\{night}\\mock_{self._frame_id:06d}.fits"
+        self.__expose(host_path)
+        return host_path
+
+    async def recenter(self, host_path=None, timeout=30):
+        """
+        Ask donuts to recenter on a frame and time the round trip
+
+        Parameters
+        ----------
+        host_path : string, optional
+            frame to recenter on, a new frame is exposed if not given
+        timeout : float, optional
+            seconds to wait for donuts to finish
+            default = 30
+
+        Returns
+        -------
+        result : string
+            DonutsRecenterDone or DonutsRecenterError
+        elapsed : float
+            seconds from DonutsRecenterRequired to the result
+        """
+        if host_path is None:
+            host_path = self.new_frame()
+        waiter = asyncio.ensure_future(self.wait_for_donuts_event(["DonutsRecenterDone",
+                                                                   "DonutsRecenterError"],
+                                                                  timeout))
+        await asyncio.sleep(0)
+        if self.announce is not None:
+            await self.send_event("NewFITReady", File=host_path, Type=0, VoyType="SHOT")
+            await asyncio.sleep(self.announce)
+        t0 = time.monotonic()
+        await self.send_event("DonutsRecenterRequired", FITPathAndName=host_path)
+        event = await waiter
+        return event['Event'], time.monotonic() - t0
+
+    async def wait_for_held(self, n_held=1, timeout=10):
+        """
+        Wait until at least n commands are being held
+
+        Returns
+        -------
+        uids : list
+            UIDs of the held commands, in arrival order
+        """
+        t0 = time.monotonic()
+        while len(self.held) < n_held:
+            if time.monotonic() - t0 > timeout:
+                raise TimeoutError("Commands never arrived at mock Voyager")
+            await asyncio.sleep(0.01)
+        return list(self.held)
+
+    def release(self, uid, result=4, param_ret=None):
+        """
+        Send the RemoteActionResult for a held command
+
+        Parameters
+        ----------
+        uid : string
+            UID of the held command
+        result : int, optional
+            ActionResultInt to send
+            default = 4 (OK)
+        param_ret : dict, optional
+            ParamRet to send
+            default = None (empty)
+        """
+        self.held.pop(uid).set_result((result, param_ret if param_ret is not None else {}))
+
+    def local_path(self, host_path):
+        """
+        Map a Windows host path onto the local filesystem
+        """
+        for prefix, local_root in self.path_map.items():
+            if host_path.startswith(prefix):
+                rest = host_path[len(prefix):].replace('\\', '/').lstrip('/')
+                return os.path.join(local_root, rest)
+        raise ValueError(f"No local mapping for {host_path}")
+
+    @staticmethod
+    def __night():
+        """
+        Nightly folder name, matches voyager_utils.get_tonight
+        """
+        # imported here so the mock has no hard dependency on the donuts tree
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        import voyager_utils as vutils # pylint: disable=import-outside-toplevel
+        return vutils.get_tonight()
+
+    def __expose(self, host_path):
+        """
+        Write a synthetic frame at the current offset
+        """
+        data = make_star_field(self.shape, offset=tuple(self.offset), seed=self.seed)
+        write_frame(self.local_path(host_path), data, self.header_values)
+
+    async def __handle_client(self, reader, writer):
+        """
+        Serve one donuts connection
+        """
+        self._writers.append(writer)
+        await self.__write(writer, {"Event": "Version", "Timestamp": time.time(),
+                                    "Host": "MOCK", "Inst": 1, "VOYVersion": "Mock"})
+        while True:
+            try:
+                line = await reader.readline()
+            except (ConnectionError, OSError):
+                break
+            if not line:
+                break
+            try:
+                message = json.loads(line)
+            except json.decoder.JSONDecodeError:
+                logging.warning(f"MOCK: cannot decode {line}")
+                continue
+            self.received.append(message)
+            if 'method' in message:
+                self.commands.append(message)
+                asyncio.ensure_future(self.__handle_command(writer, message))
+            elif message.get('Event', '').startswith('Donuts'):
+                self.donuts_events.append(message)
+                for names, future in list(self._event_waiters):
+                    if message['Event'] in names and not future.done():
+                        future.set_result(message)
+                        self._event_waiters.remove((names, future))
+        if writer in self._writers:
+            self._writers.remove(writer)
+
+    async def __handle_command(self, writer, message):
+        """
+        Serve a command, keeping count of the pulse guides running
+        """
+        method = message['method']
+        if method == "RemotePulseGuide":
+            # a pulse counts as running from the moment it arrives
+            if self.reject_overlap and self._n_pulsing > 0:
+                await self.__delay()
+                await self.__write(writer, {"jsonrpc": "2.0", "id": message['id'],
+                                            "error": {"code": 1, "message": "Mount busy with PulseGuide"}})
+                return
+            self._n_pulsing += 1
+            self.max_n_pulsing = max(self.max_n_pulsing, self._n_pulsing)
+            try:
+                await self.__respond(writer, message)
+            finally:
+                self._n_pulsing -= 1
+        else:
+            await self.__respond(writer, message)
+
+    async def __respond(self, writer, message):
+        """
+        Send the jsonrpc ack and RemoteActionResult for a command
+        """
+        method = message['method']
+        params = message['params']
+        uid = params['UID']
+        await self.__delay()
+        await self.__write(writer, {"jsonrpc": "2.0", "result": 0, "id": message['id']})
+        if method == "RemoteActionAbort":
+            self.aborted.append(params['UID'])
+            held = self.held.pop(params['UID'], None)
+            if held is not None and not held.done():
+                # 7 = ABORTED
+                held.set_result((7, {}))
+            return
+
+        if method in self.hold:
+            self.held[uid] = asyncio.get_running_loop().create_future()
+            result, param_ret = await self.held[uid]
+            await self.__write(writer, {"Event": "RemoteActionResult", "Timestamp": time.time(),
+                                        "Host": "MOCK", "Inst": 1, "UID": uid,
+                                        "ActionResultInt": result, "Motivo": "", "ParamRet": param_ret})
+            return
+
+        param_ret = {}
+        if method == "RemotePulseGuide":
+            await asyncio.sleep(params['Duration'] / 1000.)
+            self.__apply_pulse(params['Direction'], params['Duration'])
+        elif method == "RemoteMountStatusGetInfo":
+            param_ret = {"FlipStatus": self.flip_status}
+        elif method == "RemoteCameraShot":
+            self.__expose(params['FitFileName'])
+
+        await self.__delay()
+        await self.__write(writer, {"Event": "RemoteActionResult", "Timestamp": time.time(),
+                                    "Host": "MOCK", "Inst": 1, "UID": uid,
+                                    "ActionResultInt": 4, "Motivo": "", "ParamRet": param_ret})
+
+    def __apply_pulse(self, direction, duration):
+        """
+        Move the field in response to a pulse guide
+        """
+        for key, index in self.guide_directions.items():
+            if index == direction:
+                pixels = duration / self.pixels_to_time[key]
+                axis = 0 if key[1] == 'x' else 1
+                sign = 1 if key[0] == '+' else -1
+                self.offset[axis] += sign * pixels
+                return
+
+    async def __delay(self):
+        """
+        Sleep for the configured latency and jitter
+        """
+        delay = self.latency + self._random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def __poll_task(self):
+        """
+        Send Polling events like Voyager does
+        """
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            await self.send_event("Polling")
+
+    async def __write(self, writer, message):
+        """
+        Send a message, honouring the coalesce and fragment settings
+        """
+        data = json.dumps(message).encode('utf-8') + b'\r\n'
+        if self.coalesce > 0:
+            self._tx_buffer.setdefault(writer, bytearray()).extend(data)
+            if writer not in self._flush_tasks:
+                self._flush_tasks[writer] = asyncio.ensure_future(self.__flush_later(writer))
+            return
+        await self.__write_raw(writer, data)
+
+    async def __flush_later(self, writer):
+        """
+        Write everything buffered for a client in one go
+        """
+        await asyncio.sleep(self.coalesce)
+        data = bytes(self._tx_buffer.pop(writer, b''))
+        del self._flush_tasks[writer]
+        await self.__write_raw(writer, data)
+
+    async def __write_raw(self, writer, data):
+        """
+        Write bytes to a client, optionally fragmented
+        """
+        if writer.is_closing():
+            return
+        chunk = self.fragment if self.fragment > 0 else len(data)
+        try:
+            for i in range(0, len(data), chunk):
+                writer.write(data[i:i+chunk])
+                await writer.drain()
+        except (ConnectionError, OSError):
+            logging.warning("MOCK: client went away")
+
+def arg_parse():
+    """
+    Parse the command line arguments
+    """
+    p = ap.ArgumentParser()
+    p.add_argument('--port', type=int, default=5950,
+                   help='port to listen on')
+    p.add_argument('--data-root', required=True,
+                   help='local folder mounted as data_root in the donuts container')
+    p.add_argument('--data-root-host', default="C:\\Voyager\\DonutsData",
+                   help='data_root_host from the donuts config')
+    p.add_argument('--latency', type=float, default=0.0,
+                   help='mean response latency in seconds')
+    p.add_argument('--jitter', type=float, default=0.0,
+                   help='response jitter in seconds')
+    p.add_argument('--coalesce', type=float, default=0.0,
+                   help='buffer outgoing messages for this many seconds')
+    p.add_argument('--fragment', type=int, default=0,
+                   help='split writes into chunks of this many bytes')
+    p.add_argument('--recenters', type=int, default=0,
+                   help='number of recenter requests to time once donuts connects')
+    p.add_argument('--announce', type=float, default=None,
+                   help='send NewFITReady this many seconds before each recenter request')
+    p.add_argument('--drift', type=float, nargs=2, default=(0.5, -0.5),
+                   help='x y drift in pixels per frame')
+    return p.parse_args()
+
+async def main(args):
+    """
+    Run the mock server, optionally timing recenter requests
+    """
+    mock = MockVoyager({args.data_root_host: args.data_root}, host="0.0.0.0", port=args.port,
+                       latency=args.latency, jitter=args.jitter, coalesce=args.coalesce,
+                       fragment=args.fragment, drift=tuple(args.drift),
+                       announce=args.announce)
+    await mock.start()
+    if args.recenters > 0:
+        await mock.wait_for_client(timeout=3600)
+        # give donuts a moment to do its mount handshake
+        await asyncio.sleep(1)
+        times = []
+        for _ in range(args.recenters):
+            result, elapsed = await mock.recenter()
+            times.append(elapsed)
+            logging.info(f"MOCK: {result} in {elapsed*1000:.1f} ms, offset {mock.offset}")
+        times = np.array(times) * 1000
+        print(f"recenters: {len(times)} median: {np.median(times):.1f} ms "
+              f"p90: {np.percentile(times, 90):.1f} ms max: {times.max():.1f} ms")
+        await mock.stop()
+    else:
+        await asyncio.Event().wait()
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    asyncio.run(main(arg_parse()))
@@ -0,0 +1,61 @@
+"""
+The mesh background recovers the sky in place and
+the shift engines measure the same shifts with it
+"""
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# pylint: disable=wrong-import-position
+from voyager_background import MeshBackground
+from voyager_frame import load_frame, PreloadedDonuts, SIDECAR_SUFFIX
+from voyager_shift import SHIFT_ENGINES
+from bench_shift import make_frames
+from mock_voyager import make_star_field
+
+
+def test_mesh_background():
+    """
+    A sloping sky under stars is removed to the noise level,
+    in place, with the geometry worked out once per shape
+    """
+    shape = (600, 500)
+    yy, xx = np.mgrid[:shape[0], :shape[1]]
+    sky = 200 + 0.05 * xx + 0.02 * yy
+    stars = make_star_field(shape, n_stars=300, sky=0)
+    data = (stars + sky).astype(np.float32)
+    background = MeshBackground(mesh_size=50)
+
+    assert background.subtract(data) is data
+    assert np.sqrt(np.mean((data - stars)**2)) < 1
+    assert background.geometry(shape) is background.geometry(shape)
+    assert background.geometry(shape).mesh_shape == (12, 10)
+
+    # masked pixels don't count towards the sky
+    data = (stars + sky).astype(np.float32)
+    mask = np.zeros(shape, dtype=bool)
+    mask[:, :100] = True
+    data[mask] = 1e5
+    background.subtract(data, mask)
+    assert np.sqrt(np.mean((data - stars)[~mask]**2)) < 1
+
+def test_engines_with_background(tmp_path):
+    """
+    Shifts are unchanged using the mesh background, and it
+    invalidates sidecars built with donuts' background
+    """
+    ref_path, frames = make_frames(str(tmp_path), (256, 256), 3, 8., 40)
+    background = MeshBackground(mesh_size=32)
+    for name in SHIFT_ENGINES:
+        engine = SHIFT_ENGINES[name](load_frame(ref_path), subtract_bkg=True, background=background)
+        for path, true_x, true_y in frames:
+            shift = engine.measure_shift(load_frame(path))
+            assert abs(shift.x.value - true_x) < 0.25, name
+            assert abs(shift.y.value - true_y) < 0.25, name
+
+    sidecar = ref_path + SIDECAR_SUFFIX
+    PreloadedDonuts(ref_path, sidecar=sidecar, subtract_bkg=True)
+    assert not PreloadedDonuts(ref_path, sidecar=sidecar, subtract_bkg=True,
+                               background=background).sidecar_loaded
+    assert PreloadedDonuts(ref_path, sidecar=sidecar, subtract_bkg=True,
+                           background=background).sidecar_loaded
@@ -0,0 +1,56 @@
+"""
+Record a session against the mock Voyager server
+and replay it through a fresh donuts instance
+"""
+import os
+import sys
+import glob
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# pylint: disable=wrong-import-position
+import voyager_capture as vcap
+from test_mock_voyager import run_session, recenter_n, make_config, fake_db # pylint: disable=unused-import
+
+
+def test_record_and_replay(tmp_path, fake_db):
+    """
+    Every recenter in the capture is replayed, faster than it was recorded
+    """
+    capture_root = tmp_path / "capture"
+    capture_root.mkdir()
+    recorded = run_session(tmp_path, lambda mock: recenter_n(mock, 5),
+                           config_overrides={"capture_root": str(capture_root)},
+                           drift=(1.0, -1.0), latency=0.05)
+    capture_path, = glob.glob(f"{capture_root}/*.vcap.gz")
+
+    capture = vcap.Capture(vcap.read_capture(capture_path))
+    assert len(capture.frames) == 5
+    assert capture.n_connections == 1
+    assert len(capture.param_rets["RemoteMountStatusGetInfo"]) == 1
+    assert len(capture.param_rets["RemotePulseGuide"]) > 0
+
+    results, db, elapsed = vcap.replay(make_config(tmp_path / "replay", 0), capture_path)
+    assert [reply for _, reply, _ in results] == [result for result, _ in recorded]
+    assert len(db.shifts) == 4
+    assert len(db.timings) == 5
+    assert elapsed < sum(seconds for _, seconds in recorded) + 2
+
+def test_truncated_capture(tmp_path):
+    """
+    A capture cut short by a crash is read up to the last whole record
+    """
+    path = str(tmp_path / "test.vcap.gz")
+    writer = vcap.CaptureWriter(path)
+    writer.record(vcap.CONNECT, b'127.0.0.1:5950')
+    writer.record(vcap.RX, b'{"Event":"Polling"}\r\n')
+    writer.record_fits('/voyager_data/a.fits')
+    writer.record(vcap.RX, b'{"Event":"Version"}\r\n' * 100)
+    writer.close()
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(data[:-20])
+
+    records = vcap.read_capture(path)
+    assert [kind for kind, _, _ in records[:3]] == [vcap.CONNECT, vcap.RX, vcap.FITS]
+    assert records[2][2] == b'/voyager_data/a.fits'
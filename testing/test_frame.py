@@ -0,0 +1,222 @@
+"""
+Frames loaded once give the same shifts as donuts
+reading the files itself
+"""
+import os
+import sys
+import time
+import threading
+import numpy as np
+from astropy.io import fits
+from donuts import Donuts
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# pylint: disable=wrong-import-position
+import voyager_frame
+from voyager_frame import (
+    load_frame, PreloadedDonuts, FrameWatcher, ReferenceCache, ReferenceArchiver,
+    remove_sidecars, archive_file, frame_complete, SIDECAR_SUFFIX
+    )
+from mock_voyager import make_star_field, write_frame
+
+HEADER = {"OBJECT": "TEST", "FILTER": "R", "EXPTIME": 10.0}
+
+
+def test_matches_donuts(tmp_path, monkeypatch):
+    """
+    Same shift as stock donuts, with one fits.open per frame
+    """
+    ref_path = str(tmp_path / "ref.fits")
+    check_path = str(tmp_path / "check.fits")
+    write_frame(ref_path, make_star_field(), HEADER)
+    write_frame(check_path, make_star_field(offset=(3.0, -2.0)), HEADER)
+    mask = np.zeros((256, 256), dtype=bool)
+    mask[:, 10] = True
+
+    expected = Donuts(ref_path, subtract_bkg=True, image_pixel_mask=mask).measure_shift(check_path)
+
+    opened = []
+    real_open = fits.open
+    def counting_open(*args, **kwargs):
+        opened.append(args[0])
+        return real_open(*args, **kwargs)
+    monkeypatch.setattr(voyager_frame.fits, "open", counting_open)
+
+    ref = load_frame(ref_path)
+    check = load_frame(check_path)
+    assert check["OBJECT"] == "TEST"
+    donuts_ref = PreloadedDonuts(ref, subtract_bkg=True, image_pixel_mask=mask)
+    shift = donuts_ref.measure_shift(check)
+
+    assert opened == [ref_path, check_path]
+    assert donuts_ref.refimage_filename == ref_path
+    assert shift.x.value == expected.x.value
+    assert shift.y.value == expected.y.value
+
+def test_scaled_frames(tmp_path):
+    """
+    Unsigned 16 bit frames, stored scaled with BZERO, load
+    and give the same shift as stock donuts
+    """
+    ref_path = str(tmp_path / "ref.fits")
+    check_path = str(tmp_path / "check.fits")
+    write_frame(ref_path, make_star_field().astype(np.uint16), HEADER)
+    write_frame(check_path, make_star_field(offset=(3.0, -2.0)).astype(np.uint16), HEADER)
+    assert fits.getheader(ref_path)["BZERO"] == 32768
+
+    check = load_frame(check_path)
+    assert check.data.dtype == np.uint16
+    expected = Donuts(ref_path, subtract_bkg=True).measure_shift(check_path)
+    shift = PreloadedDonuts(load_frame(ref_path), subtract_bkg=True).measure_shift(check)
+    assert shift.x.value == expected.x.value
+    assert shift.y.value == expected.y.value
+
+def test_watcher_waits_for_whole_frame(tmp_path):
+    """
+    The watcher returns once the last byte lands, and gives up on a torn frame
+    """
+    path = str(tmp_path / "full.fits")
+    write_frame(path, make_star_field(), HEADER)
+    with open(path, 'rb') as f:
+        data = f.read()
+    assert frame_complete(path)
+
+    slow_path = str(tmp_path / "slow.fits")
+    def slow_write():
+        with open(slow_path, 'wb') as f:
+            for i in range(0, len(data), 40000):
+                f.write(data[i:i+40000])
+                f.flush()
+                time.sleep(0.02)
+    for use_inotify in (True, False):
+        watcher = FrameWatcher(timeout=5, use_inotify=use_inotify)
+        writer = threading.Thread(target=slow_write)
+        writer.start()
+        assert watcher.wait(slow_path)
+        assert os.path.getsize(slow_path) >= len(data) - 2880
+        writer.join()
+        watcher.close()
+        os.remove(slow_path)
+
+    torn_path = str(tmp_path / "torn.fits")
+    with open(torn_path, 'wb') as f:
+        f.write(data[:len(data) // 2])
+    watcher = FrameWatcher(timeout=0.2)
+    t_start = time.monotonic()
+    assert not watcher.wait(torn_path)
+    assert time.monotonic() - t_start < 1
+    assert not frame_complete(str(tmp_path / "missing.fits"))
+
+def test_reference_cache(tmp_path):
+    """
+    Least recently used references go first, stale paths are dropped
+    """
+    path = str(tmp_path / "ref.fits")
+    write_frame(path, make_star_field(), HEADER)
+    donuts_ref = PreloadedDonuts(load_frame(path))
+    nbytes = donuts_ref.nbytes
+    assert nbytes > 256 * 256 * 4
+
+    cache = ReferenceCache(max_entries=2)
+    cache.put("R", path, donuts_ref)
+    cache.put("V", path, donuts_ref)
+    assert cache.get("R", path) is donuts_ref
+    cache.put("B", path, donuts_ref)
+    assert cache.get("V", path) is None
+    assert cache.get("R", path) is donuts_ref
+    assert cache.get("R", "other.fits") is None
+    assert len(cache) == 1 and cache.nbytes == nbytes
+
+    # memory limit evicts down to the newest reference
+    cache = ReferenceCache(max_entries=8, max_mb=1.5 * nbytes / 1024**2)
+    cache.put("R", path, donuts_ref)
+    cache.put("V", path, donuts_ref)
+    assert cache.get("R", path) is None and cache.get("V", path) is donuts_ref
+
+def test_reference_sidecar(tmp_path):
+    """
+    A saved reference loads without reading the FITS and gives the
+    same shifts. Corrupt or out of date sidecars are rebuilt
+    """
+    ref_path = str(tmp_path / "ref.fits")
+    check_path = str(tmp_path / "check.fits")
+    sidecar = ref_path + SIDECAR_SUFFIX
+    write_frame(ref_path, make_star_field(), HEADER)
+    write_frame(check_path, make_star_field(offset=(3.0, -2.0)), HEADER)
+    mask = np.zeros((256, 256), dtype=bool)
+    mask[:, 10] = True
+
+    built = PreloadedDonuts(ref_path, sidecar=sidecar, subtract_bkg=True, image_pixel_mask=mask)
+    assert not built.sidecar_loaded and os.path.exists(sidecar)
+    expected = built.measure_shift(check_path)
+
+    loaded = PreloadedDonuts(ref_path, sidecar=sidecar, subtract_bkg=True, image_pixel_mask=mask)
+    assert loaded.sidecar_loaded
+    shift = loaded.measure_shift(check_path)
+    assert shift.x.value == expected.x.value
+    assert shift.y.value == expected.y.value
+
+    # different settings
+    rebuilt = PreloadedDonuts(ref_path, sidecar=sidecar, subtract_bkg=False, image_pixel_mask=mask)
+    assert not rebuilt.sidecar_loaded
+
+    # reference replaced by a different frame of the same size
+    size = os.path.getsize(ref_path)
+    write_frame(ref_path, make_star_field(offset=(1.0, 1.0)), HEADER)
+    mtime = os.stat(ref_path).st_mtime_ns
+    # in case the filesystem timestamps are coarse
+    os.utime(ref_path, ns=(mtime + 10**9, mtime + 10**9))
+    assert os.path.getsize(ref_path) == size
+    replaced = PreloadedDonuts(ref_path, sidecar=sidecar, subtract_bkg=False, image_pixel_mask=mask)
+    assert not replaced.sidecar_loaded
+    assert PreloadedDonuts(ref_path, sidecar=sidecar, subtract_bkg=False, image_pixel_mask=mask).sidecar_loaded
+
+    # corrupt arrays
+    with np.load(sidecar) as npz:
+        arrays = dict(npz)
+    arrays["proj_x"] = arrays["proj_x"] + 1
+    with open(sidecar, 'wb') as f:
+        np.savez(f, **arrays)
+    assert not PreloadedDonuts(ref_path, sidecar=sidecar).sidecar_loaded
+    with open(sidecar, 'wb') as f:
+        f.write(b'not a sidecar')
+    assert not PreloadedDonuts(ref_path, sidecar=sidecar).sidecar_loaded
+    assert PreloadedDonuts(ref_path, sidecar=sidecar).sidecar_loaded
+
+    # disabling the reference removes its sidecars, binned ones included
+    binned = f"{ref_path}.sw2x2{SIDECAR_SUFFIX}"
+    with open(binned, 'wb') as f:
+        f.write(b'binned sidecar')
+    assert sorted(remove_sidecars(ref_path)) == sorted([sidecar, binned])
+    assert not os.path.exists(sidecar) and os.path.exists(ref_path)
+
+def test_reference_archiver(tmp_path):
+    """
+    References are archived in the background and only
+    recorded once the archived copy is complete
+    """
+    src = str(tmp_path / "ref.fits")
+    write_frame(src, make_star_field(), HEADER)
+    # an hour old, so a fresh copy would stand out
+    mtime = os.stat(src).st_mtime_ns - 3600 * 10**9
+    os.utime(src, ns=(mtime, mtime))
+    dst = str(tmp_path / "archive" / "ref.fits")
+    os.mkdir(tmp_path / "archive")
+    assert archive_file(src, dst) == "hardlink"
+    # an existing reference is replaced by a full copy
+    assert archive_file(src, dst) in ("reflink", "copy")
+    assert frame_complete(dst)
+    # whichever way, the archived reference keeps the source's mtime
+    assert os.stat(dst).st_mtime_ns == mtime
+    assert not os.path.samefile(src, dst)
+
+    recorded = []
+    release = threading.Event()
+    archiver = ReferenceArchiver()
+    archiver.archive("block", src, str(tmp_path / "block.fits"), release.wait)
+    archiver.archive("R", src, dst + ".R", lambda: recorded.append(os.path.getsize(dst + ".R")))
+    assert archiver.pending("R") == (src, dst + ".R")
+    assert not archiver.wait(timeout=0.05)
+    release.set()
+    assert archiver.wait(timeout=5)
+    assert archiver.pending("R") is None
+    assert recorded == [os.path.getsize(src)]
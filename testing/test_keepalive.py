@@ -0,0 +1,46 @@
+"""
+The keepalive keeps to its schedule while the
+threads using the client are busy
+"""
+import os
+import sys
+import time
+import asyncio
+import threading
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# pylint: disable=wrong-import-position
+from voyager_client import VoyagerClient
+from mock_voyager import MockVoyager
+
+
+def test_keepalive_while_caller_is_blocked(tmp_path):
+    """
+    Polls keep going out every interval while the caller is
+    stuck, like the main thread waiting on a guide result
+    """
+    interval = 0.1
+    async def session():
+        mock = MockVoyager({"C:\\Voyager\\DonutsData": str(tmp_path)}, poll_interval=60)
+        await mock.start()
+        client = VoyagerClient("127.0.0.1", mock.port, "TEST", on_message=lambda rec: None,
+                               keepalive_interval=interval)
+        started = threading.Event()
+        def blocked_caller():
+            client.start(timeout=5)
+            started.set()
+            # stand in for a long measurement or calibration exposure
+            time.sleep(1.0)
+        caller = threading.Thread(target=blocked_caller)
+        caller.start()
+        await asyncio.get_running_loop().run_in_executor(None, caller.join)
+        assert started.is_set()
+        client.stop()
+        await mock.stop()
+        polls = [rec for rec in mock.received if rec.get('Event') == "Polling"]
+        return polls, client.keepalive_stats
+    polls, stats = asyncio.run(session())
+    # one hello poll plus roughly one per interval
+    assert len(polls) >= 8
+    assert stats.n_sent >= 7
+    assert stats.max_gap < 3 * interval
+    assert stats.max_jitter < interval
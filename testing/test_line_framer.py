@@ -0,0 +1,113 @@
+"""
+Tests for the Voyager stream framer
+
+Scenarios are taken from the live socket reads
+seen while developing test_receive_until.py
+"""
+import json
+import pytest
+from voyager_client import LineFramer
+
+POLLING = b'{"Event":"Polling","Timestamp":1652231344.88438,"Host":"DESKTOP-CNTF3JR","Inst":1}'
+SIGNAL = b'{"Event":"Signal","Timestamp":1652231344.9,"Host":"DESKTOP-CNTF3JR","Inst":1,"Code":5}'
+NEW_FIT = b'{"Event":"NewFITReady","Timestamp":1652231345.1,"Host":"DESKTOP-CNTF3JR","Inst":1,"File":"C:\\\\Data\\\\a.fit"}'
+
+
+def test_single_complete_message():
+    """
+    One message and its delimiter in a single read
+    """
+    framer = LineFramer()
+    assert framer.feed(POLLING + b'\r\n') == [POLLING]
+    assert framer.pending == 0
+
+def test_message_split_over_reads():
+    """
+    The delimiter is not found on the first read, so
+    the partial message must be held for the next one
+    """
+    framer = LineFramer()
+    assert framer.feed(POLLING[:20]) == []
+    assert framer.feed(POLLING[20:50]) == []
+    assert framer.feed(POLLING[50:] + b'\r\n') == [POLLING]
+    assert framer.pending == 0
+
+def test_message_end_and_next_start():
+    """
+    One read ends a message and starts the next. The start
+    of the next message used to go to message_overflow
+    """
+    framer = LineFramer()
+    assert framer.feed(POLLING[:30]) == []
+    assert framer.feed(POLLING[30:] + b'\r\n' + SIGNAL[:10]) == [POLLING]
+    assert framer.pending == 10
+    assert framer.feed(SIGNAL[10:] + b'\r\n') == [SIGNAL]
+
+def test_burst_of_messages_in_one_read():
+    """
+    Voyager bursts Polling, Signal and NewFITReady together
+    """
+    framer = LineFramer()
+    data = POLLING + b'\r\n' + SIGNAL + b'\r\n' + NEW_FIT + b'\r\n'
+    messages = framer.feed(data)
+    assert messages == [POLLING, SIGNAL, NEW_FIT]
+    assert [json.loads(m)['Event'] for m in messages] == ["Polling", "Signal", "NewFITReady"]
+
+def test_burst_with_trailing_partial():
+    """
+    Two complete messages and the start of a third
+    """
+    framer = LineFramer()
+    data = POLLING + b'\r\n' + SIGNAL + b'\r\n' + NEW_FIT[:15]
+    assert framer.feed(data) == [POLLING, SIGNAL]
+    assert framer.feed(NEW_FIT[15:] + b'\r\n') == [NEW_FIT]
+
+def test_delimiter_split_over_reads():
+    """
+    The \\r and \\n arrive in different reads
+    """
+    framer = LineFramer()
+    assert framer.feed(POLLING + b'\r') == []
+    assert framer.feed(b'\n' + SIGNAL + b'\r') == [POLLING]
+    assert framer.feed(b'\n') == [SIGNAL]
+    assert framer.pending == 0
+
+def test_empty_reads_are_harmless():
+    """
+    Socket timeouts used to append b'' to the buffer until
+    the emergency break fired. They should now be ignored
+    """
+    framer = LineFramer()
+    assert framer.feed(POLLING[:10]) == []
+    for _ in range(20):
+        assert framer.feed(b'') == []
+    assert framer.feed(POLLING[10:] + b'\r\n') == [POLLING]
+
+def test_empty_messages_skipped():
+    """
+    Back to back delimiters do not produce empty messages
+    """
+    framer = LineFramer()
+    assert framer.feed(b'\r\n\r\n' + POLLING + b'\r\n\r\n') == [POLLING]
+
+def test_byte_at_a_time():
+    """
+    Worst case fragmentation still gives every message
+    """
+    framer = LineFramer()
+    data = POLLING + b'\r\n' + SIGNAL + b'\r\n'
+    messages = []
+    for i in range(len(data)):
+        messages.extend(framer.feed(data[i:i+1]))
+    assert messages == [POLLING, SIGNAL]
+
+def test_overflow_resets_buffer():
+    """
+    A stream with no delimiters is abandoned rather than
+    growing without bound
+    """
+    framer = LineFramer(max_buffer=64)
+    with pytest.raises(ValueError):
+        framer.feed(b'x' * 65)
+    assert framer.pending == 0
+    assert framer.feed(POLLING + b'\r\n') == [POLLING]
@@ -0,0 +1,41 @@
+"""
+Vectorised mask binning matches the old loops, and
+binned/subframed masks are only made once
+"""
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# pylint: disable=wrong-import-position
+import voyager_utils as vutils
+import voyager_donuts
+from bench_mask import legacy_bin_boolean_mask, make_mask
+
+
+def test_bin_boolean_mask():
+    """
+    Same result as the old loops, including partial bins at the edges
+    """
+    mask = make_mask((301, 257))
+    for xbin, ybin in ((1, 1), (2, 2), (3, 2), (4, 3)):
+        expected = legacy_bin_boolean_mask(mask, xbin, ybin).astype(bool)
+        assert np.array_equal(vutils.bin_boolean_mask(mask, xbin, ybin), expected)
+
+def test_mask_cache():
+    """
+    Repeated requests for a mask return the cached, read only, copy
+    """
+    # pylint: disable=protected-access
+    voyager = voyager_donuts.Voyager.__new__(voyager_donuts.Voyager)
+    voyager._full_frame_boolean_mask = make_mask((300, 400)).astype(bool)
+    voyager._binned_masks = {}
+    voyager._subframe_masks = {}
+    extract = voyager._Voyager__extract_image_pixel_mask
+
+    subframe = extract(2, 2, width_x=50, height_y=40, subf_start_x=10, subf_start_y=20)
+    expected = vutils.bin_boolean_mask(voyager._full_frame_boolean_mask, 2, 2)[20:60, 10:60]
+    assert np.array_equal(subframe, expected)
+    assert extract(2, 2, width_x=50, height_y=40, subf_start_x=10, subf_start_y=20) is subframe
+    assert extract(2, 2, full_frame=True).shape == (150, 200)
+    assert list(voyager._binned_masks) == [(2, 2)]
+    assert not subframe.flags.writeable
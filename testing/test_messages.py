@@ -0,0 +1,59 @@
+"""
+Tests for the pre-serialised message templates and JSON codecs
+"""
+import json
+import pytest
+from voyager_client import JsonCodec, MessageTemplate, TemplateField, VoyagerClient
+from voyager_donuts import Message
+
+UID = "8f0e6a4c-3b2d-4b1a-9f4e-2a6c1d7e9b30"
+
+
+@pytest.mark.parametrize("message", [
+    Message.pulse_guide(UID, 12, 2, 350),
+    Message.camera_shot(UID, 13, 20, 0, 1, True, "C:\\Voyager\\DonutsCalibration\\2024-01-01\\step_000_\"é\".fits"),
+    Message.goto_radec(UID, 14, "12 34 56.78", "-01 02 03.4"),
+    Message.get_mount_status(UID, 15),
+])
+def test_template_matches_message(message):
+    """
+    The spliced bytes decode to exactly the message dict
+    """
+    assert json.loads(message.data) == dict(message)
+
+def test_template_value_types():
+    """
+    Ints, floats, bools, None and strings needing escapes
+    are all spliced in as valid JSON
+    """
+    template = MessageTemplate({"a": TemplateField("a"), "b": [1, TemplateField("b")],
+                                "c": {"d": TemplateField("c")}, "fixed": "x"})
+    for value in (0, -3, 1.5, True, None, "plain", "back\\slash \"quoted\"\n", "ü"):
+        data = template.render(a=value, b=value, c=value)
+        assert json.loads(data) == {"a": value, "b": [1, value], "c": {"d": value}, "fixed": "x"}
+    with pytest.raises(KeyError):
+        template.render(a=1, b=2)
+
+def test_polling_template():
+    """
+    The keepalive still looks like the old json.dumps version
+    """
+    client = VoyagerClient("127.0.0.1", 5950, "DESKTOP-CNTF3JR", on_message=print)
+    data = client.polling_str()
+    assert data.endswith(b'\r\n')
+    rec = json.loads(data)
+    assert rec['Event'] == "Polling" and rec['Host'] == "DESKTOP-CNTF3JR" and rec['Inst'] == 1
+    assert isinstance(rec['Timestamp'], str)
+
+@pytest.mark.parametrize("backend", ["json", "orjson"])
+def test_codecs_agree(backend):
+    """
+    Both backends decode Voyager messages the same way
+    """
+    pytest.importorskip(backend)
+    codec = JsonCodec(backend)
+    raw = b'{"Event":"RemoteActionResult","Timestamp":1652231344.88,"UID":"abc","ActionResultInt":4,"ParamRet":{"FlipStatus":0}}'
+    assert codec.loads(raw) == json.loads(raw)
+    assert json.loads(codec.dumps(json.loads(raw))) == json.loads(raw)
+    with pytest.raises(ValueError):
+        codec.loads(b'{"Event": "Polling"')
@@ -0,0 +1,594 @@
+"""
+End to end tests of Voyager.run() against the local mock
+Voyager server in mock_voyager.py
+"""
+import os
+import sys
+import errno
+import time
+import asyncio
+import threading
+import pytest
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# pylint: disable=wrong-import-position
+import voyager_donuts
+import voyager_frame
+from mock_voyager import MockVoyager
+from voyager_client import VoyagerClient, VoyagerCommandError
+from voyager_frame import PreloadedDonuts, SIDECAR_SUFFIX
+
+DATA_ROOT_HOST = "C:\\Voyager\\DonutsData"
+REFERENCE_ROOT_HOST = "C:\\Voyager\\DonutsReference"
+CALIBRATION_ROOT_HOST = "C:\\Voyager\\DonutsCalibration"
+GUIDE_DIRECTIONS = {"+x": 0, "-x": 1, "+y": 2, "-y": 3}
+PIXELS_TO_TIME = {"+x": 20., "-x": 20., "+y": 20., "-y": 20.}
+
+
+def make_config(tmp_path, port, **overrides):
+    """
+    Minimal FORK mount config pointing at the mock server
+    """
+    config = {
+        "host": "MOCK", "socket_ip": "127.0.0.1", "socket_port": port,
+        "calibration_root_host": CALIBRATION_ROOT_HOST,
+        "data_root_host": DATA_ROOT_HOST,
+        "reference_root_host": REFERENCE_ROOT_HOST,
+        "calibration_root": str(tmp_path / "calibration"),
+        "data_root": str(tmp_path / "data"),
+        "reference_root": str(tmp_path / "reference"),
+        "logging_root": str(tmp_path / "log"),
+        "image_extension": ".fits", "filter_keyword": "FILTER", "field_keyword": "OBJECT",
+        "ra_keyword": "OBJCTRA", "dec_keyword": "OBJCTDEC",
+        "xbin_keyword": "XBINNING", "ybin_keyword": "YBINNING",
+        "xsize_keyword": "NAXIS1", "ysize_keyword": "NAXIS2",
+        "xorigin_keyword": "XORGSUBF", "yorigin_keyword": "YORGSUBF",
+        "logging_level": "info", "logging_location": "stdout",
+        "donuts_subtract_bkg": False,
+        "calibration_filter_index": 0, "calibration_binning": 1,
+        "calibration_step_size_ms": 1000, "calibration_n_iterations": 2,
+        "calibration_exptime": 1,
+        "ra_axis": "y", "mount_type": "FORK",
+        "pixels_to_time": PIXELS_TO_TIME, "guide_directions": GUIDE_DIRECTIONS,
+        "guide_buffer_length": 20, "guide_buffer_sigma": 10,
+        "max_error_pixels": 20, "n_images_to_stabilise": 2,
+        "stabilised_pixel_shift": 2,
+        "pid_coeffs": {"x": {"p": 0.75, "i": 0.02, "d": 0.0},
+                       "y": {"p": 0.7, "i": 0.02, "d": 0.0},
+                       "set_x": 0.0, "set_y": 0.0},
+        "command_timeouts": {"RemotePulseGuide": 5, "RemoteCameraShot": 10,
+                             "RemoteMountStatusGetInfo": 5},
+    }
+    config.update(overrides)
+    for key in ("calibration_root", "data_root", "reference_root", "logging_root"):
+        os.makedirs(config[key], exist_ok=True)
+    return config
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    """
+    Keep reference images and shifts in memory, there is no MySQL here
+    """
+    refs = {}
+    shifts = []
+    timings = []
+    monkeypatch.setattr(voyager_donuts.vdb, "get_reference_image_path",
+                        lambda *args: refs.get(args))
+    monkeypatch.setattr(voyager_donuts.vdb, "set_reference_image",
+                        lambda path, *args: refs.__setitem__(args, path))
+    monkeypatch.setattr(voyager_donuts.vdb, "log_shifts_to_db", shifts.append)
+    monkeypatch.setattr(voyager_donuts.vdb, "log_frame_timing_to_db",
+                        lambda *args: timings.append(args))
+    return refs, shifts, timings
+
+def run_session(tmp_path, script, config_overrides=None, **mock_kwargs):
+    """
+    Start the mock server and a donuts instance, run the
+    scripted coroutine against them and shut everything down
+
+    Parameters
+    ----------
+    tmp_path : Path
+        scratch directory for data, references etc
+    script : coroutine function
+        called with the running MockVoyager, returns the test result
+    config_overrides : dict, optional
+        extra donuts config values
+    mock_kwargs : dict
+        extra MockVoyager arguments
+
+    Returns
+    -------
+    result : object
+        whatever script returns
+    """
+    async def session():
+        mock = MockVoyager({DATA_ROOT_HOST: str(tmp_path / "data")},
+                           guide_directions=GUIDE_DIRECTIONS,
+                           pixels_to_time=PIXELS_TO_TIME, **mock_kwargs)
+        await mock.start()
+        config = make_config(tmp_path, mock.port, **(config_overrides or {}))
+        voyager = voyager_donuts.Voyager(config)
+        voyager_donuts.EXIT_EVENT.clear()
+        donuts_thread = threading.Thread(target=voyager.run, daemon=True)
+        donuts_thread.start()
+        try:
+            await mock.wait_for_client()
+            # let the mount handshake finish before scripting anything
+            t0 = time.monotonic()
+            while not any(c['method'] == "RemoteMountStatusGetInfo" for c in mock.commands):
+                assert time.monotonic() - t0 < 10, "No mount handshake"
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.1)
+            return await script(mock)
+        finally:
+            voyager_donuts.EXIT_EVENT.set()
+            await asyncio.get_running_loop().run_in_executor(None, donuts_thread.join, 10)
+            await mock.stop()
+            voyager_donuts.EXIT_EVENT.clear()
+    return asyncio.run(session())
+
+def run_client(tmp_path, script, **mock_kwargs):
+    """
+    Start the mock server and a bare VoyagerClient, run the
+    scripted coroutine against them and shut everything down
+
+    Parameters
+    ----------
+    tmp_path : Path
+        scratch directory for data
+    script : coroutine function
+        called with the running MockVoyager, the client and a
+        list the client callbacks append event names etc to in order
+    mock_kwargs : dict
+        extra MockVoyager arguments
+
+    Returns
+    -------
+    result : object
+        whatever script returns
+    """
+    async def session():
+        mock = MockVoyager({DATA_ROOT_HOST: str(tmp_path)}, poll_interval=60, **mock_kwargs)
+        await mock.start()
+        timeline = []
+        client = VoyagerClient("127.0.0.1", mock.port, "TEST",
+                               on_message=lambda rec: timeline.append(rec['Event']))
+        await asyncio.get_running_loop().run_in_executor(None, client.start, 5)
+        try:
+            return await script(mock, client, timeline)
+        finally:
+            client.stop()
+            await mock.stop()
+    return asyncio.run(session())
+
+def command(method, uid, idd, **params):
+    """
+    Minimal two way command for the client
+    """
+    return {"method": method, "params": {"UID": uid, **params}, "id": idd}
+
+async def recenter_n(mock, n_frames):
+    """
+    Time n recenter requests
+    """
+    results = []
+    for _ in range(n_frames):
+        results.append(await mock.recenter())
+    return results
+
+def test_recenter_loop_keeps_field_centred(tmp_path, fake_db):
+    """
+    The field drifts between frames and donuts pulls it
+    back, every request is answered promptly
+    """
+    refs, shifts, timings = fake_db
+    async def script(mock):
+        results = await recenter_n(mock, 8)
+        return results, list(mock.offset)
+    results, offset = run_session(tmp_path, script, drift=(1.0, -1.0))
+    assert all(result == "DonutsRecenterDone" for result, _ in results)
+    # the reference was taken at (1, -1), uncorrected we would be at (8, -8)
+    assert abs(offset[0] - 1) < 1 and abs(offset[1] + 1) < 1
+    assert all(elapsed < 5 for _, elapsed in results)
+    assert len(refs) == 1
+    # first frame becomes the reference, the rest are measured
+    assert len(shifts) == 7
+    # every frame is timed, the reference frame is not measured
+    assert len(timings) == 8
+    assert timings[0][3]['ref_store'] > 0 and timings[0][3]['measure_shift'] == 0
+    assert all(timing[3]['measure_shift'] > 0 for timing in timings[1:])
+    assert all(timing[2] >= sum(timing[3].values()) for timing in timings)
+
+def test_prefetch_on_new_fit_ready(tmp_path, fake_db):
+    """
+    Frames announced with NewFITReady are measured before the
+    recenter request, which then only has to pulse guide
+    """
+    _, shifts, timings = fake_db
+    async def script(mock):
+        results = await recenter_n(mock, 6)
+        return results, list(mock.offset)
+    results, offset = run_session(tmp_path, script, config_overrides={"prefetch_frames": True},
+                                  drift=(1.0, -1.0), announce=0.3)
+    assert all(result == "DonutsRecenterDone" for result, _ in results)
+    assert abs(offset[0] - 1) < 1 and abs(offset[1] + 1) < 1
+    assert len(shifts) == 5
+    # only the reference frame is loaded after the recenter request
+    assert timings[0][3]['header'] > 0
+    assert all(timing[3]['measure_shift'] == 0 and timing[3]['ready'] == 0 for timing in timings[1:])
+
+def test_low_quality_shifts_skipped(tmp_path, fake_db):
+    """
+    Shifts with a weak correlation peak are logged but not corrected
+    """
+    _, shifts, _ = fake_db
+    async def script(mock):
+        results = await recenter_n(mock, 4)
+        assert not any(c['method'] == "RemotePulseGuide" for c in mock.commands)
+        return results, list(mock.offset)
+    # an impossible threshold culls everything
+    results, offset = run_session(tmp_path, script, config_overrides={"min_shift_quality": 1e6},
+                                  drift=(1.0, -1.0))
+    assert all(result == "DonutsRecenterDone" for result, _ in results)
+    assert abs(offset[0] - 4) < 0.5 and abs(offset[1] + 4) < 0.5
+    assert len(shifts) == 3
+    # quality is recorded, the culled_quality flag is set
+    assert all(shift[15] > 0 and shift[16] == 1 for shift in shifts)
+
+def test_sidecar_for_copied_reference(tmp_path, fake_db, monkeypatch):
+    """
+    A new reference copied across filesystems gets a sidecar
+    tied to the archived copy, which loads after a restart
+    """
+    refs, _, _ = fake_db
+    def no_hardlinks(src, dst):
+        raise OSError(errno.EXDEV, "Invalid cross-device link", src, dst)
+    monkeypatch.setattr(os, "link", no_hardlinks)
+    results = run_session(tmp_path, lambda mock: recenter_n(mock, 2), drift=(1.0, -1.0))
+    assert all(result == "DonutsRecenterDone" for result, _ in results)
+    ref_path, = refs.values()
+    assert ref_path.startswith(str(tmp_path / "reference"))
+    assert os.path.exists(f"{ref_path}{SIDECAR_SUFFIX}")
+    # as the next donuts session would build it
+    restarted = PreloadedDonuts(ref_path, sidecar=f"{ref_path}{SIDECAR_SUFFIX}", subtract_bkg=False)
+    assert restarted.sidecar_loaded is True
+
+def test_failed_archive_leaves_no_sidecar(tmp_path, fake_db, monkeypatch):
+    """
+    A reference that could not be archived is not recorded
+    and leaves no orphaned sidecar in the reference folder
+    """
+    refs, _, _ = fake_db
+    def fail(src, dst):
+        raise OSError(errno.ENOSPC, "No space left on device", src, dst)
+    monkeypatch.setattr(os, "link", fail)
+    monkeypatch.setattr(voyager_frame, "fcntl", None)
+    monkeypatch.setattr(voyager_frame.shutil, "copyfile", fail)
+    results = run_session(tmp_path, lambda mock: recenter_n(mock, 2), drift=(1.0, -1.0))
+    assert all(result == "DonutsRecenterDone" for result, _ in results)
+    assert not refs
+    assert not os.listdir(tmp_path / "reference")
+
+def test_reference_cache_filter_cycling(tmp_path, fake_db, monkeypatch):
+    """
+    Cycling back to a filter reuses its reference rather than building it again
+    """
+    refs, shifts, _ = fake_db
+    built = []
+    class CountingDonuts(PreloadedDonuts):
+        """
+        Count the references built
+        """
+        def __init__(self, refimage, **kwargs):
+            built.append(refimage)
+            super().__init__(refimage, **kwargs)
+    monkeypatch.setitem(voyager_donuts.SHIFT_ENGINES, "donuts", CountingDonuts)
+    async def script(mock):
+        results = []
+        for filt in ("R", "V") * 3:
+            mock.header_values["FILTER"] = filt
+            results.append(await mock.recenter())
+        return results
+    results = run_session(tmp_path, script, drift=(0.5, 0.5))
+    assert all(result == "DonutsRecenterDone" for result, _ in results)
+    assert len(refs) == 2 and len(built) == 2
+    assert len(shifts) == 4
+
+def test_event_delivered_while_command_in_flight(tmp_path):
+    """
+    Events that arrive while a command is waiting for its
+    RemoteActionResult reach on_message straight away
+    """
+    async def script(mock, client, timeline):
+        future = client.submit(command("RemoteMountStatusGetInfo", "uid-1", 1), 4)
+        future.add_done_callback(lambda _: timeline.append("done"))
+        await mock.wait_for_held(1)
+        await mock.send_event("ControlData", MNTPIER="pierEast", MNTSLEW=False)
+        t0 = time.monotonic()
+        while "ControlData" not in timeline:
+            assert time.monotonic() - t0 < 5, "Event not delivered"
+            await asyncio.sleep(0.01)
+        assert not future.done() and client.n_pending == 1
+        mock.release("uid-1", param_ret={"FlipStatus": 0})
+        payload = await asyncio.wrap_future(future)
+        return payload, timeline
+    payload, timeline = run_client(tmp_path, script, hold=["RemoteMountStatusGetInfo"])
+    assert payload == {"FlipStatus": 0}
+    assert timeline.index("ControlData") < timeline.index("done")
+
+def test_commands_completing_out_of_order(tmp_path):
+    """
+    Several commands in flight at once each resolve to their
+    own result, whatever order Voyager finishes them in
+    """
+    async def script(mock, client, timeline):
+        futures = {}
+        for idd in range(1, 5):
+            uid = f"uid-{idd}"
+            futures[uid] = client.submit(command("RemoteMountStatusGetInfo", uid, idd), 4)
+            futures[uid].add_done_callback(lambda _, uid=uid: timeline.append(uid))
+        assert await mock.wait_for_held(4) == list(futures)
+        assert client.n_pending == 4
+        # finish them backwards, the second one fails
+        for uid in reversed(list(futures)):
+            if uid == "uid-2":
+                mock.release(uid, result=5)
+            else:
+                mock.release(uid, param_ret={"FlipStatus": int(uid[-1])})
+            await asyncio.sleep(0.05)
+        results = {}
+        for uid, future in futures.items():
+            try:
+                results[uid] = await asyncio.wrap_future(future)
+            except VoyagerCommandError as error:
+                results[uid] = error
+        return results, timeline, client.n_pending
+    results, timeline, n_pending = run_client(tmp_path, script, hold=["RemoteMountStatusGetInfo"])
+    assert [what for what in timeline if what.startswith("uid")] == ["uid-4", "uid-3", "uid-2", "uid-1"]
+    assert results["uid-1"] == {"FlipStatus": 1}
+    assert isinstance(results["uid-2"], VoyagerCommandError) and "uid-2" in str(results["uid-2"])
+    assert results["uid-3"] == {"FlipStatus": 3}
+    assert results["uid-4"] == {"FlipStatus": 4}
+    assert n_pending == 0
+
+def test_recenter_with_latency_and_coalescing(tmp_path, fake_db):
+    """
+    Slow, jittery, coalesced and fragmented responses
+    still complete every recenter
+    """
+    results = run_session(tmp_path, lambda mock: recenter_n(mock, 4),
+                          drift=(2.0, 2.0), latency=0.02, jitter=0.01,
+                          coalesce=0.01, fragment=7, poll_interval=0.05)
+    assert all(result == "DonutsRecenterDone" for result, _ in results)
+
+def test_parallel_pulse_guide(tmp_path, fake_db):
+    """
+    X and Y corrections run at the same time
+    """
+    async def script(mock):
+        results = await recenter_n(mock, 5)
+        return results, list(mock.offset), mock.max_n_pulsing, mock.aborted
+    results, offset, max_n_pulsing, aborted = run_session(
+        tmp_path, script, config_overrides={"parallel_pulse_guide": True}, drift=(1.0, -1.0))
+    assert all(result == "DonutsRecenterDone" for result, _ in results)
+    assert abs(offset[0] - 1) < 1 and abs(offset[1] + 1) < 1
+    assert max_n_pulsing == 2
+    assert not aborted
+
+def test_parallel_pulse_guide_overlap_rejected(tmp_path, fake_db):
+    """
+    When Voyager rejects the overlapping pulse it is retried
+    and the rest of the corrections are sent one at a time
+    """
+    async def script(mock):
+        results = await recenter_n(mock, 5)
+        pulses = [c for c in mock.commands if c['method'] == "RemotePulseGuide"]
+        return results, list(mock.offset), len(pulses), mock.max_n_pulsing, mock.aborted
+    results, offset, n_pulses, max_n_pulsing, aborted = run_session(
+        tmp_path, script, config_overrides={"parallel_pulse_guide": True},
+        drift=(1.0, -1.0), reject_overlap=True)
+    assert all(result == "DonutsRecenterDone" for result, _ in results)
+    assert abs(offset[0] - 1) < 1 and abs(offset[1] + 1) < 1
+    assert max_n_pulsing == 1
+    # 4 corrections of 2 pulses, plus the one rejected, which is also aborted
+    assert n_pulses == 9
+    assert len(aborted) == 1
+
+def test_parallel_pulse_guide_timeout_not_retried(tmp_path, fake_db):
+    """
+    A parallel pulse that times out is aborted and reported,
+    not retried, and the next correction is parallel again
+    """
+    async def script(mock):
+        first = await mock.recenter()
+        mock.hold.add("RemotePulseGuide")
+        second = await mock.recenter()
+        n_pulses = sum(1 for c in mock.commands if c['method'] == "RemotePulseGuide")
+        mock.hold.clear()
+        mock.max_n_pulsing = 0
+        third = await mock.recenter()
+        return first, second, third, n_pulses, mock.max_n_pulsing, mock.aborted
+    first, second, third, n_pulses, max_n_pulsing, aborted = run_session(
+        tmp_path, script, drift=(1.0, -1.0),
+        config_overrides={"parallel_pulse_guide": True,
+                          "command_timeouts": {"RemotePulseGuide": 0.5, "RemoteCameraShot": 10,
+                                               "RemoteMountStatusGetInfo": 5}})
+    assert first[0] == "DonutsRecenterDone"
+    assert second[0] == "DonutsRecenterError"
+    assert third[0] == "DonutsRecenterDone"
+    assert n_pulses == 2 and len(aborted) == 2
+    assert max_n_pulsing == 2
+
+def test_pulse_guide_never_completes(tmp_path, fake_db):
+    """
+    A PulseGuide that never finishes is aborted at its deadline,
+    reported to Voyager and donuts goes back to idle
+    """
+    async def script(mock):
+        first = await mock.recenter()
+        mock.hold.add("RemotePulseGuide")
+        second = await mock.recenter()
+        pulse = [c for c in mock.commands if c['method'] == "RemotePulseGuide"][0]
+        mock.hold.clear()
+        third = await mock.recenter()
+        return first, second, third, pulse, mock.aborted
+    first, second, third, pulse, aborted = run_session(
+        tmp_path, script, drift=(1.0, -1.0),
+        config_overrides={"command_timeouts": {"RemotePulseGuide": 0.5, "RemoteCameraShot": 10,
+                                               "RemoteMountStatusGetInfo": 5}})
+    assert first[0] == "DonutsRecenterDone"
+    # the deadline is the allowance plus the pulse itself
+    assert second[0] == "DonutsRecenterError"
+    assert 0.5 + pulse['params']['Duration'] / 1000. <= second[1] < 3
+    assert aborted == [pulse['params']['UID']]
+    # back to IDLE, the next request is handled rather than skipped as busy
+    assert third[0] == "DonutsRecenterDone"
+
+def test_failed_stabilisation_is_reported(tmp_path, fake_db):
+    """
+    Failing to stabilise is reported to Voyager without
+    stopping the guide thread, and stabilisation starts over
+    """
+    async def script(mock):
+        results = await recenter_n(mock, 6)
+        errors = [event.get('DonutsError', '') for event in mock.donuts_events
+                  if event['Event'] == "DonutsRecenterError"]
+        return results, errors
+    # the field runs away faster than the pulses bring it back
+    results, errors = run_session(tmp_path, script, drift=(-10.0, -10.0),
+                                  config_overrides={"n_images_to_stabilise": 1,
+                                                    "max_error_pixels": 5})
+    assert len(results) == 6
+    assert errors and all(error.startswith("Failed to stabilise guiding") for error in errors)
+    assert results[-1][0] == "DonutsRecenterDone"
+
+def test_failed_handshake_is_retried(tmp_path, fake_db, monkeypatch):
+    """
+    Recenter requests are refused until a failed mount
+    handshake has been retried successfully
+    """
+    monkeypatch.setattr(voyager_donuts, "HANDSHAKE_RETRY_INTERVAL", 0.5)
+    async def script(mock):
+        # the first handshake times out
+        await mock.wait_for_held(1)
+        first = await mock.recenter()
+        error = mock.donuts_events[-1].get('DonutsError', '')
+        mock.hold.clear()
+        n_handshakes = sum(1 for c in mock.commands if c['method'] == "RemoteMountStatusGetInfo")
+        t0 = time.monotonic()
+        while sum(1 for c in mock.commands if c['method'] == "RemoteMountStatusGetInfo") <= n_handshakes:
+            assert time.monotonic() - t0 < 10, "Handshake not retried"
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(0.2)
+        second = await mock.recenter()
+        return first, error, second
+    first, error, second = run_session(
+        tmp_path, script, hold=["RemoteMountStatusGetInfo"],
+        config_overrides={"command_timeouts": {"RemotePulseGuide": 5, "RemoteCameraShot": 10,
+                                               "RemoteMountStatusGetInfo": 0.3}})
+    assert first[0] == "DonutsRecenterError"
+    assert "handshake" in error
+    assert second[0] == "DonutsRecenterDone"
+
+def test_unknown_flip_status_on_reconnect(tmp_path, fake_db, monkeypatch):
+    """
+    A reconnect handshake that gets FlipStatus 5 stays pending,
+    recenters are refused and it is retried until it works
+    """
+    monkeypatch.setattr(voyager_donuts, "HANDSHAKE_RETRY_INTERVAL", 0.5)
+    def n_handshakes(mock):
+        return sum(1 for c in mock.commands if c['method'] == "RemoteMountStatusGetInfo")
+    async def script(mock):
+        first = await mock.recenter()
+        mock.flip_status = 5
+        n_before = n_handshakes(mock)
+        await mock.disconnect()
+        await mock.wait_for_client(timeout=10)
+        t0 = time.monotonic()
+        while n_handshakes(mock) <= n_before:
+            assert time.monotonic() - t0 < 10, "No handshake on reconnect"
+            await asyncio.sleep(0.02)
+        await asyncio.sleep(0.1)
+        refused = await mock.recenter()
+        error = mock.donuts_events[-1].get('DonutsError', '')
+        n_failed = n_handshakes(mock)
+        mock.flip_status = 4
+        t0 = time.monotonic()
+        while n_handshakes(mock) <= n_failed:
+            assert time.monotonic() - t0 < 10, "Handshake not retried"
+            await asyncio.sleep(0.02)
+        await asyncio.sleep(0.2)
+        last = await mock.recenter()
+        return first, refused, error, last
+    first, refused, error, last = run_session(tmp_path, script, drift=(1.0, 1.0))
+    assert first[0] == "DonutsRecenterDone"
+    assert refused[0] == "DonutsRecenterError" and "handshake" in error
+    assert last[0] == "DonutsRecenterDone"
+
+def test_reconnect_after_server_drop(tmp_path, fake_db):
+    """
+    Donuts reconnects and carries on guiding after Voyager drops it
+    """
+    async def script(mock):
+        first = await mock.recenter()
+        await mock.disconnect()
+        await mock.wait_for_client(timeout=10)
+        await asyncio.sleep(0.2)
+        second = await mock.recenter()
+        return first, second
+    first, second = run_session(tmp_path, script, drift=(1.0, 1.0))
+    assert first[0] == "DonutsRecenterDone"
+    assert second[0] == "DonutsRecenterDone"
+
+def test_gem_flip_status_is_cached(tmp_path, fake_db):
+    """
+    A GEM only asks for its flip status at the handshake and
+    again when ControlData says the mount changed pier side
+    """
+    refs, _, _ = fake_db
+    async def script(mock):
+        await recenter_n(mock, 3)
+        n_before = sum(1 for c in mock.commands if c['method'] == "RemoteMountStatusGetInfo")
+        # meridian flip
+        mock.flip_status = 2
+        await mock.send_event("ControlData", MNTPIER="pierEast", MNTSLEW=False)
+        await mock.send_event("ControlData", MNTPIER="pierWest", MNTSLEW=False)
+        await asyncio.sleep(0.5)
+        results = await recenter_n(mock, 2)
+        n_after = sum(1 for c in mock.commands if c['method'] == "RemoteMountStatusGetInfo")
+        return n_before, n_after, results
+    gem_config = {"mount_type": "GEM",
+                  "pixels_to_time_east": PIXELS_TO_TIME, "pixels_to_time_west": PIXELS_TO_TIME,
+                  "guide_directions_east": GUIDE_DIRECTIONS, "guide_directions_west": GUIDE_DIRECTIONS}
+    n_before, n_after, results = run_session(tmp_path, script, config_overrides=gem_config,
+                                             drift=(1.0, -1.0), flip_status=0)
+    assert n_before == 1
+    assert n_after == 2
+    assert all(result == "DonutsRecenterDone" for result, _ in results)
+    # the flip means a new reference for the west side
+    assert len(refs) == 2
+
+def test_unknown_flip_status_mid_session(tmp_path, fake_db):
+    """
+    Voyager briefly not knowing the flip status fails that
+    recenter rather than stopping donuts
+    """
+    async def script(mock):
+        first = await recenter_n(mock, 2)
+        mock.flip_status = 5
+        await mock.send_event("ControlData", MNTPIER="pierEast", MNTSLEW=True)
+        await asyncio.sleep(0.2)
+        unknown = await mock.recenter()
+        mock.flip_status = 0
+        await mock.send_event("ControlData", MNTPIER="pierEast", MNTSLEW=True)
+        await asyncio.sleep(0.2)
+        last = await mock.recenter()
+        return first, unknown, last
+    gem_config = {"mount_type": "GEM",
+                  "pixels_to_time_east": PIXELS_TO_TIME, "pixels_to_time_west": PIXELS_TO_TIME,
+                  "guide_directions_east": GUIDE_DIRECTIONS, "guide_directions_west": GUIDE_DIRECTIONS}
+    first, unknown, last = run_session(tmp_path, script, config_overrides=gem_config,
+                                       drift=(1.0, -1.0), flip_status=0)
+    assert all(result == "DonutsRecenterDone" for result, _ in first)
+    assert unknown[0] == "DonutsRecenterError"
+    assert last[0] == "DonutsRecenterDone"
@@ -0,0 +1,132 @@
+"""
+The phase correlation shift engine agrees with donuts
+and can be selected for guiding, on whole or binned frames
+"""
+import os
+import sys
+import logging
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# pylint: disable=wrong-import-position
+import voyager_utils as vutils
+from voyager_shift import SHIFT_ENGINES, SoftwareBinned
+from voyager_frame import Frame, load_frame, SIDECAR_SUFFIX
+from bench_shift import make_frames, HEADER
+from mock_voyager import make_star_field, write_frame
+from test_mock_voyager import run_session, recenter_n, fake_db # pylint: disable=unused-import
+
+
+def test_engines_match_true_shifts(tmp_path):
+    """
+    Both engines recover known sub-pixel shifts, with and without a mask
+    """
+    ref_path, frames = make_frames(str(tmp_path), (256, 256), 4, 8., 40)
+    mask = np.zeros((256, 256), dtype=bool)
+    mask[:, 100] = True
+    for name in SHIFT_ENGINES:
+        for image_pixel_mask in (None, mask):
+            engine = SHIFT_ENGINES[name](load_frame(ref_path), subtract_bkg=True,
+                                         image_pixel_mask=image_pixel_mask)
+            for path, true_x, true_y in frames:
+                shift = engine.measure_shift(load_frame(path))
+                assert abs(shift.x.value - true_x) < 0.25, name
+                assert abs(shift.y.value - true_y) < 0.25, name
+                assert shift.quality > 3, name
+
+def test_blank_frame_quality(tmp_path):
+    """
+    A blank frame (e.g. dome closed) gives a finite zero quality
+    rather than nan, so it is culled by min_shift_quality
+    """
+    ref_path = str(tmp_path / "ref.fits")
+    write_frame(ref_path, make_star_field(), HEADER)
+    blank = Frame(str(tmp_path / "blank.fits"), np.full((256, 256), 1000, dtype=np.uint16), HEADER)
+    for name in ("phase", "tiled"):
+        shift = SHIFT_ENGINES[name](load_frame(ref_path), subtract_bkg=True).measure_shift(blank)
+        assert shift.quality == 0, name
+        assert np.isfinite(shift.x.value) and np.isfinite(shift.y.value), name
+
+def test_guide_with_phase_engine(tmp_path, fake_db):
+    """
+    Guiding with the phase correlation engine keeps the field centred
+    """
+    async def script(mock):
+        results = await recenter_n(mock, 5)
+        return results, list(mock.offset)
+    results, offset = run_session(tmp_path, script, config_overrides={"shift_engine": "phase"},
+                                  drift=(1.0, -1.0))
+    assert all(result == "DonutsRecenterDone" for result, _ in results)
+    assert abs(offset[0] - 1) < 1 and abs(offset[1] + 1) < 1
+
+def test_tiled_rejects_bad_tile(tmp_path, caplog):
+    """
+    A bright artefact that doesn't move with the stars is outvoted
+    """
+    shape = (384, 384)
+    ref = make_star_field(shape, n_stars=120)
+    check = make_star_field(shape, n_stars=120, offset=(2.4, -1.3))
+    # a hot blob in the top right tile, in the same place in both frames
+    yy, xx = np.mgrid[:shape[0], :shape[1]]
+    blob = 1e6 * np.exp(-((xx - 320)**2 + (yy - 320)**2) / 50.)
+    ref_path, check_path = str(tmp_path / "ref.fits"), str(tmp_path / "check.fits")
+    write_frame(ref_path, ref + blob, HEADER)
+    write_frame(check_path, check + blob, HEADER)
+
+    caplog.set_level(logging.INFO)
+    engine = SHIFT_ENGINES["tiled"](load_frame(ref_path), tiles=[3, 3])
+    shift = engine.measure_shift(load_frame(check_path))
+    assert abs(shift.x.value + 2.4) < 0.1 and abs(shift.y.value - 1.3) < 0.1
+    assert "rejected [8:" in caplog.text
+
+    # regions of interest, partly off the frame
+    engine = SHIFT_ENGINES["tiled"](load_frame(ref_path), regions=[[0, 0, 200, 200], [300, 300, 200, 200]])
+    assert len(engine.regions) == 2
+    assert engine.regions[1] == (slice(300, 384), slice(300, 384))
+
+def test_software_binning(tmp_path, fake_db):
+    """
+    Binned and cropped frames give shifts in frame pixels
+    """
+    data = np.arange(7 * 5, dtype=np.uint16).reshape(7, 5)
+    assert np.array_equal(vutils.bin_image(data, 2, 3),
+                          data[:6, :4].reshape(2, 3, 2, 2).sum(axis=(1, 3)))
+
+    ref_path, frames = make_frames(str(tmp_path), (512, 512), 3, 8., 160)
+    mask = np.zeros((512, 512), dtype=bool)
+    mask[:, 200] = True
+    sidecar = ref_path + SIDECAR_SUFFIX
+    def crop_and_bin(path):
+        frame = load_frame(path)
+        return Frame(path, vutils.bin_image(frame.data[:, 50:450], 2, 2), frame.header)
+    binned_mask = vutils.bin_boolean_mask(mask[:, 50:450], 2, 2)
+    for name in SHIFT_ENGINES:
+        engine = SoftwareBinned(SHIFT_ENGINES[name], load_frame(ref_path), sidecar=sidecar,
+                                image_pixel_mask=mask, binning=2, crop=[50, 0, 400, 1000],
+                                subtract_bkg=True)
+        assert engine.image_pixel_mask.shape == (256, 200)
+        # same as measuring frames binned up front, in unbinned pixels
+        binned = SHIFT_ENGINES[name](crop_and_bin(ref_path), image_pixel_mask=binned_mask,
+                                     subtract_bkg=True)
+        for path, true_x, true_y in frames:
+            shift = engine.measure_shift(load_frame(path))
+            expected = binned.measure_shift(crop_and_bin(path))
+            assert shift.x.value == 2 * expected.x.value, name
+            assert shift.y.value == 2 * expected.y.value, name
+            # the synthetic stars are undersampled once binned, too few
+            # pixels across them for donuts' fit to be this accurate
+            if name == "phase":
+                assert abs(shift.x.value - true_x) < 0.1 and abs(shift.y.value - true_y) < 0.1
+    # the binned donuts reference has its own sidecar
+    assert os.path.exists(f"{ref_path}.sw2x2_crop50_0_400_512{SIDECAR_SUFFIX}")
+    assert not os.path.exists(sidecar)
+
+    async def script(mock):
+        results = await recenter_n(mock, 5)
+        return results, list(mock.offset)
+    # the mock's frames are too small for donuts once binned
+    (tmp_path / "session").mkdir()
+    results, offset = run_session(tmp_path / "session", script,
+                                  config_overrides={"software_binning": [2, 2], "shift_engine": "phase"},
+                                  drift=(1.0, -1.0))
+    assert all(result == "DonutsRecenterDone" for result, _ in results)
+    assert abs(offset[0] - 1) < 1 and abs(offset[1] + 1) < 1
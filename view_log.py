@@ -22,6 +22,9 @@ def arg_parse():
     p.add_argument("--last",
                    help="view last X entries instead of supplying times",
                    type=int)
+    p.add_argument("--timing",
+                   help="view per frame stage timing instead of the shifts",
+                   action="store_true")
     return p.parse_args()
 
 @contextmanager
@@ -42,20 +45,21 @@ def db_cursor(host='127.0.0.1', port=3306, user='donuts',
 
 if __name__ == "__main__":
     args = arg_parse()
+    table = "autoguider_timing" if args.timing else "autoguider_log"
 
     if args.last:
-        qry = """
+        qry = f"""
             SELECT *
-            FROM autoguider_log
+            FROM {table}
             ORDER BY updated DESC
             LIMIT %s
             """
         qry_args = (args.last, )
 
     elif args.t1 and args.t2:
-        qry = """
+        qry = f"""
             SELECT *
-            FROM autoguider_log
+            FROM {table}
             WHERE updated > %s AND updated < %s
             ORDER BY updated DESC
             """
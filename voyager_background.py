@@ -0,0 +1,296 @@
+"""
+Mesh sky background estimation for the shift engines
+
+The frame is divided into a mesh of boxes. The sky in each box
+is the sigma clipped median of a fixed grid of sample pixels,
+the coarse mesh is median filtered to remove boxes swamped by
+bright stars, then bilinearly interpolated back to full size
+and subtracted from the frame in place, a strip at a time.
+
+Everything that depends only on the frame shape (box edges,
+sample indices, interpolation weights) is worked out once per
+shape and cached, frames of one configuration (size, subframe
+and binning) then only pay for the statistics and subtraction
+"""
+import numpy as np
+from scipy.ndimage import median_filter, distance_transform_edt
+
+class MeshGeometry():
+    """
+    Sampling and interpolation indices for one frame shape
+    """
+    def __init__(self, shape, mesh_size, samples):
+        """
+        Parameters
+        ----------
+        shape : tuple
+            (ny, nx) of the frames
+        mesh_size : int
+            box size in pixels, boxes at the far edges
+            take up any remainder
+        samples : int
+            most sample pixels per box along each axis
+        """
+        self.shape = shape
+        ny, nx = shape
+        y_edges = self.__edges(ny, mesh_size)
+        x_edges = self.__edges(nx, mesh_size)
+        self.mesh_shape = (len(y_edges) - 1, len(x_edges) - 1)
+        # (n boxes, samples) pixel indices per axis, evenly spread through each box
+        self.sample_rows = self.__samples(y_edges, samples)
+        self.sample_cols = self.__samples(x_edges, samples)
+        # lower mesh node and weight of the upper one for every row/column
+        self.row_nodes, self.row_weights = self.__interpolation(y_edges)
+        self.col_nodes, self.col_weights = self.__interpolation(x_edges)
+        # runs of rows between the same pair of mesh rows, as (start, stop, node)
+        starts = np.flatnonzero(np.diff(self.row_nodes, prepend=-1))
+        stops = np.append(starts[1:], ny)
+        self.row_segments = [(int(start), int(stop), int(self.row_nodes[start]))
+                             for start, stop in zip(starts, stops)]
+
+    @staticmethod
+    def __edges(n_pixels, mesh_size):
+        """
+        Box edges along one axis, at least one box
+        """
+        n_boxes = max(n_pixels // mesh_size, 1)
+        edges = np.arange(n_boxes + 1) * mesh_size
+        edges[-1] = n_pixels
+        return edges
+
+    @staticmethod
+    def __samples(edges, samples):
+        """
+        Sample pixel indices for each box along one axis
+        """
+        n_samples = min(samples, int(np.diff(edges).min()))
+        fraction = (np.arange(n_samples) + 0.5) / n_samples
+        return (edges[:-1, None] + fraction[None, :] * np.diff(edges)[:, None]).astype(np.intp)
+
+    @staticmethod
+    def __interpolation(edges):
+        """
+        Linear interpolation between box centres along one
+        axis, constant beyond the outermost centres
+        """
+        centres = (edges[:-1] + edges[1:] - 1) / 2
+        pixels = np.arange(edges[-1])
+        if len(centres) == 1:
+            return np.zeros(len(pixels), dtype=np.intp), np.zeros(len(pixels), dtype=np.float32)
+        nodes = np.clip(np.searchsorted(centres, pixels, side='right') - 1, 0, len(centres) - 2)
+        weights = np.clip((pixels - centres[nodes]) / np.diff(centres)[nodes], 0, 1)
+        return nodes.astype(np.intp), weights.astype(np.float32)
+
+class MeshBackground():
+    """
+    Sigma clipped mesh background, shared by every reference so
+    the geometry cache carries across reference changes
+    """
+    def __init__(self, mesh_size=64, n_sigma=3.0, iterations=3, samples=16,
+                 filter_size=3):
+        """
+        Parameters
+        ----------
+        mesh_size : int, optional
+            box size in pixels, a few times the star size
+            default = 64
+        n_sigma : float, optional
+            clip samples this many robust standard
+            deviations from the box median
+            default = 3
+        iterations : int, optional
+            rounds of clipping
+            default = 3
+        samples : int, optional
+            most sample pixels per box along each axis,
+            up to samples**2 per box
+            default = 16
+        filter_size : int, optional
+            median filter over the coarse mesh, 1 for none
+            default = 3
+        """
+        self.mesh_size = int(mesh_size)
+        if self.mesh_size < 2:
+            raise ValueError(f"Background mesh size must be at least 2 pixels, got {mesh_size}")
+        self.n_sigma = n_sigma
+        self.iterations = iterations
+        self.samples = samples
+        self.filter_size = filter_size
+        # MeshGeometry per frame shape. Shapes are set by the frame size,
+        # subframe and binning so there are only ever a handful
+        self._geometry = {}
+
+    def __repr__(self):
+        """
+        Settings that change the background, used in sidecar digests
+        """
+        return (f"MeshBackground(mesh_size={self.mesh_size}, n_sigma={self.n_sigma}, "
+                f"iterations={self.iterations}, samples={self.samples}, "
+                f"filter_size={self.filter_size})")
+
+    def geometry(self, shape):
+        """
+        Cached geometry for frames of a given shape
+
+        Parameters
+        ----------
+        shape : tuple
+            (ny, nx) of the frames
+
+        Returns
+        -------
+        geometry : MeshGeometry
+            sampling and interpolation indices
+
+        Raises
+        ------
+        None
+        """
+        shape = tuple(shape)
+        geometry = self._geometry.get(shape)
+        if geometry is None:
+            # two threads may both build it, either copy will do
+            geometry = MeshGeometry(shape, self.mesh_size, self.samples)
+            self._geometry[shape] = geometry
+        return geometry
+
+    def mesh(self, data, mask=None):
+        """
+        Measure the coarse background mesh
+
+        Parameters
+        ----------
+        data : array
+            image data
+        mask : array, optional
+            boolean mask of pixels to ignore
+            default = None
+
+        Returns
+        -------
+        mesh : array
+            float32 sky level per box
+
+        Raises
+        ------
+        None
+        """
+        geometry = self.geometry(data.shape)
+        rows = geometry.sample_rows[:, :, None, None]
+        cols = geometry.sample_cols[None, None, :, :]
+        n_y, n_x = geometry.mesh_shape
+        # (boxes, samples) of just the sample pixels, masked ones set to nan
+        values = np.asarray(data[rows, cols], dtype=np.float32)
+        values = values.transpose(0, 2, 1, 3).reshape(n_y * n_x, -1)
+        if mask is not None and mask is not np.ma.nomask:
+            masked = np.asarray(mask, dtype=bool)[rows, cols]
+            values[masked.transpose(0, 2, 1, 3).reshape(n_y * n_x, -1)] = np.nan
+
+        # sort each box once, nans go to the end. Clipping about the median
+        # always keeps a contiguous run of sorted values, so each round of
+        # clipping only moves the [low, high) ends of the run in every box
+        values.sort(axis=1)
+        low = np.zeros(len(values), dtype=np.intp)
+        high = np.isfinite(values).sum(axis=1)
+        for _ in range(self.iterations):
+            median, sigma = self.__run_statistics(values, low, high)
+            new_low = np.sum(values < median - self.n_sigma * sigma, axis=1)
+            new_high = np.sum(values <= median + self.n_sigma * sigma, axis=1)
+            new_low, new_high = np.maximum(new_low, low), np.minimum(new_high, high)
+            if np.array_equal(new_low, low) and np.array_equal(new_high, high):
+                break
+            low, high = new_low, new_high
+        median, _ = self.__run_statistics(values, low, high)
+        mesh = median[:, 0].reshape(n_y, n_x)
+
+        # boxes with nothing left to measure (e.g. masked) copy the nearest one that has
+        empty = ~np.isfinite(mesh)
+        if empty.all():
+            mesh[:] = 0
+        elif empty.any():
+            nearest = distance_transform_edt(empty, return_distances=False, return_indices=True)
+            mesh = mesh[tuple(nearest)]
+        if self.filter_size > 1 and min(mesh.shape) >= self.filter_size:
+            mesh = median_filter(mesh, size=self.filter_size, mode='nearest')
+        return mesh.astype(np.float32)
+
+    @staticmethod
+    def __run_statistics(values, low, high):
+        """
+        Median and robust standard deviation of the sorted
+        values[low:high] of every box
+
+        Parameters
+        ----------
+        values : array
+            (boxes, samples) sorted sample values
+        low, high : array
+            first and one past the last sample kept per box
+
+        Returns
+        -------
+        median, sigma : array
+            (boxes, 1) statistics, nan for boxes with no samples left
+
+        Raises
+        ------
+        None
+        """
+        count = high - low
+        last = values.shape[1] - 1
+
+        def percentile(fraction):
+            position = low + fraction * np.maximum(count - 1, 0)
+            below = np.clip(np.floor(position).astype(np.intp), 0, last)
+            above = np.clip(below + 1, 0, last)
+            weight = (position - below)[:, None]
+            lower = np.take_along_axis(values, below[:, None], axis=1)
+            upper = np.take_along_axis(values, above[:, None], axis=1)
+            return np.where(weight > 0, lower + weight * (upper - lower), lower)
+        median = percentile(0.5)
+        # half the 16-84 percentile range is sigma for gaussian noise
+        sigma = (percentile(0.8413) - percentile(0.1587)) / 2
+        median[count == 0] = np.nan
+        return median, sigma
+
+    def subtract(self, data, mask=None):
+        """
+        Subtract the background from an image in place
+
+        Parameters
+        ----------
+        data : array
+            float32 image, modified in place
+        mask : array, optional
+            boolean mask of pixels to ignore when
+            measuring the background
+            default = None
+
+        Returns
+        -------
+        data : array
+            the same array, background subtracted
+
+        Raises
+        ------
+        TypeError : When data is not a writeable floating point array
+        """
+        if not np.issubdtype(data.dtype, np.floating) or not data.flags.writeable:
+            raise TypeError("Background is subtracted in place, data must be a writeable float array")
+        geometry = self.geometry(data.shape)
+        mesh = self.mesh(data, mask)
+        # interpolate across columns once, then down the rows between each
+        # pair of mesh rows, so no full frame background is ever held in memory
+        nodes, weights = geometry.col_nodes, geometry.col_weights
+        upper = np.minimum(nodes + 1, mesh.shape[1] - 1)
+        mesh_cols = mesh[:, nodes] * (1 - weights) + mesh[:, upper] * weights
+        strip = np.empty((max(stop - start for start, stop, _ in geometry.row_segments),
+                          data.shape[1]), dtype=np.float32)
+        for start, stop, node in geometry.row_segments:
+            lower_row = mesh_cols[node]
+            step = mesh_cols[min(node + 1, mesh.shape[0] - 1)] - lower_row
+            background = strip[:stop - start]
+            np.multiply(geometry.row_weights[start:stop, None], step, out=background)
+            background += lower_row
+            data[start:stop] -= background
+        return data
@@ -0,0 +1,574 @@
+"""
+Record and replay the Voyager wire protocol
+
+A capture is a gzipped stream of records, each a small
+header (kind, wall clock time, length) followed by the
+payload. Kinds are:
+
+   R : raw bytes read from Voyager, as returned by each read
+   T : bytes written to Voyager
+   C : a new connection was made
+   F : container path of a FITS frame donuts was asked to use
+
+Replaying a capture runs a real Voyager instance against a
+local server that plays back the recorded stream as fast as
+donuts can consume it. Each DonutsRecenterRequired waits for
+donuts to reply before the stream continues. Responses to
+donuts' own commands are generated live, because command IDs
+and UIDs differ from run to run, using the recorded payloads
+(e.g. FlipStatus) in order. Reads are replayed with their
+original grouping so message bursts are reproduced
+
+Run a replay with e.g.:
+
+   python voyager_capture.py config.toml night.vcap.gz --data-dir /data/2024-01-01
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import zlib
+import struct
+import shutil
+import asyncio
+import logging
+import tempfile
+import threading
+import argparse as ap
+from collections import defaultdict
+from voyager_client import LineFramer
+import voyager_utils as vutils
+
+# pylint: disable=logging-fstring-interpolation
+# pylint: disable=too-many-instance-attributes
+# pylint: disable=broad-except
+# pylint: disable=invalid-name
+
+RX = b'R'
+TX = b'T'
+CONNECT = b'C'
+FITS = b'F'
+
+# kind, wall clock time, payload length
+_RECORD_HEADER = struct.Struct('<cdI')
+
+# events that need donuts to reply before the replay carries on
+_BLOCKING_EVENTS = {"DonutsRecenterRequired": ("DonutsRecenterDone", "DonutsRecenterError")}
+
+# events we never replay, they would stop donuts or need hardware
+_SKIPPED_EVENTS = ("DonutsAbort", "DonutsCalibrationRequired")
+
+class CaptureWriter():
+    """
+    Write a protocol capture file. Safe to call
+    from the client's event loop and the main thread
+    """
+    def __init__(self, path):
+        """
+        Open the capture file
+
+        Parameters
+        ----------
+        path : string
+            where to write the capture
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = gzip.open(path, 'wb')
+
+    def record(self, kind, data):
+        """
+        Add a record to the capture
+
+        Parameters
+        ----------
+        kind : bytes
+            one of RX, TX, CONNECT or FITS
+        data : bytes
+            payload of the record
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(_RECORD_HEADER.pack(kind, time.time(), len(data)))
+            self._file.write(data)
+
+    def record_fits(self, path):
+        """
+        Note the container path of a frame we were asked to
+        guide on and flush, so a crash loses at most a frame
+        """
+        self.record(FITS, path.encode('utf-8'))
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        """
+        Finish the capture file
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+def read_capture(path):
+    """
+    Read every record from a capture file. A capture cut short
+    by a crash is read up to the last complete record
+
+    Parameters
+    ----------
+    path : string
+        capture file to read
+
+    Returns
+    -------
+    records : list of tuple
+        (kind, timestamp, payload) for each record
+
+    Raises
+    ------
+    None
+    """
+    with gzip.open(path, 'rb') as f:
+        try:
+            data = f.read()
+        except (EOFError, OSError):
+            logging.warning(f"Capture {path} is truncated, reading what we can")
+            data = _read_truncated(path)
+    records = []
+    offset = 0
+    while offset + _RECORD_HEADER.size <= len(data):
+        kind, timestamp, length = _RECORD_HEADER.unpack_from(data, offset)
+        offset += _RECORD_HEADER.size
+        if offset + length > len(data):
+            break
+        records.append((kind, timestamp, bytes(data[offset:offset+length])))
+        offset += length
+    return records
+
+def _read_truncated(path):
+    """
+    Decompress as much of a truncated gzip file as possible
+    """
+    # a streaming decompressor hands back everything up to the cut
+    decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    with open(path, 'rb') as f:
+        try:
+            return decompressor.decompress(f.read())
+        except zlib.error:
+            return b''
+
+
+class Capture():
+    """
+    A capture file broken down for replay
+    """
+    def __init__(self, records, delim=b'\r\n'):
+        """
+        Frame the recorded streams and work out which
+        incoming messages were responses to our commands
+
+        Parameters
+        ----------
+        records : list of tuple
+            (kind, timestamp, payload) from read_capture
+        delim : bytes, optional
+            Message delimiter used by Voyager
+            default = b'\\r\\n'
+        """
+        self.frames = []
+        # recorded ParamRet for each command method, in order
+        self.param_rets = defaultdict(list)
+        # (timestamp, [messages]) for each read from Voyager
+        self.reads = []
+        self.n_connections = 0
+
+        uid_methods = {}
+        idds = set()
+        rx_framer = LineFramer(delim)
+        tx_framer = LineFramer(delim)
+        for kind, timestamp, payload in records:
+            if kind == RX:
+                self.reads.append((timestamp, rx_framer.feed(payload)))
+            elif kind == TX:
+                for message in tx_framer.feed(payload):
+                    rec = _decode(message)
+                    if 'method' in rec:
+                        idds.add(rec['id'])
+                        uid_methods[rec['params'].get('UID')] = rec['method']
+            elif kind == CONNECT:
+                self.n_connections += 1
+                rx_framer.reset()
+                tx_framer.reset()
+            elif kind == FITS:
+                self.frames.append(payload.decode('utf-8'))
+
+        # drop the responses to our own commands, they are regenerated live
+        self.timeline = []
+        for timestamp, messages in self.reads:
+            kept = []
+            for message in messages:
+                rec = _decode(message)
+                if 'jsonrpc' in rec and rec.get('id') in idds:
+                    continue
+                if rec.get('Event') == "RemoteActionResult" and rec.get('UID') in uid_methods:
+                    self.param_rets[uid_methods[rec['UID']]].append(rec.get('ParamRet', {}))
+                    continue
+                if rec.get('Event') in _SKIPPED_EVENTS:
+                    logging.warning(f"REPLAY: skipping {rec['Event']}")
+                    continue
+                kept.append((message, rec))
+            if kept:
+                self.timeline.append((timestamp, kept))
+
+    @property
+    def duration(self):
+        """
+        Seconds between the first and last recorded read
+        """
+        if not self.reads:
+            return 0.
+        return self.reads[-1][0] - self.reads[0][0]
+
+def _decode(message):
+    """
+    Decode a message, returning {} if it is not valid JSON
+    """
+    try:
+        return json.loads(message)
+    except json.decoder.JSONDecodeError:
+        return {}
+
+class ReplayServer():
+    """
+    Local server that plays a capture back to donuts
+    """
+    def __init__(self, capture, realtime=False, reply_timeout=60, delim=b'\r\n'):
+        """
+        Initialise the replay server
+
+        Parameters
+        ----------
+        capture : Capture
+            the capture to play back
+        realtime : boolean, optional
+            keep the recorded gaps between reads
+            default = False (as fast as donuts can go)
+        reply_timeout : float, optional
+            max seconds to wait for donuts to answer a blocking event
+            default = 60
+        delim : bytes, optional
+            Message delimiter used by Voyager
+            default = b'\\r\\n'
+        """
+        self.capture = capture
+        self.realtime = realtime
+        self.reply_timeout = reply_timeout
+        self.delim = delim
+        self.port = None
+        self.results = []
+        self.finished = None
+        self._server = None
+        self._replies = None
+        self._param_ret_index = defaultdict(int)
+
+    async def start(self):
+        """
+        Listen on a free local port
+        """
+        self.finished = asyncio.Event()
+        self._replies = asyncio.Queue()
+        self._server = await asyncio.start_server(self.__handle_client, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """
+        Stop listening
+        """
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def __handle_client(self, reader, writer):
+        """
+        Play the capture to the first donuts connection
+        """
+        listener = asyncio.ensure_future(self.__listen(reader, writer))
+        try:
+            await self.__play(writer)
+        finally:
+            self.finished.set()
+            listener.cancel()
+            writer.close()
+
+    async def __play(self, writer):
+        """
+        Write each recorded read, waiting for donuts
+        where Voyager would have done
+        """
+        last_timestamp = None
+        for timestamp, kept in self.capture.timeline:
+            if self.realtime and last_timestamp is not None:
+                await asyncio.sleep(max(timestamp - last_timestamp, 0))
+            last_timestamp = timestamp
+            writer.write(b''.join(message + self.delim for message, _ in kept))
+            await writer.drain()
+            for _, rec in kept:
+                if rec.get('Event') in _BLOCKING_EVENTS:
+                    await self.__wait_for_reply(rec)
+
+    async def __wait_for_reply(self, rec):
+        """
+        Wait for donuts to finish handling a blocking event
+        """
+        expected = _BLOCKING_EVENTS[rec['Event']]
+        t0 = time.monotonic()
+        try:
+            while True:
+                reply = await asyncio.wait_for(self._replies.get(), self.reply_timeout)
+                if reply['Event'] in expected:
+                    break
+        except asyncio.TimeoutError:
+            reply = {"Event": "Timeout"}
+        self.results.append((rec['Event'], reply['Event'], time.monotonic() - t0))
+
+    async def __listen(self, reader, writer):
+        """
+        Answer donuts' commands and pass on its replies
+        """
+        framer = LineFramer(self.delim)
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            for message in framer.feed(data):
+                rec = _decode(message)
+                if 'method' in rec:
+                    await self.__answer(writer, rec)
+                elif rec.get('Event', '').startswith("Donuts"):
+                    self._replies.put_nowait(rec)
+
+    async def __answer(self, writer, rec):
+        """
+        Ack a command and complete it straight away with
+        the next recorded ParamRet for its method
+        """
+        method = rec['method']
+        recorded = self.capture.param_rets[method]
+        if recorded:
+            param_ret = recorded[self._param_ret_index[method] % len(recorded)]
+            self._param_ret_index[method] += 1
+        elif method == "RemoteMountStatusGetInfo":
+            param_ret = {"FlipStatus": 4}
+        else:
+            param_ret = {}
+        ack = {"jsonrpc": "2.0", "result": 0, "id": rec['id']}
+        result = {"Event": "RemoteActionResult", "Timestamp": time.time(), "Host": "REPLAY",
+                  "Inst": 1, "UID": rec['params']['UID'], "ActionResultInt": 4,
+                  "Motivo": "", "ParamRet": param_ret}
+        writer.write(json.dumps(ack).encode('utf-8') + self.delim +
+                     json.dumps(result).encode('utf-8') + self.delim)
+        await writer.drain()
+
+def stage_frames(capture, data_root, data_dir=None):
+    """
+    Make the recorded frames visible where donuts will look
+    for them tonight. Donuts resolves frames to
+    data_root/tonight/filename so link each one there
+
+    Parameters
+    ----------
+    capture : Capture
+        the capture being replayed
+    data_root : string
+        data_root for the replaying donuts instance
+    data_dir : string, optional
+        folder holding the night's frames, if they have
+        moved since the capture was recorded
+        default = None (use the recorded paths)
+
+    Returns
+    -------
+    n_missing : int
+        number of frames that could not be found
+
+    Raises
+    ------
+    None
+    """
+    night_dir = os.path.join(data_root, vutils.get_tonight())
+    os.makedirs(night_dir, exist_ok=True)
+    n_missing = 0
+    for frame in capture.frames:
+        filename = frame.split('/')[-1]
+        source = os.path.join(data_dir, filename) if data_dir is not None else frame
+        target = os.path.join(night_dir, filename)
+        if not os.path.exists(source):
+            logging.warning(f"REPLAY: cannot find {source}")
+            n_missing += 1
+            continue
+        if not os.path.lexists(target):
+            os.symlink(os.path.abspath(source), target)
+    return n_missing
+
+class MemoryDatabase():
+    """
+    In memory stand in for voyager_db so replays
+    never touch the observatory database
+    """
+    def __init__(self):
+        """
+        Start with no references and no logs
+        """
+        self.references = {}
+        self.shifts = []
+        self.timings = []
+
+    def get_reference_image_path(self, *args):
+        """
+        See voyager_db.get_reference_image_path
+        """
+        return self.references.get(args)
+
+    def set_reference_image(self, ref_image_path, *args):
+        """
+        See voyager_db.set_reference_image
+        """
+        self.references[args] = ref_image_path
+
+    def log_shifts_to_db(self, qry_args):
+        """
+        See voyager_db.log_shifts_to_db
+        """
+        self.shifts.append(qry_args)
+
+    def log_frame_timing_to_db(self, *args):
+        """
+        See voyager_db.log_frame_timing_to_db
+        """
+        self.timings.append(args)
+
+def replay(config, capture_path, data_dir=None, realtime=False, work_dir=None):
+    """
+    Replay a capture through a fresh Voyager instance
+
+    Parameters
+    ----------
+    config : dict
+        donuts configuration, as used to record the capture.
+        Connection and path settings are overridden
+    capture_path : string
+        capture file to replay
+    data_dir : string, optional
+        folder holding the night's frames if they have moved
+        default = None
+    realtime : boolean, optional
+        keep the recorded gaps between reads
+        default = False
+    work_dir : string, optional
+        scratch folder for references etc, a temporary
+        folder is used and removed if not given
+        default = None
+
+    Returns
+    -------
+    results : list of tuple
+        (event, reply, seconds) for each blocking event replayed
+    db : MemoryDatabase
+        everything donuts logged during the replay
+    elapsed : float
+        wall clock seconds the replay took
+
+    Raises
+    ------
+    None
+    """
+    # imported here so recording does not pull in the whole guider
+    import voyager_donuts # pylint: disable=import-outside-toplevel
+
+    capture = Capture(read_capture(capture_path))
+    logging.info(f"REPLAY: {len(capture.timeline)} reads, {len(capture.frames)} frames, "
+                 f"{capture.duration:.1f} s recorded over {capture.n_connections} connection(s)")
+
+    cleanup = work_dir is None
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix="donuts_replay_")
+
+    db = MemoryDatabase()
+    originals = {name: getattr(voyager_donuts.vdb, name) for name in vars(MemoryDatabase)
+                 if not name.startswith('_')}
+    for name in originals:
+        setattr(voyager_donuts.vdb, name, getattr(db, name))
+
+    async def session():
+        server = ReplayServer(capture, realtime=realtime)
+        await server.start()
+        replay_config = dict(config)
+        replay_config.update({"socket_ip": "127.0.0.1", "socket_port": server.port})
+        for key in ("data_root", "reference_root", "calibration_root"):
+            replay_config[key] = os.path.join(work_dir, key)
+            os.makedirs(replay_config[key], exist_ok=True)
+        replay_config.pop("capture_root", None)
+        stage_frames(capture, replay_config['data_root'], data_dir)
+
+        voyager = voyager_donuts.Voyager(replay_config)
+        voyager_donuts.EXIT_EVENT.clear()
+        donuts_thread = threading.Thread(target=voyager.run, daemon=True)
+        t0 = time.monotonic()
+        donuts_thread.start()
+        await server.finished.wait()
+        elapsed = time.monotonic() - t0
+        voyager_donuts.EXIT_EVENT.set()
+        await asyncio.get_running_loop().run_in_executor(None, donuts_thread.join, 10)
+        voyager_donuts.EXIT_EVENT.clear()
+        await server.stop()
+        return server.results, elapsed
+
+    try:
+        results, elapsed = asyncio.run(session())
+    finally:
+        for name, function in originals.items():
+            setattr(voyager_donuts.vdb, name, function)
+        if cleanup:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results, db, elapsed
+
+def arg_parse():
+    """
+    Parse the command line arguments
+    """
+    p = ap.ArgumentParser()
+    p.add_argument('config',
+                   help='path to the config file used when recording')
+    p.add_argument('capture',
+                   help='capture file to replay')
+    p.add_argument('--data-dir',
+                   help='folder holding the frames if they have moved since recording')
+    p.add_argument('--realtime', action='store_true',
+                   help='keep the recorded gaps between messages')
+    p.add_argument('--debug', action='store_true',
+                   help='show the donuts debug log')
+    return p.parse_args()
+
+if __name__ == "__main__":
+    args = arg_parse()
+    logging.basicConfig(stream=sys.stdout,
+                        level=logging.DEBUG if args.debug else logging.WARNING)
+    replay_results, replay_db, replay_elapsed = replay(vutils.load_config(args.config), args.capture,
+                                                       data_dir=args.data_dir,
+                                                       realtime=args.realtime)
+    for event, reply, seconds in replay_results:
+        print(f"{event} -> {reply} {seconds*1000:.1f} ms")
+    n_done = sum(1 for _, reply, _ in replay_results if reply == "DonutsRecenterDone")
+    print(f"replayed {len(replay_results)} recenters ({n_done} done) in {replay_elapsed:.2f} s, "
+          f"{len(replay_db.shifts)} shifts logged")
@@ -0,0 +1,1281 @@
+"""
+Asyncio transport for the Voyager JSON-RPC connection
+
+The event loop runs in a background thread and owns the
+socket. A reader task frames the incoming byte stream and
+hands each complete message to a callback the moment it
+arrives, a writer task drains the outbound queue and a
+keepalive timer stops Voyager from dropping the connection
+when we have nothing to say
+
+Two way commands are tracked in a table of commands in
+flight. Their jsonrpc responses and RemoteActionResult
+events resolve a future for the caller, everything else
+goes to the normal message callback
+
+If the connection drops the client reconnects with jittered
+exponential backoff. Commands in flight fail and a
+CONNECTED_EVENT message is passed to the callback after
+every (re)connection so the owner can redo any handshake
+"""
+import asyncio
+import random
+import threading
+from concurrent.futures import Future
+import logging
+import json
+import time
+
+# pylint: disable=logging-fstring-interpolation
+# pylint: disable=too-many-instance-attributes
+# pylint: disable=broad-except
+
+# passed to on_message each time a connection is made
+CONNECTED_EVENT = "ClientConnected"
+
+class VoyagerCommandError(Exception):
+    """
+    Raised when Voyager rejects or fails a two way command
+    """
+
+class VoyagerCommandRejected(VoyagerCommandError):
+    """
+    Raised when Voyager answers a two way command with an
+    error, either in the jsonrpc response or the RemoteActionResult
+    """
+
+class VoyagerCommandTimeout(VoyagerCommandError):
+    """
+    Raised when a two way command misses its deadline.
+    The command has been aborted with RemoteActionAbort
+    """
+    def __init__(self, method, uid, idd, timeout, stage):
+        """
+        Initialise the timeout error
+
+        Parameters
+        ----------
+        method : string
+            name of the command that timed out
+        uid : string
+            unique ID for this command
+        idd : int
+            unique ID for this command
+        timeout : float
+            deadline that was missed, in seconds
+        stage : string
+            response we were still waiting for,
+            jsonrpc or RemoteActionResult
+        """
+        self.method = method
+        self.uid = uid
+        self.idd = idd
+        self.timeout = timeout
+        self.stage = stage
+        super().__init__(f"{method} {uid}:{idd} timed out after {timeout:.1f} s waiting for {stage}")
+
+class Response():
+    """
+    Keep track of outstanding responses from Voyager
+    """
+    def __init__(self, uid, idd, ok_status, method=None):
+        """
+        Initialise response object
+
+        Parameters
+        ----------
+        uid : string
+            unique ID for this command
+        idd : int
+            unique ID for this command
+        ok_staus : int
+            command return value that we search for
+            to ensure everything went ok. Any other
+            value means there was an error
+        method : string, optional
+            name of the command, used for reporting
+            default = None
+        """
+        self.uid = uid
+        self.idd = idd
+        self.uid_recv = False
+        self.idd_recv = False
+        self.uid_status = None
+        self.idd_status = None
+        self.ok_status = ok_status
+        self.method = method
+        # ParamRet data from the RemoteActionResult
+        self.payload = None
+        # resolved once both responses are in, waited on by the caller
+        self.future = Future()
+        # timer handle for the command deadline, if any
+        self.timer = None
+
+    def uid_received(self, status, payload=None):
+        """
+        Update uuid response as received
+
+        Parameters
+        ----------
+        status : int
+            response code to command for given uid
+        payload : dict, optional
+            ParamRet data returned with the response
+            default = None
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        self.uid_recv = True
+        self.uid_status = status
+        self.payload = payload
+
+    def idd_received(self, status):
+        """
+        Update uuid response as received
+
+        Parameters
+        ----------
+        status : int
+            response code to command for given idd
+
+        Returns
+        -------
+
+        Raises
+        ------
+        None
+        """
+        self.idd_recv = True
+        self.idd_status = status
+
+    def all_ok(self):
+        """
+        Check if uid and idd are all ok
+        Return True if so and False if not
+
+        idd is left hardcoded to 0
+        uid code is supplied on init
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        all_ok : boolean
+            Did we get a good response for the command submitted?
+            True of False
+
+        Raises
+        ------
+        None
+        """
+        return self.uid_recv and self.idd_recv and \
+               self.uid_status == self.ok_status and self.idd_status == 0
+
+class LineFramer():
+    """
+    Incremental framer for Voyager's delimited message stream
+
+    Bytes are fed in as they are read from the socket. Partial
+    messages are held in a single bytearray between reads and
+    every complete message in the buffer is returned per feed,
+    so bursts of several messages in one read are never lost
+    """
+    def __init__(self, delim=b'\r\n', max_buffer=1048576):
+        """
+        Initialise the framer
+
+        Parameters
+        ----------
+        delim : bytes, optional
+            Message delimiter used by Voyager
+            default = b'\\r\\n'
+        max_buffer : int, optional
+            Max number of bytes to hold without seeing
+            a delimiter before giving up on the stream
+            default = 1048576
+        """
+        self.delim = delim
+        self.max_buffer = max_buffer
+        self._buffer = bytearray()
+        # where to resume searching for a delimiter, avoids rescanning partial data
+        self._scan_from = 0
+
+    @property
+    def pending(self):
+        """
+        Number of bytes held waiting for a delimiter
+        """
+        return len(self._buffer)
+
+    def feed(self, data):
+        """
+        Add newly read bytes and extract all complete messages
+
+        Parameters
+        ----------
+        data : bytes
+            raw bytes read from the socket, may be empty
+
+        Returns
+        -------
+        messages : list of bytes
+            complete messages with the delimiter removed.
+            Empty messages are skipped
+
+        Raises
+        ------
+        ValueError : When max_buffer bytes are held without a delimiter.
+            The buffer is reset before raising
+        """
+        buf = self._buffer
+        buf += data
+        messages = []
+        start = 0
+        delim_len = len(self.delim)
+        idx = buf.find(self.delim, self._scan_from)
+        while idx >= 0:
+            if idx > start:
+                messages.append(bytes(buf[start:idx]))
+            start = idx + delim_len
+            idx = buf.find(self.delim, start)
+        if start:
+            del buf[:start]
+        # a delimiter may be split across reads, so back up one short of its length
+        self._scan_from = max(len(buf) - delim_len + 1, 0)
+
+        if len(buf) > self.max_buffer:
+            self.reset()
+            raise ValueError(f"No delimiter found in {self.max_buffer} bytes")
+        return messages
+
+    def reset(self):
+        """
+        Throw away any partial message, e.g. after reconnecting
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        self._buffer.clear()
+        self._scan_from = 0
+
+class JsonCodec():
+    """
+    JSON encoding and decoding for the Voyager stream.
+    Uses orjson when it is installed, the standard
+    library json module otherwise
+    """
+    def __init__(self, backend=None):
+        """
+        Pick the JSON backend
+
+        Parameters
+        ----------
+        backend : string, optional
+            "orjson" or "json"
+            default = None (fastest available)
+
+        Raises
+        ------
+        ImportError : When the requested backend is not installed
+        ValueError : When the backend is not recognised
+        """
+        if backend is None:
+            try:
+                import orjson # pylint: disable=import-outside-toplevel,unused-import
+                backend = "orjson"
+            except ImportError:
+                backend = "json"
+        if backend == "orjson":
+            import orjson # pylint: disable=import-outside-toplevel
+            self.loads = orjson.loads
+            self.dumps = orjson.dumps
+        elif backend == "json":
+            self.loads = json.loads
+            self.dumps = self.__json_dumps
+        else:
+            raise ValueError(f"Unknown JSON backend {backend}")
+        self.backend = backend
+
+    @staticmethod
+    def __json_dumps(obj):
+        """
+        Standard library equivalent of orjson.dumps
+        """
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+class TemplateField():
+    """
+    Placeholder for a value spliced into a MessageTemplate
+    """
+    def __init__(self, name):
+        """
+        Parameters
+        ----------
+        name : string
+            keyword used to fill this field in MessageTemplate.render
+        """
+        self.name = name
+
+class MessageTemplate():
+    """
+    A message serialised once, with only the fields that
+    change from message to message filled in when sending
+    """
+    def __init__(self, template):
+        """
+        Serialise the fixed parts of a message
+
+        Parameters
+        ----------
+        template : dict
+            the message, with TemplateField placeholders
+            for the values that change
+        """
+        fields = []
+        def placeholder(obj):
+            if not isinstance(obj, TemplateField):
+                raise TypeError(f"Cannot serialise {obj!r}")
+            fields.append(obj.name)
+            return f"\x00{len(fields) - 1}\x00"
+        serialised = json.dumps(template, separators=(',', ':'), default=placeholder).encode('utf-8')
+        # the placeholders come out as quoted strings, swap each for a %s slot
+        serialised = serialised.replace(b'%', b'%%')
+        for i in range(len(fields)):
+            marker = json.dumps(f"\x00{i}\x00").encode('utf-8')
+            serialised = serialised.replace(marker, b'%s', 1)
+        self._format = serialised
+        self._fields = tuple(fields)
+
+    def render(self, **values):
+        """
+        Fill in the fields of the template
+
+        Parameters
+        ----------
+        values : dict
+            value for each TemplateField, by name
+
+        Returns
+        -------
+        message : bytes
+            the serialised message, without a delimiter
+
+        Raises
+        ------
+        KeyError : When a field is not given a value
+        """
+        encode = self.encode_value
+        return self._format % tuple([encode(values[name]) for name in self._fields])
+
+    @staticmethod
+    def encode_value(value):
+        """
+        Serialise a single value, with a fast path for
+        the ints and plain strings we send most often
+        """
+        value_type = type(value)
+        if value_type is int:
+            return b'%d' % value
+        if value_type is str and value.isascii() and value.isprintable() \
+            and '"' not in value and '\\' not in value:
+            return b'"%s"' % value.encode('ascii')
+        return json.dumps(value).encode('utf-8')
+
+class Command(dict):
+    """
+    A two way command. Reads like the plain message dict,
+    but carries the command already serialised so it
+    does not need encoding again when it is sent
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data, **message):
+        """
+        Parameters
+        ----------
+        data : bytes
+            the serialised command, without a delimiter
+        message : dict
+            the command's method, params (with UID) and id
+        """
+        super().__init__(**message)
+        self.data = data
+
+class KeepaliveStats():
+    """
+    How closely keepalives keep to their schedule, and
+    the longest Voyager went without hearing from us
+    """
+    def __init__(self):
+        """
+        Start with no keepalives sent
+        """
+        self.n_sent = 0
+        self.last_jitter = 0.
+        self.max_jitter = 0.
+        self.max_gap = 0.
+        self._sum_jitter = 0.
+
+    def record_keepalive(self, jitter):
+        """
+        Add a keepalive that was written jitter seconds
+        after it was due
+
+        Parameters
+        ----------
+        jitter : float
+            seconds between the deadline and the write
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        self.n_sent += 1
+        self.last_jitter = jitter
+        self.max_jitter = max(self.max_jitter, jitter)
+        self._sum_jitter += jitter
+
+    def record_gap(self, gap):
+        """
+        Add the time between two consecutive writes of any kind
+        """
+        self.max_gap = max(self.max_gap, gap)
+
+    @property
+    def mean_jitter(self):
+        """
+        Mean lateness of keepalives in seconds
+        """
+        return self._sum_jitter / self.n_sent if self.n_sent else 0.
+
+    def summary(self):
+        """
+        One line summary for the log
+        """
+        return (f"n={self.n_sent} jitter mean={self.mean_jitter*1000:.1f} "
+                f"max={self.max_jitter*1000:.1f} last={self.last_jitter*1000:.1f} ms "
+                f"longest gap={self.max_gap:.2f} s")
+
+class VoyagerClient():
+    """
+    Asyncio client for Voyager's application server
+    """
+    def __init__(self, socket_ip, socket_port, host, on_message,
+                 delim=b'\r\n', keepalive_interval=5, n_bytes=4096,
+                 reconnect_min_delay=1, reconnect_max_delay=60, capture=None,
+                 codec=None):
+        """
+        Initialise the client. Nothing happens on the
+        network until start() is called
+
+        Parameters
+        ----------
+        socket_ip : string
+            IP address of the Voyager application server
+        socket_port : int
+            Port of the Voyager application server
+        host : string
+            Host name reported to Voyager in our messages
+        on_message : callable
+            Called with each decoded message (dict). Note this
+            is called from the event loop thread
+        delim : bytes, optional
+            Message delimiter used by Voyager
+            default = b'\\r\\n'
+        keepalive_interval : float, optional
+            Send a Polling event if nothing has been sent
+            for this many seconds
+            default = 5
+        n_bytes : int, optional
+            Max number of bytes per socket read
+            default = 4096
+        reconnect_min_delay : float, optional
+            Backoff before the first reconnection attempt, seconds
+            default = 1
+        reconnect_max_delay : float, optional
+            Cap on the backoff between reconnection attempts, seconds
+            default = 60
+        capture : voyager_capture.CaptureWriter, optional
+            Record every byte read and written to this capture
+            default = None
+        codec : JsonCodec, optional
+            JSON encoder/decoder for the stream
+            default = None (JsonCodec with the fastest backend)
+        """
+        self.socket_ip = socket_ip
+        self.socket_port = socket_port
+        self.host = host
+        self.inst = 1
+        self.on_message = on_message
+        self.delim = delim
+        self.keepalive_interval = keepalive_interval
+        self.n_bytes = n_bytes
+        self.reconnect_min_delay = reconnect_min_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.capture = capture
+        self.codec = codec if codec is not None else JsonCodec()
+        # the keepalive and abort messages only change in a field or two
+        self._polling_template = MessageTemplate({"Event": "Polling",
+                                                  "Timestamp": TemplateField("Timestamp"),
+                                                  "Host": host,
+                                                  "Inst": self.inst})
+        self._abort_template = MessageTemplate({"method": "RemoteActionAbort",
+                                                "params": {"UID": TemplateField("UID")},
+                                                "id": TemplateField("id")})
+        self._framer = LineFramer(delim)
+
+        self._loop = None
+        self._thread = None
+        self._session = None
+        self._connected = threading.Event()
+        self._reader = None
+        self._writer = None
+        self._outbox = None
+        self._tasks = []
+        # loop.time() of the last write, or of the last queued keepalive
+        self._last_send_time = None
+        self._last_write_time = None
+        self.keepalive_stats = KeepaliveStats()
+        # log the keepalive stats every this many keepalives
+        self.keepalive_report_every = 60
+
+        # two way commands in flight, keyed by jsonrpc id and by UID
+        self._pending_idd = {}
+        self._pending_uid = {}
+
+    def start(self, timeout=None):
+        """
+        Start the event loop thread and wait until we are
+        connected to Voyager. Connection attempts are retried
+        with backoff until they succeed or stop() is called
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Seconds to wait for the first connection
+            default = None (wait forever)
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        OSError : When not connected within timeout
+        """
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.__run_loop)
+        self._thread.daemon = True
+        self._thread.start()
+        self._session = asyncio.run_coroutine_threadsafe(self.__session_task(), self._loop)
+        if not self._connected.wait(timeout):
+            self.stop()
+            raise OSError(f"Could not connect to Voyager at {self.socket_ip}:{self.socket_port}")
+
+    @property
+    def connected(self):
+        """
+        Are we currently connected to Voyager?
+        """
+        return self._connected.is_set()
+
+    def stop(self):
+        """
+        Cancel the transport tasks, close the connection
+        and stop the event loop thread
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        if self._loop is None or not self._loop.is_running():
+            return
+        future = asyncio.run_coroutine_threadsafe(self.__shutdown(), self._loop)
+        try:
+            future.result(5)
+        except Exception:
+            logging.exception("Problem shutting down Voyager client")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        if threading.current_thread() is not self._thread:
+            self._thread.join(5)
+
+    def send(self, message):
+        """
+        Queue a message string for the writer task.
+        Safe to call from any thread
+
+        Parameters
+        ----------
+        message : string or bytes
+            message to communicate to Voyager, including delimiter
+
+        Returns
+        -------
+        queued : boolean
+            Was the message accepted for sending?
+            True or False
+
+        Raises
+        ------
+        None
+        """
+        if self._loop is None or not self._loop.is_running() or not self.connected:
+            logging.error(f"CANNOT SEND {message.rstrip()} TO VOYAGER, not connected")
+            return False
+        data = message.encode('utf-8') if isinstance(message, str) else message
+        self._loop.call_soon_threadsafe(self.__enqueue, data)
+        return True
+
+    def submit(self, message, ok_status, timeout=None):
+        """
+        Send a two way command and register it as in flight.
+        Safe to call from any thread
+
+        The returned future resolves once both the jsonrpc
+        response and the RemoteActionResult event for this
+        command have arrived. Unrelated messages that arrive
+        meanwhile are passed to on_message as normal
+
+        If a timeout is given and the command has not finished
+        by then, it is aborted with RemoteActionAbort and the
+        future raises VoyagerCommandTimeout
+
+        Parameters
+        ----------
+        message : dict or Command
+            command object with params.UID, id and method.
+            Commands are sent as already serialised
+        ok_status : int
+            RemoteActionResult code that means success
+        timeout : float, optional
+            deadline for the whole round trip in seconds
+            default = None (wait forever)
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            resolves to the ParamRet payload of the command
+            or raises VoyagerCommandError
+
+        Raises
+        ------
+        None
+        """
+        response = Response(message['params']['UID'], message['id'],
+                            ok_status, message['method'])
+        if isinstance(message, Command):
+            data = message.data + self.delim
+        else:
+            data = self.codec.dumps(message) + self.delim
+        if self._loop is None or not self._loop.is_running() or not self.connected:
+            response.future.set_exception(VoyagerCommandError(f"Not connected, cannot send {data.rstrip()}"))
+            return response.future
+        self._loop.call_soon_threadsafe(self.__register, response, data, timeout)
+        return response.future
+
+    def abort(self, uid, idd):
+        """
+        If things go pear shaped, tell Voyager
+        to abort this UID:IDD
+
+        Parameters
+        ----------
+        uid : string
+            unique ID for this command
+        idd : int
+            unique ID for this command
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        data = self._abort_template.render(UID=uid, id=idd) + self.delim
+        _ = self.send(data)
+
+    @property
+    def n_pending(self):
+        """
+        Number of two way commands currently in flight
+        """
+        return len(self._pending_uid)
+
+    def polling_str(self):
+        """
+        Create a Polling event string, used for keepalive
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        polling_str : bytes
+            Polling event ready to send
+
+        Raises
+        ------
+        None
+        """
+        return self._polling_template.render(Timestamp=str(time.time())) + self.delim
+
+    def __run_loop(self):
+        """
+        Target for the event loop thread
+        """
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    async def __session_task(self):
+        """
+        Keep a connection to Voyager open. Connect, run until
+        the reader stops, tidy up and go again with backoff
+        """
+        attempt = 0
+        while True:
+            try:
+                await self.__connect()
+            except OSError as err:
+                delay = self.__backoff_delay(attempt)
+                attempt += 1
+                logging.error(f"Voyager socket connect failed ({err}), retrying in {delay:.1f} s [{attempt}]")
+                await asyncio.sleep(delay)
+                continue
+            attempt = 0
+            self._connected.set()
+            # let the owner redo any handshake before new messages arrive
+            self.__deliver({"Event": CONNECTED_EVENT})
+            self._tasks = [asyncio.ensure_future(self.__reader_task()),
+                           asyncio.ensure_future(self.__writer_task()),
+                           asyncio.ensure_future(self.__keepalive_task())]
+            try:
+                # the reader finishes when the connection is lost
+                await self._tasks[0]
+            finally:
+                await self.__disconnect("connection to Voyager lost")
+            logging.error("Lost connection to Voyager, reconnecting")
+
+    def __backoff_delay(self, attempt):
+        """
+        Jittered exponential backoff between connection attempts
+
+        Parameters
+        ----------
+        attempt : int
+            number of failed attempts so far
+
+        Returns
+        -------
+        delay : float
+            seconds to wait before the next attempt
+
+        Raises
+        ------
+        None
+        """
+        delay = min(self.reconnect_max_delay, self.reconnect_min_delay * 2**attempt)
+        # keep half the delay and randomise the rest so clients don't retry in lock step
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def __connect(self):
+        """
+        Open the connection and reset the per
+        connection state
+        """
+        self._reader, self._writer = await asyncio.open_connection(self.socket_ip,
+                                                                   self.socket_port)
+        self._framer.reset()
+        if self.capture is not None:
+            self.capture.record(b'C', f"{self.socket_ip}:{self.socket_port}".encode('utf-8'))
+        self._outbox = asyncio.Queue()
+        # say hello straight away, Voyager expects a poll soon after connecting
+        self._last_send_time = self._loop.time()
+        self._last_write_time = None
+        self._outbox.put_nowait((self.polling_str(), None))
+        logging.info(f"Connected to Voyager at {self.socket_ip}:{self.socket_port}")
+
+    async def __disconnect(self, reason):
+        """
+        Cancel the tasks, close the connection and fail
+        anything still in flight
+
+        Parameters
+        ----------
+        reason : string
+            why we are disconnecting, reported to waiting callers
+        """
+        self._connected.clear()
+        self.__fail_all_pending(reason)
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except Exception:
+                pass
+            self._writer = None
+
+    async def __shutdown(self):
+        """
+        Stop reconnecting and close the connection
+        """
+        if self._session is not None:
+            self._session.cancel()
+        await self.__disconnect("client shutting down")
+
+    def __enqueue(self, data):
+        """
+        Put encoded data on the outbox, runs on the event loop.
+        Data sent while disconnected is dropped as it would
+        be stale by the time we reconnect
+
+        Parameters
+        ----------
+        data : bytes
+            encoded message ready to send
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        if not self.connected:
+            logging.error(f"CANNOT SEND {data.rstrip()} TO VOYAGER, not connected")
+            return
+        self._outbox.put_nowait((data, None))
+
+    def __register(self, response, data, timeout):
+        """
+        Add a command to the in flight tables, start its
+        deadline timer and queue it. Runs on the event loop
+        so a response can never arrive before its command
+        is registered
+
+        Parameters
+        ----------
+        response : Response
+            tracking object for the command
+        data : bytes
+            encoded command ready to send
+        timeout : float
+            deadline for the command in seconds, None for no deadline
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        if not self.connected:
+            error = VoyagerCommandError(f"Not connected, cannot send {response.method} {response.uid}:{response.idd}")
+            response.future.set_exception(error)
+            return
+        self._pending_idd[response.idd] = response
+        self._pending_uid[response.uid] = response
+        if timeout is not None:
+            response.timer = self._loop.call_later(timeout, self.__expire, response, timeout)
+        logging.debug(f"CALLBACK ADD: {response.uid}:{response.idd}")
+        self._outbox.put_nowait((data, None))
+
+    def __expire(self, response, timeout):
+        """
+        Abort a command that missed its deadline
+
+        Parameters
+        ----------
+        response : Response
+            tracking object for the command
+        timeout : float
+            the deadline that was missed, in seconds
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        if response.future.done():
+            return
+        stage = "RemoteActionResult" if response.idd_recv else "jsonrpc"
+        error = VoyagerCommandTimeout(response.method, response.uid, response.idd, timeout, stage)
+        logging.error(f"TIMEOUT: {error}, aborting")
+        self.abort(response.uid, response.idd)
+        self.__complete(response, error)
+
+    def __complete(self, response, error=None):
+        """
+        Remove a command from the in flight tables
+        and resolve its future
+
+        Parameters
+        ----------
+        response : Response
+            tracking object for the command
+        error : Exception, optional
+            if supplied the future raises this
+            default = None
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        self._pending_idd.pop(response.idd, None)
+        self._pending_uid.pop(response.uid, None)
+        if response.timer is not None:
+            response.timer.cancel()
+        if response.future.done():
+            return
+        if error is not None:
+            response.future.set_exception(error)
+        else:
+            response.future.set_result(response.payload)
+
+    def __fail_all_pending(self, reason):
+        """
+        Fail every command in flight, e.g. when the
+        connection drops
+
+        Parameters
+        ----------
+        reason : string
+            description of why the commands failed
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        for response in list(self._pending_uid.values()):
+            error = VoyagerCommandError(f"{response.method} {response.uid}:{response.idd} failed, {reason}")
+            self.__complete(response, error)
+
+    def __route(self, rec):
+        """
+        Match a message against the commands in flight
+
+        Parameters
+        ----------
+        rec : dict
+            decoded message from Voyager
+
+        Returns
+        -------
+        consumed : boolean
+            True if the message was a command response,
+            False if it should go to on_message
+
+        Raises
+        ------
+        None
+        """
+        # handle the jsonrpc response (1 of 2 responses needed)
+        if "jsonrpc" in rec:
+            logging.debug(f"RECEIVED: {rec}")
+            rec_idd, result, err_code, err_msg = self.__parse_jsonrpc(rec)
+            response = self._pending_idd.get(rec_idd)
+            if response is None:
+                logging.warning(f"Ignoring jsonrpc response for unknown idd: {rec_idd}")
+                return True
+            response.idd_received(result)
+            # result = 0 means OK, anything else is bad
+            # leave this jsonrpc check hardcoded
+            if result != 0:
+                logging.error(f"Problem with command id: {rec_idd}")
+                logging.error(f"{err_code} {err_msg}")
+                # Leo said if result!=0, we have a serious issue. Therefore abort.
+                self.abort(response.uid, response.idd)
+                error = VoyagerCommandRejected(f"{response.method} {response.uid}:{rec_idd} rejected: {err_code} {err_msg}")
+                self.__complete(response, error)
+            else:
+                logging.debug(f"Command id: {rec_idd} returned correctly")
+                if response.uid_recv:
+                    self.__complete(response)
+            return True
+
+        # handle the RemoteActionResult response (2 of 2 needed)
+        if rec.get('Event') == "RemoteActionResult":
+            logging.debug(f"RECEIVED: {rec}")
+            rec_uid, result, motivo, param_ret = self.__parse_remote_action_result(rec)
+            response = self._pending_uid.get(rec_uid)
+            if response is None:
+                logging.warning(f"Ignoring RemoteActionResult for unknown uid: {rec_uid}")
+                return True
+            response.uid_received(result, param_ret)
+            # result = 4 means OK, anything else is an issue
+            if result != response.ok_status:
+                logging.error(f"Problem with command uid: {rec_uid}")
+                logging.error(f"{rec}")
+                error = VoyagerCommandRejected(f"{response.method} {rec_uid}:{response.idd} returned {result}: {motivo}")
+                self.__complete(response, error)
+            else:
+                logging.debug(f"Command uid: {rec_uid} returned correctly")
+                if response.idd_recv:
+                    self.__complete(response)
+            return True
+
+        return False
+
+    @staticmethod
+    def __parse_jsonrpc(response):
+        """
+        Take a jsonrpc response and figure out
+        what happened. If there is an error result is
+        missing and error object is there instead
+
+        Parameters
+        ----------
+        response : dict
+            jsonrpc response from Voyager
+
+        Returns
+        -------
+        rec_idd : int
+            response_id, used to match async commands/responses
+        result : int
+            result code, 0 = ok, all else = not ok
+        error_code : int
+            used to determine type of error
+        error_msg : string
+            description of any error
+
+        Raises
+        ------
+        None
+        """
+        # get the response ID
+        rec_idd = response['id']
+
+        try:
+            result = response['result']
+            error_code = None
+            error_msg = None
+        except KeyError:
+            result = -1
+            error_code = response['error']['code']
+            error_msg = response['error']['message']
+
+        return rec_idd, result, error_code, error_msg
+
+    @staticmethod
+    def __parse_remote_action_result(response):
+        """
+        Take a remote action result and see what happened
+
+        Parameters
+        ----------
+        response : dict
+            Voyager RemoteActionResult response
+
+        Returns
+        -------
+        uid : string
+            unique id for the corresponding command
+        result : int
+            result code, 4 = ok, all else = not ok
+        motivo : string
+            description of any error
+        param_ret : dict
+            parameters returned by command
+
+        Raises
+        ------
+        None
+        """
+        result = response['ActionResultInt']
+        uid = response['UID']
+        motivo = response['Motivo']
+        param_ret = response['ParamRet']
+        return uid, result, motivo, param_ret
+
+    async def __reader_task(self):
+        """
+        Read from the socket and dispatch every
+        complete message immediately. Returns when
+        the connection is lost
+        """
+        while True:
+            try:
+                data = await self._reader.read(self.n_bytes)
+            except (ConnectionError, OSError):
+                logging.exception("Problem reading from Voyager")
+                break
+            if not data:
+                logging.error("Voyager closed the connection")
+                break
+            if self.capture is not None:
+                self.capture.record(b'R', data)
+            try:
+                messages = self._framer.feed(data)
+            except ValueError:
+                logging.exception("Problem framing Voyager messages, dropping partial data")
+                continue
+            for message_str in messages:
+                self.__dispatch(message_str)
+
+    def __dispatch(self, message_str):
+        """
+        Decode one framed message and pass it to the callback
+
+        Parameters
+        ----------
+        message_str : bytes
+            one complete message without its delimiter
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        logging.debug(f"Message raw {message_str}")
+        try:
+            rec = self.codec.loads(message_str)
+        except ValueError:
+            logging.warning(f"Cannot decode message {message_str}, skipping")
+            return
+        if self.__route(rec):
+            return
+        self.__deliver(rec)
+
+    def __deliver(self, rec):
+        """
+        Pass a message to the owner's callback
+
+        Parameters
+        ----------
+        rec : dict
+            decoded message
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        try:
+            self.on_message(rec)
+        except Exception:
+            logging.exception(f"Problem handling message {rec}")
+
+    async def __writer_task(self):
+        """
+        Write queued messages to the socket in order.
+        Keepalives carry their deadline so we can see
+        how late they went out
+        """
+        while True:
+            data, deadline = await self._outbox.get()
+            try:
+                self._writer.write(data)
+                await self._writer.drain()
+            except (ConnectionError, OSError):
+                logging.exception(f"CANNOT SEND {data.rstrip()} TO VOYAGER")
+                continue
+            now = self._loop.time()
+            if self._last_write_time is not None:
+                self.keepalive_stats.record_gap(now - self._last_write_time)
+            self._last_write_time = now
+            self._last_send_time = now
+            if deadline is not None:
+                self.__record_keepalive(now - deadline)
+            if self.capture is not None:
+                self.capture.record(b'T', data)
+            logging.debug(f"SENT: {data.rstrip()}")
+
+    async def __keepalive_task(self):
+        """
+        Send a Polling event whenever the connection has
+        been quiet for keepalive_interval seconds
+
+        This runs on the event loop to a deadline set by the
+        last write, so it keeps going whatever the main and
+        guide threads are blocked on
+        """
+        while True:
+            deadline = self._last_send_time + self.keepalive_interval
+            delay = deadline - self._loop.time()
+            if delay > 0:
+                # something else may be written meanwhile, so check again on waking
+                await asyncio.sleep(delay)
+                continue
+            self._outbox.put_nowait((self.polling_str(), deadline))
+            # don't queue a second poll before this one is written
+            self._last_send_time = self._loop.time()
+
+    def __record_keepalive(self, jitter):
+        """
+        Add a keepalive to the stats, logging them now and then
+        and warning if the keepalive was badly late
+
+        Parameters
+        ----------
+        jitter : float
+            seconds between the keepalive deadline and the write
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        stats = self.keepalive_stats
+        stats.record_keepalive(jitter)
+        if jitter > self.keepalive_interval / 2:
+            logging.warning(f"KEEPALIVE: sent {jitter:.2f} s late")
+        if stats.n_sent % self.keepalive_report_every == 0:
+            logging.info(f"KEEPALIVE: {stats.summary()}")
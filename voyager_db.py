@@ -163,12 +163,57 @@ def log_shifts_to_db(qry_args):
         INSERT INTO autoguider_log
         (ref_image_path, comp_image_path, stabilised, shift_x, shift_y,
          pre_pid_x, pre_pid_y, post_pid_x, post_pid_y, final_x, final_y,
-         std_buff_x, std_buff_y, culled_max_shift_x, culled_max_shift_y)
+         std_buff_x, std_buff_y, culled_max_shift_x, culled_max_shift_y,
+         shift_quality, culled_quality)
         VALUES
         (%s, %s, %s, %s, %s, %s, %s,
-         %s, %s, %s, %s, %s, %s, %s, %s)
+         %s, %s, %s, %s, %s, %s, %s, %s,
+         %s, %s)
         """
     with db_cursor() as cur:
         cur.execute(qry, qry_args)
         logging.debug(f"DB: {qry}")
         logging.debug(f"DB: {qry_args}")
+
+def log_frame_timing_to_db(comp_image_path, result, total, stages):
+    """
+    Log where the time went while guiding on a frame
+
+    Parameters
+    ----------
+    comp_image_path : string
+        path to the frame that was guided on, matches
+        comp_image_path in autoguider_log
+    result : string
+        DonutsRecenterDone or DonutsRecenterError
+    total : float
+        seconds from DonutsRecenterRequired to the result
+    stages : dict
+        seconds spent in each stage, see voyager_utils.StageTimer
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    qry = """
+        INSERT INTO autoguider_timing
+        (comp_image_path, result, total_ms, queue_ms, ready_ms, header_ms,
+         mount_status_ms, ref_lookup_ms, ref_store_ms, donuts_init_ms,
+         measure_shift_ms, log_shifts_ms, pulse_guide_ms)
+        VALUES
+        (%s, %s, %s, %s, %s, %s, %s,
+         %s, %s, %s, %s, %s, %s)
+        """
+    qry_args = (comp_image_path, result, total*1000, stages['queue']*1000,
+                stages['ready']*1000, stages['header']*1000, stages['mount_status']*1000,
+                stages['ref_lookup']*1000, stages['ref_store']*1000,
+                stages['donuts_init']*1000, stages['measure_shift']*1000,
+                stages['log_shifts']*1000, stages['pulse_guide']*1000)
+    with db_cursor() as cur:
+        cur.execute(qry, qry_args)
+        logging.debug(f"DB: {qry}")
+        logging.debug(f"DB: {qry_args}")
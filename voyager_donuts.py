@@ -1,29 +1,39 @@
 """
 Test script for guiding Voyager with donuts
 """
+import os
 import sys
-import socket as s
 import traceback
 import time
 import threading
 import logging
 import queue
-import json
 import uuid
 import signal
 import argparse as ap
 from datetime import datetime
-from shutil import copyfile
+from functools import partial
 from collections import defaultdict
 import numpy as np
 from astropy.io import fits
-from donuts import Donuts
+from voyager_client import (
+    VoyagerClient,
+    VoyagerCommandError,
+    VoyagerCommandRejected,
+    CONNECTED_EVENT,
+    Command,
+    MessageTemplate,
+    TemplateField)
+from voyager_capture import CaptureWriter
+from voyager_frame import (
+    load_frame, FrameWatcher, ReferenceCache, ReferenceArchiver, SIDECAR_SUFFIX
+    )
+from voyager_shift import SHIFT_ENGINES, SoftwareBinned
+from voyager_background import MeshBackground
 import voyager_utils as vutils
 import voyager_db as vdb
 from PID import PID
 
-# TODO: Add RemoteActionAbort call when things go horribly wrong
-
 # pylint: disable=line-too-long
 # pylint: disable=invalid-name
 # pylint: disable=logging-fstring-interpolation
@@ -44,7 +54,7 @@ expected_fork_keys = set(['pixels_to_time', 'guide_directions'])
 
 # some error codes when exiting
 ERROR_SOCKET, ERROR_MOUNT_TYPE, ERROR_STABILISE, ERROR_UNHANDLED, \
-    ERROR_FILE_MISSING = np.arange(5)
+    ERROR_FILE_MISSING, ERROR_SHIFT_ENGINE = np.arange(6)
 
 def arg_parse():
     """
@@ -55,9 +65,25 @@ def arg_parse():
                    help='path to config file')
     return p.parse_args()
 
+# default deadlines (s) for two way commands, on top of any exposure or pulse time
+DEFAULT_COMMAND_TIMEOUTS = {"RemotePulseGuide": 30,
+                            "RemoteCameraShot": 60,
+                            "RemoteMountStatusGetInfo": 10,
+                            "RemotePrecisePointTarget": 300}
+
+# seconds between retries of a failed mount handshake
+HANDSHAKE_RETRY_INTERVAL = 10
+
 # set this when ctrl+c happens, then exit cleanly
 EXIT_EVENT = threading.Event()
 
+class DonutsRecenterError(Exception):
+    """
+    Raised on the guide thread when a frame cannot be
+    guided on. The main thread reports the message to
+    Voyager with a DonutsRecenterError event
+    """
+
 class DonutsStatus():
     """
     Current status of Donuts guiding
@@ -76,12 +102,116 @@ class FlipStatus():
     """
     BEFORE, AFTER, FORK, ERROR, UNKNOWN = np.arange(5)
 
+class MountState():
+    """
+    Cached mount type and flip status, so the guide
+    loop doesn't ask Voyager for it on every frame
+
+    The cache is updated from the main thread and the
+    client's event loop and read from the guide thread
+    """
+    def __init__(self, ttl):
+        """
+        Initialise an empty cache
+
+        Parameters
+        ----------
+        ttl : float
+            seconds a mount status stays valid
+        """
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._is_gem = None
+        self._flip_status = None
+        self._updated = None
+        self._refreshing = False
+
+    def update(self, is_gem, flip_status):
+        """
+        Store a fresh mount status
+
+        Parameters
+        ----------
+        is_gem : boolean
+            is this a German Equatorial Mount?
+        flip_status : int
+            see FlipStatus class for options
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        with self._lock:
+            self._is_gem = is_gem
+            self._flip_status = flip_status
+            self._updated = time.monotonic()
+
+    def get(self):
+        """
+        Get the cached mount status if it is still valid
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        status : tuple or None
+            (is_gem, flip_status), None if stale or invalidated
+
+        Raises
+        ------
+        None
+        """
+        with self._lock:
+            if self._updated is None or time.monotonic() - self._updated > self.ttl:
+                return None
+            return self._is_gem, self._flip_status
+
+    @property
+    def stale(self):
+        """
+        Does the cache need refreshing?
+        """
+        return self.get() is None
+
+    def invalidate(self):
+        """
+        Throw away the cached status, e.g. when the mount may have flipped
+        """
+        with self._lock:
+            self._updated = None
+
+    def start_refresh(self):
+        """
+        Claim the refresh, returns False if one is already in flight
+        """
+        with self._lock:
+            if self._refreshing:
+                return False
+            self._refreshing = True
+            return True
+
+    def end_refresh(self):
+        """
+        Release the refresh claimed with start_refresh
+        """
+        with self._lock:
+            self._refreshing = False
+
 class Message():
     """
     Define some dicts for specific Voyager two way commands
 
     Also define some flags to compare responses from Voyager's
     RemoteActionResult ActionResultInt to.
+
+    Each command is also serialised from a template made once,
+    with only the UID, id and values filled in per message
     """
     NEED_INIT = 0
     READY = 1
@@ -95,6 +225,48 @@ class Message():
     TIME_END = 9
     OK_PARTIAL = 10
 
+    PULSE_GUIDE = MessageTemplate({"method": "RemotePulseGuide",
+                                   "params": {"UID": TemplateField("UID"),
+                                              "Direction": TemplateField("Direction"),
+                                              "Duration": TemplateField("Duration"),
+                                              "Parallelized": "true"},
+                                   "id": TemplateField("id")})
+
+    CAMERA_SHOT = MessageTemplate({"method": "RemoteCameraShot",
+                                   "params": {"UID": TemplateField("UID"),
+                                              "Expo": TemplateField("Expo"),
+                                              "Bin": TemplateField("Bin"),
+                                              "IsROI": "false",
+                                              "ROITYPE": 0,
+                                              "ROIX": 0,
+                                              "ROIY": 0,
+                                              "ROIDX": 0,
+                                              "ROIDY": 0,
+                                              "FilterIndex": TemplateField("FilterIndex"),
+                                              "ExpoType": 0,
+                                              "SpeedIndex": 0,
+                                              "ReadoutIndex": 0,
+                                              "IsSaveFile": TemplateField("IsSaveFile"),
+                                              "FitFileName": TemplateField("FitFileName"),
+                                              "Gain": 1,
+                                              "Offset": 0,
+                                              "Parallelized": "true"},
+                                   "id": TemplateField("id")})
+
+    GOTO_RADEC = MessageTemplate({"method": "RemotePrecisePointTarget",
+                                  "params": {"UID": TemplateField("UID"),
+                                             "IsText": "true",
+                                             "RA": 0,
+                                             "DEC": 0,
+                                             "RAText": TemplateField("RAText"),
+                                             "DECText": TemplateField("DECText"),
+                                             "Parallelized": "true"},
+                                  "id": TemplateField("id")})
+
+    MOUNT_STATUS = MessageTemplate({"method": "RemoteMountStatusGetInfo",
+                                    "params": {"UID": TemplateField("UID")},
+                                    "id": TemplateField("id")})
+
     @staticmethod
     def pulse_guide(uid, idd, direction, duration):
         """
@@ -116,20 +288,21 @@ class Message():
 
         Returns
         -------
-        message : dict
-            JSON dumps ready dict for a pulse guide command
+        message : Command
+            pulse guide command, serialised and ready to send
 
         Raises
         ------
         None
         """
-        message = {"method": "RemotePulseGuide",
-                   "params": {"UID": uid,
-                              "Direction": direction,
-                              "Duration": duration,
-                              "Parallelized": "true"},
-                   "id": idd}
-        return message
+        data = Message.PULSE_GUIDE.render(UID=uid, Direction=direction,
+                                          Duration=duration, id=idd)
+        return Command(data, method="RemotePulseGuide",
+                       params={"UID": uid,
+                               "Direction": direction,
+                               "Duration": duration,
+                               "Parallelized": "true"},
+                       id=idd)
 
     @staticmethod
     def camera_shot(uid, idd, exptime, filter_index, binning, save_file, filename):
@@ -159,34 +332,37 @@ class Message():
 
         Returns
         -------
-        message : dict
-            JSON dumps ready dict for a pulse guide command
+        message : Command
+            camera shot command, serialised and ready to send
 
         Raises
         ------
         None
         """
-        message = {"method": "RemoteCameraShot",
-                   "params": {"UID": uid,
-                              "Expo": exptime,
-                              "Bin": binning,
-                              "IsROI": "false",
-                              "ROITYPE": 0,
-                              "ROIX": 0,
-                              "ROIY": 0,
-                              "ROIDX": 0,
-                              "ROIDY": 0,
-                              "FilterIndex": filter_index,
-                              "ExpoType": 0,
-                              "SpeedIndex": 0,
-                              "ReadoutIndex": 0,
-                              "IsSaveFile": str(save_file).lower(),
-                              "FitFileName": filename,
-                              "Gain": 1,
-                              "Offset": 0,
-                              "Parallelized": "true"},
-                   "id": idd}
-        return message
+        data = Message.CAMERA_SHOT.render(UID=uid, Expo=exptime, Bin=binning,
+                                          FilterIndex=filter_index,
+                                          IsSaveFile=str(save_file).lower(),
+                                          FitFileName=filename, id=idd)
+        return Command(data, method="RemoteCameraShot",
+                       params={"UID": uid,
+                               "Expo": exptime,
+                               "Bin": binning,
+                               "IsROI": "false",
+                               "ROITYPE": 0,
+                               "ROIX": 0,
+                               "ROIY": 0,
+                               "ROIDX": 0,
+                               "ROIDY": 0,
+                               "FilterIndex": filter_index,
+                               "ExpoType": 0,
+                               "SpeedIndex": 0,
+                               "ReadoutIndex": 0,
+                               "IsSaveFile": str(save_file).lower(),
+                               "FitFileName": filename,
+                               "Gain": 1,
+                               "Offset": 0,
+                               "Parallelized": "true"},
+                       id=idd)
 
     @staticmethod
     def goto_radec(uid, idd, ra, dec):
@@ -206,23 +382,23 @@ class Message():
 
         Returns
         -------
-        message : dict
-            JSON dumps ready dict for a pulse guide command
+        message : Command
+            pointing command, serialised and ready to send
 
         Raises
         ------
         None
         """
-        message = {"method": "RemotePrecisePointTarget",
-                   "params": {"UID": uid,
-                              "IsText": "true",
-                              "RA": 0,
-                              "DEC": 0,
-                              "RAText": ra,
-                              "DECText": dec,
-                              "Parallelized": "true"},
-                   "id": idd}
-        return message
+        data = Message.GOTO_RADEC.render(UID=uid, RAText=ra, DECText=dec, id=idd)
+        return Command(data, method="RemotePrecisePointTarget",
+                       params={"UID": uid,
+                               "IsText": "true",
+                               "RA": 0,
+                               "DEC": 0,
+                               "RAText": ra,
+                               "DECText": dec,
+                               "Parallelized": "true"},
+                       id=idd)
 
     @staticmethod
     def get_mount_status(uid, idd):
@@ -241,108 +417,17 @@ class Message():
 
         Returns
         -------
-        message : dict
-            JSON dumps ready dict for a remote mount status command
-
-        Raises
-        ------
-        None
-        """
-        message = {"method": "RemoteMountStatusGetInfo",
-                   "params": {"UID": uid},
-                   "id": idd}
-        return message
-
-class Response():
-    """
-    Keep track of outstanding responses from Voyager
-    """
-    def __init__(self, uid, idd, ok_status):
-        """
-        Initialise response object
-
-        Parameters
-        ----------
-        uid : string
-            unique ID for this command
-        idd : int
-            unique ID for this command
-        ok_staus : int
-            command return value that we search for
-            to ensure everything went ok. Any other
-            value means there was an error
-        """
-        self.uid = uid
-        self.idd = idd
-        self.uid_recv = False
-        self.idd_recv = False
-        self.uid_status = None
-        self.idd_status = None
-        self.ok_status = ok_status
-
-    def uid_received(self, status):
-        """
-        Update uuid response as received
-
-        Parameters
-        ----------
-        status : int
-            response code to command for given uid
-
-        Returns
-        -------
-        None
-
-        Raises
-        ------
-        None
-        """
-        self.uid_recv = True
-        self.uid_status = status
-
-    def idd_received(self, status):
-        """
-        Update uuid response as received
-
-        Parameters
-        ----------
-        status : int
-            response code to command for given idd
-
-        Returns
-        -------
+        message : Command
+            mount status command, serialised and ready to send
 
         Raises
         ------
         None
         """
-        self.idd_recv = True
-        self.idd_status = status
-
-    def all_ok(self):
-        """
-        Check if uid and idd are all ok
-        Return True if so and False if not
-
-        idd is left hardcoded to 0
-        uid code is supplied on init
-
-        Parameters
-        ----------
-        None
-
-        Returns
-        -------
-        all_ok : boolean
-            Did we get a good response for the command submitted?
-            True of False
-
-        Raises
-        ------
-        None
-        """
-        return self.uid_recv and self.idd_recv and \
-               self.uid_status == self.ok_status and self.idd_status == 0
+        data = Message.MOUNT_STATUS.render(UID=uid, id=idd)
+        return Command(data, method="RemoteMountStatusGetInfo",
+                       params={"UID": uid},
+                       id=idd)
 
 class Voyager():
     """
@@ -357,7 +442,8 @@ class Voyager():
         config : dict
             Configuration information
         """
-        self.socket = None
+        self._config = config
+        self._client = None
         self.socket_ip = config['socket_ip']
         self.socket_port = config['socket_port']
         self.host = config['host']
@@ -366,7 +452,7 @@ class Voyager():
 
         # Fits image path keyword
         self._voyager_path_keyword = "FITPathAndName"
-        self._INFO_SIGNALS = ["Polling", "Version", "Signal", "NewFITReady"]
+        self._INFO_SIGNALS = ["Polling", "Version", "Signal"]
 
         # set up important image header keywords
         self.filter_keyword = config['filter_keyword']
@@ -386,6 +472,20 @@ class Voyager():
         # if GEM we need to handle image flipping
         self._IS_GEM = None
         self._last_flip_status = None
+        # we can't guide until the mount handshake has worked,
+        # a failed one is retried from the idle loop after this time
+        self._handshake_pending = True
+        self._handshake_retry_time = None
+
+        # GEM flip status is cached for this long (s) and refreshed in the
+        # background, so guiding on a frame doesn't wait on the mount
+        try:
+            mount_status_ttl = config['mount_status_ttl']
+        except KeyError:
+            mount_status_ttl = 60
+        self._mount_state = MountState(mount_status_ttl)
+        # last pier side reported in ControlData, used to spot flips
+        self._last_pier_side = None
 
         # keep track of current status
         self._status = DonutsStatus.UNKNOWN
@@ -393,18 +493,31 @@ class Voyager():
         # add a message object for sharing between methods
         self._msg = Message()
 
-        # create an overflow for message receiving, not sure if needed, but added just in case
-        self.message_overflow = []
+        # messages from Voyager are queued here by the client as they arrive
+        self._inbox = queue.Queue()
 
         # some internal tracking variables
         self._image_id = 0
         self._comms_id = 0
-        self._last_poll_time = None
 
         # set up the guiding thread
         self._latest_guide_frame = None
+        self._latest_mount_status = None
+        self._guide_handoff_time = None
         self._guide_condition = threading.Condition()
 
+        # measure frames announced by NewFITReady while we wait for
+        # the DonutsRecenterRequired, see __prefetch_guide_frame
+        try:
+            self.prefetch_frames = config['prefetch_frames']
+        except KeyError:
+            self.prefetch_frames = False
+        self._prefetch_frame = None
+        self._prefetched = None
+
+        # stage timing for the frame being guided on
+        self._frame_timer = vutils.StageTimer()
+
         # set up a queue to send back results from guide_loop
         self._results_queue = queue.Queue(maxsize=1)
 
@@ -442,6 +555,18 @@ class Voyager():
         self._last_xorigin = None
         self._last_yorigin = None
         self._donuts_ref = None
+        # built references for recently used observing configurations
+        try:
+            reference_cache_size = config['reference_cache_size']
+        except KeyError:
+            reference_cache_size = 8
+        try:
+            reference_cache_mb = config['reference_cache_mb']
+        except KeyError:
+            reference_cache_mb = 512
+        self._reference_cache = ReferenceCache(reference_cache_size, reference_cache_mb)
+        # new references are copied to reference_root in the background
+        self._reference_archiver = ReferenceArchiver()
 
         # set up the PID loop coeffs etc
         self.pid_x_p = config["pid_coeffs"]["x"]["p"]
@@ -469,6 +594,13 @@ class Voyager():
         # set up max error in pixels
         self.max_error_pixels = config['max_error_pixels']
 
+        # skip corrections from shifts with a weak correlation peak (clouds,
+        # dome closing etc). The scale depends on the shift engine
+        try:
+            self.min_shift_quality = config['min_shift_quality']
+        except KeyError:
+            self.min_shift_quality = None
+
         # set up stabilisation
         self._stabilised = False
         # set up how many attempts to stabilise are allowed
@@ -502,6 +634,9 @@ class Voyager():
             self._full_frame_boolean_mask = self.__load_full_frame_boolean_mask()
         else:
             self._full_frame_boolean_mask = None
+        # masks already binned per (xbin, ybin) and sliced per subframe
+        self._binned_masks = {}
+        self._subframe_masks = {}
 
         # initialise all the things
         self.__initialise_guide_buffer()
@@ -512,6 +647,68 @@ class Voyager():
         # some donuts algorithm config
         self.donuts_subtract_bkg = config['donuts_subtract_bkg']
 
+        # how shifts are measured, see voyager_shift.py
+        try:
+            self.shift_engine = config['shift_engine']
+        except KeyError:
+            self.shift_engine = "donuts"
+        self._shift_engine = SHIFT_ENGINES[self.shift_engine]
+        # extra keyword arguments for the engine, e.g. tiles for "tiled"
+        try:
+            self.shift_engine_options = config['shift_engine_options']
+        except KeyError:
+            self.shift_engine_options = {}
+        # sigma clipped mesh background instead of each engine's own sky
+        # removal. One estimator is shared so its mesh geometry is reused
+        try:
+            self.background_mesh = config['background_mesh']
+        except KeyError:
+            self.background_mesh = None
+        if self.background_mesh is not None and self.donuts_subtract_bkg:
+            self._background = MeshBackground(mesh_size=self.background_mesh)
+            self._shift_engine = partial(self._shift_engine, background=self._background)
+        else:
+            self._background = None
+        # crop and/or bin frames in memory before measuring them, shifts
+        # come back in frame pixels so nothing downstream changes
+        try:
+            self.software_binning = config['software_binning']
+        except KeyError:
+            self.software_binning = 1
+        try:
+            self.software_crop = config['software_crop']
+        except KeyError:
+            self.software_crop = None
+        if self.software_binning not in (1, [1, 1]) or self.software_crop is not None:
+            self._shift_engine = partial(SoftwareBinned, self._shift_engine,
+                                         binning=self.software_binning,
+                                         crop=self.software_crop)
+
+        # deadlines for two way commands, see __command_timeout
+        self.command_timeouts = dict(DEFAULT_COMMAND_TIMEOUTS)
+        if 'command_timeouts' in config:
+            self.command_timeouts.update(config['command_timeouts'])
+
+        # send x and y pulse guides together rather than one after the other
+        try:
+            self.parallel_pulse_guide = config['parallel_pulse_guide']
+        except KeyError:
+            self.parallel_pulse_guide = False
+
+        # record the Voyager protocol for replaying later, see voyager_capture.py
+        try:
+            self.capture_root = config['capture_root']
+        except KeyError:
+            self.capture_root = None
+        self._capture = None
+
+        # wait for frames to be completely written before reading them
+        try:
+            frame_ready_timeout = config['frame_ready_timeout']
+        except KeyError:
+            frame_ready_timeout = 5.0
+        self._frame_watcher = FrameWatcher(timeout=frame_ready_timeout)
+
     def __load_full_frame_boolean_mask(self):
         """
         Try loading a mask from disc
@@ -522,7 +719,8 @@ class Voyager():
         except FileNotFoundError:
             print(f"Mask file {self.full_frame_boolean_mask_file} is missing, exiting.")
             sys.exit(ERROR_FILE_MISSING)
-        return full_frame_mask
+        # convert once here rather than on every binning
+        return np.asarray(full_frame_mask, dtype=bool)
 
     def __resolve_host_path(self, data_type, path):
         """
@@ -621,6 +819,26 @@ class Voyager():
         Ping the mount to see if it is a GEM
         and what the status is. If it returns FORK
         then we can ignore all the GEM logic
+
+        This runs mid-session as well as at start up, so
+        an unusable answer is raised for the caller to
+        handle rather than exiting
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        is_gem : boolean
+            is this a German Equatorial Mount?
+        flip_status : int
+            see FlipStatus class for options
+
+        Raises
+        ------
+        ValueError : When Voyager cannot tell us the mount type or flip status
+        VoyagerCommandError : When the command fails
         """
         # check if GEM or Fork, if Fork we can skip things later
         uuid_mount = str(uuid.uuid4())
@@ -629,10 +847,32 @@ class Voyager():
         payload = self.__send_two_way_message_to_voyager(message_mount)
         self._comms_id += 1
 
-        if payload['FlipStatus'] == 5:
-            logging.fatal("Cannot determine if mount is GEM or Fork, quitting!")
-            sys.exit(ERROR_MOUNT_TYPE)
-        elif payload['FlipStatus'] == 4:
+        is_gem, flip_status = self.__parse_mount_status(payload)
+        self._mount_state.update(is_gem, flip_status)
+        return is_gem, flip_status
+
+    @staticmethod
+    def __parse_mount_status(payload):
+        """
+        Map Voyager's FlipStatus onto our mount type and flip status
+
+        Parameters
+        ----------
+        payload : dict
+            ParamRet from RemoteMountStatusGetInfo
+
+        Returns
+        -------
+        is_gem : boolean
+            is this a German Equatorial Mount?
+        flip_status : int
+            see FlipStatus class for options
+
+        Raises
+        ------
+        ValueError : When Voyager cannot tell us the flip status
+        """
+        if payload['FlipStatus'] == 4:
             logging.info("Voyager reports mount as FORK, ignoring all pier flip logic")
             return False, FlipStatus.FORK
         elif payload['FlipStatus'] in (0, 1):
@@ -641,9 +881,153 @@ class Voyager():
         elif payload['FlipStatus'] in (2, 3):
             logging.info("Voyager reports mount as GEM, currently AFTER flip")
             return True, FlipStatus.AFTER
-        else:
-            logging.fatal("Got unhandled return from mount status")
-            sys.exit(ERROR_UNHANDLED)
+        elif payload['FlipStatus'] == 5:
+            raise ValueError("Voyager cannot determine if the mount is a GEM or FORK (FlipStatus 5)")
+        raise ValueError(f"Unhandled FlipStatus {payload['FlipStatus']}")
+
+    def __current_mount_status(self):
+        """
+        Get the GEM mount status for the frame about to be
+        guided on, from the cache if it is fresh, otherwise
+        from the mount. Called on the main thread only
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        mount_status : tuple or None
+            (is_gem, flip_status), None for a FORK mount or
+            if the mount could not be asked
+
+        Raises
+        ------
+        None
+        """
+        if not self._IS_GEM:
+            return None
+        with self._frame_timer.stage("mount_status"):
+            mount_status = self._mount_state.get()
+            if mount_status is None:
+                logging.debug("Cached mount status is stale, asking the mount")
+                try:
+                    mount_status = self.__get_mount_status()
+                except Exception:
+                    logging.exception("Failed to get the mount status")
+        return mount_status
+
+    def __refresh_mount_status(self):
+        """
+        Ask Voyager for the mount status without waiting for
+        the answer. The cache is updated from the client's event
+        loop when the RemoteActionResult arrives
+
+        This is only called from the main thread while the
+        guide thread is idle, so the two never send commands
+        at the same time
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        if not self._client.connected or not self._mount_state.start_refresh():
+            return
+        uuid_mount = str(uuid.uuid4())
+        message_mount = self._msg.get_mount_status(uuid_mount, self._comms_id)
+        self._comms_id += 1
+        future = self._client.submit(message_mount, self._msg.OK,
+                                     timeout=self.__command_timeout(message_mount))
+        future.add_done_callback(self.__mount_status_received)
+
+    def __mount_status_received(self, future):
+        """
+        Store the result of a background mount status refresh
+        """
+        try:
+            is_gem, flip_status = self.__parse_mount_status(future.result())
+            self._mount_state.update(is_gem, flip_status)
+        except Exception:
+            logging.warning("Background mount status refresh failed, will retry", exc_info=True)
+        finally:
+            self._mount_state.end_refresh()
+
+    def __check_for_flip(self, rec):
+        """
+        Watch ControlData for signs the mount may have
+        flipped and drop the cached flip status if so
+
+        Parameters
+        ----------
+        rec : dict
+            ControlData event from Voyager
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        pier_side = rec.get('MNTPIER')
+        # a flip is a slew, so any slew might have changed the pier side
+        if rec.get('MNTSLEW') or (pier_side is not None and self._last_pier_side is not None \
+                                  and pier_side != self._last_pier_side):
+            if not self._mount_state.stale:
+                logging.info("Mount is slewing or changed pier side, refreshing flip status")
+            self._mount_state.invalidate()
+        if pier_side is not None:
+            self._last_pier_side = pier_side
+
+    def __mount_handshake(self):
+        """
+        Get the mount type and flip status after connecting
+        to Voyager and set up the guide directions and scales
+
+        On a reconnect the last flip status is left alone, so
+        the guide loop still spots a flip that happened while
+        we were disconnected. Everything else we hold in
+        memory (reference, PID loop, buffers) carries on
+
+        If the handshake fails it is left pending, retried
+        from the idle loop and recenter requests are refused
+        until it succeeds
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        self._handshake_pending = True
+        try:
+            self._IS_GEM, current_flip_status = self.__get_mount_status()
+        except Exception:
+            logging.exception(f"Mount status handshake failed, retrying in {HANDSHAKE_RETRY_INTERVAL} s")
+            self._handshake_retry_time = time.monotonic() + HANDSHAKE_RETRY_INTERVAL
+            return
+        # update the guide config directions and scales now we know about the mount
+        self.__update_guiding_configuration(self._IS_GEM, current_flip_status)
+        if self._last_flip_status is None:
+            self._last_flip_status = current_flip_status
+        self._handshake_pending = False
+        self._handshake_retry_time = None
+        logging.info("Mount status handshake complete")
 
     def __update_guiding_configuration(self, is_gem, current_flip_status):
         """
@@ -668,14 +1052,14 @@ class Voyager():
         None
         """
         if is_gem and current_flip_status == FlipStatus.BEFORE:
-            self.pixels_to_time = config['pixels_to_time_east']
-            self.guide_directions = config['guide_directions_east']
+            self.pixels_to_time = self._config['pixels_to_time_east']
+            self.guide_directions = self._config['guide_directions_east']
         elif is_gem and current_flip_status == FlipStatus.AFTER:
-            self.pixels_to_time = config['pixels_to_time_west']
-            self.guide_directions = config['guide_directions_west']
+            self.pixels_to_time = self._config['pixels_to_time_west']
+            self.guide_directions = self._config['guide_directions_west']
         elif not is_gem:
-            self.pixels_to_time = config['pixels_to_time']
-            self.guide_directions = config['guide_directions']
+            self.pixels_to_time = self._config['pixels_to_time']
+            self.guide_directions = self._config['guide_directions']
         else:
             pass
 
@@ -703,28 +1087,30 @@ class Voyager():
         guide_thread.daemon = True
         guide_thread.start()
 
-        # open the socket to Voyager
+        # open the connection to Voyager, this also starts the keepalive timer
+        # the mount handshake is done when the client reports it has connected
         self.__open_socket()
 
-        # keep it alive and listen for jobs
-        self.__keep_socket_alive()
-
         # set guiding status to IDLE
         self._status = DonutsStatus.IDLE
 
-        # get the mount status and type
-        self._IS_GEM, self._last_flip_status = self.__get_mount_status()
-        # update the guide config directions and scales now we know about the mount
-        self.__update_guiding_configuration(self._IS_GEM, self._last_flip_status)
-
         # loop until told to stop
         while 1:
             # end on ctrl+c
-            if EXIT_EVENT.set():
+            if EXIT_EVENT.is_set():
                 break
 
+            # try a failed mount handshake again while we are not guiding
+            if self._handshake_retry_time is not None and self._status == DonutsStatus.IDLE and \
+                self._client.connected and time.monotonic() > self._handshake_retry_time:
+                self.__mount_handshake()
+
+            # keep the GEM flip status fresh while we are not guiding
+            if self._IS_GEM and self._status == DonutsStatus.IDLE and self._mount_state.stale:
+                self.__refresh_mount_status()
+
             # listen for a response or a new job to do
-            rec = self.__receive_until_delim()
+            rec = self.__receive()
 
             # was there a command? If so, do something, else, do nothing/keep alive
             if rec:
@@ -736,6 +1122,23 @@ class Voyager():
                     if rec['Event'] in self._INFO_SIGNALS:
                         logging.debug(f"RECEIVED: {rec}")
 
+                    # start on a new frame before Voyager asks us to recenter on it
+                    elif rec['Event'] == "NewFITReady":
+                        logging.debug(f"RECEIVED: {rec}")
+                        if self.prefetch_frames and self._status == DonutsStatus.IDLE:
+                            prefetch_image = self.__resolve_container_path("data", rec['File'])
+                            with self._guide_condition:
+                                self._prefetch_frame = prefetch_image
+                                self._guide_condition.notify()
+
+                    # look out for meridian flips
+                    elif rec['Event'] == "ControlData":
+                        self.__check_for_flip(rec)
+
+                    # we have (re)connected to Voyager, check in with the mount
+                    elif rec['Event'] == CONNECTED_EVENT:
+                        self.__mount_handshake()
+
                     # handle the autoguider calibration event
                     elif rec['Event'] == "DonutsCalibrationRequired":
                         # send a dummy command with a small delay for now
@@ -743,17 +1146,28 @@ class Voyager():
                         self.__send_donuts_message_to_voyager("DonutsCalibrationStart")
 
                         # run the calibration process
-                        self.__calibrate_donuts()
-
-                        # send the calibration done message
-                        self.__send_donuts_message_to_voyager("DonutsCalibrationDone")
+                        try:
+                            self.__calibrate_donuts()
+                            # send the calibration done message
+                            self.__send_donuts_message_to_voyager("DonutsCalibrationDone")
+                        except Exception:
+                            self.__send_donuts_message_to_voyager("DonutsCalibrationError", "Calibration failed, see donuts log")
+                            traceback.print_exc()
                         self._status = DonutsStatus.IDLE
 
                     # handle the autoguiding event
                     elif rec['Event'] == "DonutsRecenterRequired":
                         logging.debug(f"RECEIVED: {rec}")
+                        # without the mount handshake we don't know how to guide
+                        if self._handshake_pending:
+                            logging.error("Mount status handshake not complete, cannot recenter yet")
+                            self.__send_donuts_message_to_voyager("DonutsRecenterStart")
+                            self.__send_donuts_message_to_voyager("DonutsRecenterError", "Mount status handshake with Voyager not complete, cannot recenter yet")
+
                         # if guider is IDLE, do stuff, otherwise do nothing
-                        if self._status == DonutsStatus.IDLE:
+                        elif self._status == DonutsStatus.IDLE:
+                            # start the clock on this frame
+                            self._frame_timer = vutils.StageTimer()
                             # set the current mode to guiding
                             self._status = DonutsStatus.GUIDING
                             # send a DonutsRecenterStart reply
@@ -763,48 +1177,55 @@ class Voyager():
                             # keep a local copy of the image to guide on's path
                             host_path = rec[self._voyager_path_keyword]
                             last_image = self.__resolve_container_path("data", host_path)
+                            if self._capture is not None:
+                                self._capture.record_fits(last_image)
+
+                            # the guide thread never talks to Voyager, so make
+                            # sure we have the GEM flip status before handing over
+                            mount_status = self.__current_mount_status()
 
                             # set the latest image and notify the guide loop thread to wake up
                             with self._guide_condition:
                                 self._latest_guide_frame = last_image
+                                self._latest_mount_status = mount_status
+                                self._guide_handoff_time = time.monotonic()
                                 self._guide_condition.notify()
 
                             # fetch the results from the queue
-                            direction, duration = self._results_queue.get()
+                            direction, duration, error = self._results_queue.get()
+
+                            # the guide loop could not guide on this frame, tell Voyager
+                            if error is not None:
+                                result = "DonutsRecenterError"
+                                self.__send_donuts_message_to_voyager("DonutsRecenterError", error)
 
                             # only try guiding if a valid correction was returned, otherwise, do nothing
-                            if duration['x'] != 0 or duration['y'] != 0:
+                            elif duration['x'] != 0 or duration['y'] != 0:
                                 logging.info(f"CORRECTION: {direction['x']}:{duration['x']} {direction['y']}:{duration['y']}")
 
-                                # send a pulseGuide command followed by a loop for responses
-                                # this must be done before the next command can be sent
+                                # send the x and y pulseGuide commands and wait for both to complete
                                 # if both are sent ok, we send the DonutsRecenterDone, otherwise we send an error
                                 try:
-                                    # make x correction message
-                                    uuid_x = str(uuid.uuid4())
-                                    message_x = self._msg.pulse_guide(uuid_x, self._comms_id, direction['x'], duration['x'])
-                                    # send x correction
-                                    self.__send_two_way_message_to_voyager(message_x)
-                                    self._comms_id += 1
-
-                                    # make y correction message
-                                    uuid_y = str(uuid.uuid4())
-                                    message_y = self._msg.pulse_guide(uuid_y, self._comms_id, direction['y'], duration['y'])
-                                    # send the y correction
-                                    self.__send_two_way_message_to_voyager(message_y)
-                                    self._comms_id += 1
+                                    with self._frame_timer.stage("pulse_guide"):
+                                        self.__apply_guide_correction(direction, duration)
 
                                     # send a DonutsRecenterDone message
+                                    result = "DonutsRecenterDone"
                                     self.__send_donuts_message_to_voyager("DonutsRecenterDone")
                                 except Exception:
                                     # send a recentering error
+                                    result = "DonutsRecenterError"
                                     self.__send_donuts_message_to_voyager("DonutsRecenterError", f"Failed to PulseGuide {last_image}")
                                     traceback.print_exc()
                             else:
                                 logging.info(f"No guide correction returned for {last_image}, skipping and sending DonutsRecenterDone...")
                                 # send a DonutsRecenterDone message
+                                result = "DonutsRecenterDone"
                                 self.__send_donuts_message_to_voyager("DonutsRecenterDone")
 
+                            # report where the time went for this frame
+                            self.__log_frame_timing(last_image, result)
+
                             # set the current mode back to IDLE
                             self._status = DonutsStatus.IDLE
 
@@ -819,7 +1240,8 @@ class Voyager():
                     elif rec['Event'] == "DonutsAbort":
                         logging.info(f"RECEIVED: {rec}")
                         logging.info("EVENT: Donuts abort requested, dying peacefully")
-                        # close the socket
+                        # finish archiving any new references and close the socket
+                        self._reference_archiver.wait(timeout=60)
                         self.__close_socket()
                         # exit
                         sys.exit(0)
@@ -829,12 +1251,9 @@ class Voyager():
                         logging.error('Oh dear, something unforseen has occurred. Here\'s what...')
                         logging.error(f"Failed parsing {rec}")
 
-            # do we need to poll again?
-            now = time.time()
-            time_since_last_poll = now - self._last_poll_time
-            if time_since_last_poll > 5:
-                # ping the keep alive
-                self.__keep_socket_alive()
+        # tidy up the connection on ctrl+c
+        self._reference_archiver.wait(timeout=60)
+        self.__close_socket()
 
     @staticmethod
     def __dec_str_to_deg(declination):
@@ -853,6 +1272,8 @@ class Voyager():
         Take the full frame mask. Apply any binning to it, then
         slice out any subframe currently applied to the science images
 
+        Results are cached, the returned masks are read only
+
         Parameters
         ----------
         xbin : int
@@ -879,67 +1300,43 @@ class Voyager():
         ------
         None
         """
-        image_pixel_mask = self._full_frame_boolean_mask
-        # apply binning if not 1x1
-        if not xbin == ybin == 1:
-            image_pixel_mask = self.__bin_boolean_mask(image_pixel_mask, xbin, ybin)
-
-        # select subframe if defined
         if full_frame:
-            return image_pixel_mask
+            key = (xbin, ybin)
         else:
-            # slice out any subframe
+            key = (xbin, ybin, width_x, height_y, subf_start_x, subf_start_y)
+        try:
+            return self._subframe_masks[key]
+        except KeyError:
+            pass
+
+        # apply binning, if not 1x1, once per binning level
+        try:
+            image_pixel_mask = self._binned_masks[(xbin, ybin)]
+        except KeyError:
+            if xbin == ybin == 1:
+                image_pixel_mask = np.array(self._full_frame_boolean_mask, dtype=bool)
+            else:
+                image_pixel_mask = vutils.bin_boolean_mask(self._full_frame_boolean_mask, xbin, ybin)
+            # donuts only reads the mask, make sure nothing changes the cached copy
+            image_pixel_mask.flags.writeable = False
+            self._binned_masks[(xbin, ybin)] = image_pixel_mask
+
+        # slice out any subframe
+        if not full_frame:
             image_pixel_mask = image_pixel_mask[subf_start_y: subf_start_y + height_y,
                                                 subf_start_x: subf_start_x + width_x]
+        self._subframe_masks[key] = image_pixel_mask
         return image_pixel_mask
 
-    @staticmethod
-    def __bin_boolean_mask(data, xbin, ybin):
-        """
-        Bin a boolean mask
-
-        Note:
-            We do a max in each cell, rather than
-            a sum to keep 0 | 1 in the result
-
-            Additional pixels that do not complete a
-            bin are ignored
-
-        Parameters
-        ----------
-        data : array
-            full frame boolean mask to bin
-        xbin : int
-            binning factor in x (across columns)
-        ybin : int
-            binning factor in y (across rows)
-
-        Returns
-        -------
-        y : array
-            binned boolean mask
-
-        Raises
-        ------
-        None
-        """
-        nrows, ncols = data.shape
-        n_binned_cols = ncols//xbin
-        n_binned_rows = nrows//ybin
-        x = np.zeros((nrows, n_binned_cols), dtype=np.uint16)
-        y = np.zeros((n_binned_rows, n_binned_cols), dtype=np.uint16)
-        for i in range(nrows):
-            x[i] = np.max(data[i][:n_binned_cols*xbin].reshape(n_binned_cols, xbin), axis=1)
-        for i in range(n_binned_cols):
-            y[:, i] = np.max(x[:, i][:n_binned_rows*ybin].reshape(n_binned_rows, ybin), axis=1)
-        return y
-
     def __guide_loop(self):
         """
         Analyse incoming images for guiding offsets.
         Results are communicated to the main run thread
         using the results_queue
 
+        All two way commands to Voyager are issued from the
+        main thread, so this thread never waits on the network
+
         Parameters
         ----------
         None
@@ -954,138 +1351,62 @@ class Voyager():
         """
         while 1:
             # end on ctrl+c
-            if EXIT_EVENT.set():
+            if EXIT_EVENT.is_set():
                 break
 
             # block until a frame is available for processing
             with self._guide_condition:
-                while self._latest_guide_frame is None:
+                while self._latest_guide_frame is None and self._prefetch_frame is None:
                     self._guide_condition.wait()
 
-                last_image = self._latest_guide_frame
-
-                # check if GEM
-                if self._IS_GEM:
-                    # get the mount status and check current flip status
-                    is_gem, current_flip_status = self.__get_mount_status()
-                    self.__update_guiding_configuration(is_gem, current_flip_status)
+                # nothing to guide on yet, get ahead on the next frame.
+                # The lock is released so the main thread can hand over meanwhile
+                if self._latest_guide_frame is None:
+                    prefetch_image = self._prefetch_frame
+                    self._prefetch_frame = None
                 else:
-                    current_flip_status = FlipStatus.FORK
-
-                # check if we're still observing the same field
-                # pylint: disable=no-member
-                with fits.open(last_image, ignore_missing_end=True) as ff:
-                    # current field and filter?
-                    current_filter = ff[0].header[self.filter_keyword]
-                    current_field = ff[0].header[self.field_keyword]
-                    current_xbin = ff[0].header[self.xbin_keyword]
-                    current_ybin = ff[0].header[self.ybin_keyword]
-                    declination = ff[0].header[self.dec_keyword]
-                    current_xsize = ff[0].header[self.xsize_keyword]
-                    current_ysize = ff[0].header[self.ysize_keyword]
-                    current_xorigin = ff[0].header[self.xorigin_keyword]
-                    current_yorigin = ff[0].header[self.yorigin_keyword]
-                    self._declination = self.__dec_str_to_deg(declination)
-                # pylint: enable=no-member
-
-                # if something changes or we haven't started yet, sort out a reference image
-                if current_field != self._last_field or current_filter != self._last_filter or \
-                    current_xbin != self._last_xbin or current_ybin != self._last_ybin or \
-                    current_xsize != self._last_xsize or current_ysize != self._last_ysize or \
-                    current_xorigin != self._last_xorigin or \
-                    current_yorigin != self._last_yorigin or \
-                    current_flip_status != self._last_flip_status or self._donuts_ref is None:
-                    logging.info("Detected change in observing sequence, reinitialising donuts...")
-                    # reset PID loop to unstabilised state
-                    self.__initialise_pid_loop(stabilised=False)
-                    # reset the guide buffer
-                    self.__initialise_guide_buffer()
-                    # reset stabilised flag
-                    self._stabilised = False
-
-                    # replacement block using database
-                    # look for a reference image for this field, filter, binx and biny
-                    self._ref_file = vdb.get_reference_image_path(current_field, current_filter, current_xbin, current_ybin,
-                                                                  current_xsize, current_ysize,
-                                                                  current_xorigin, current_yorigin,
-                                                                  current_flip_status)
-
-                    # if we have a reference, use it. Otherwise store this image as the new reference frame
-                    if self._ref_file is not None:
-                        do_correction = True
-                    else:
-                        # set the last image as reference
-                        self._ref_file = last_image
-                        ref_filename = self._ref_file.split('/')[-1]
-                        # copy it to the special storage area
-                        long_term_ref_file = f"{self.reference_root}/{ref_filename}"
-                        copyfile(self._ref_file, long_term_ref_file)
-                        # set thw copied image to the reference in the database
-                        vdb.set_reference_image(long_term_ref_file, current_field, current_filter,
-                                                current_xbin, current_ybin,
-                                                current_xsize, current_ysize,
-                                                current_xorigin, current_yorigin,
-                                                current_flip_status)
-                        # set skip correction as new reference was just defined as this current image
-                        do_correction = False
-
-                    # make this image the reference
-                    if self._APPLY_IMAGE_MASK and self._full_frame_boolean_mask is not None:
-                        image_pixel_mask = self.__extract_image_pixel_mask(current_xbin, current_ybin,
-                                                                           full_frame=False,
-                                                                           width_x=current_xsize,
-                                                                           height_y=current_ysize,
-                                                                           subf_start_x=current_xorigin,
-                                                                           subf_start_y=current_yorigin)
-                        self._donuts_ref = Donuts(self._ref_file, subtract_bkg=self.donuts_subtract_bkg,
-                                                  image_pixel_mask=image_pixel_mask)
-                    else:
-                        self._donuts_ref = Donuts(self._ref_file, subtract_bkg=self.donuts_subtract_bkg)
-                else:
-                    logging.info("No change in observing sequence, donuts continuing as before...")
-                    do_correction = True
-
-                # update the last field/filter values
-                self._last_field = current_field
-                self._last_filter = current_filter
-                self._last_xbin = current_xbin
-                self._last_ybin = current_ybin
-                self._last_xsize = current_xsize
-                self._last_ysize = current_ysize
-                self._last_xorigin = current_xorigin
-                self._last_yorigin = current_yorigin
-                self._last_flip_status = current_flip_status
-
-                # do the correction if required
-                if do_correction:
-                    # work out shift here
-                    shift = self._donuts_ref.measure_shift(last_image)
-                    logging.info(f"Raw shift measured: x:{shift.x.value:.2f} y:{shift.y.value:.2f}")
-
-                    # process the shifts and add the results to the queue
-                    direction, duration = self.__process_guide_correction(shift, current_xbin, current_ybin)
-
-                    # add the post-PID values to the results queue
-                    self._results_queue.put((direction, duration))
+                    prefetch_image = None
+            if prefetch_image is not None:
+                self.__prefetch_guide_frame(prefetch_image)
+                continue
 
-                else:
-                    # return a null correction and do nothing
-                    direction = {"x": self.guide_directions["+x"],
-                                 "y": self.guide_directions["+y"]}
-                    duration = {"x": 0, "y": 0}
-                    self._results_queue.put((direction, duration))
+            with self._guide_condition:
+                last_image = self._latest_guide_frame
+                # too late to prefetch this one
+                if self._prefetch_frame == last_image:
+                    self._prefetch_frame = None
+                self._frame_timer.mark("queue", self._guide_handoff_time)
+
+                # measure the frame. A failure here must not kill the guide thread
+                # or the main thread would wait on the results queue forever
+                error = None
+                try:
+                    direction, duration = self.__process_guide_frame(last_image, self._latest_mount_status)
+                except DonutsRecenterError as recenter_error:
+                    logging.error(f"Cannot guide on {last_image}: {recenter_error}")
+                    direction, duration, error = None, None, f"{recenter_error} {last_image}"
+                except Exception:
+                    logging.exception(f"Failed to determine guide correction for {last_image}")
+                    direction, duration, error = None, None, f"Failed to measure {last_image}"
+
+                # add the post-PID values, or what went wrong, to the results queue
+                self._results_queue.put((direction, duration, error))
 
                 # set this to None for the next image
                 self._latest_guide_frame = None
 
-
-    def __open_socket(self):
+    def __prefetch_guide_frame(self, prefetch_image):
         """
-        Open a socket connection to Voyager
+        Load a frame and measure its shift against the current
+        reference before Voyager asks us to recenter on it. The
+        PID loop and references are left alone, the result is
+        only used if the recenter request is for this frame and
+        the reference hasn't changed by then
 
         Parameters
         ----------
-        None
+        prefetch_image : string
+            path to the frame Voyager has just saved
 
         Returns
         -------
@@ -1095,23 +1416,62 @@ class Voyager():
         ------
         None
         """
-        self.socket = s.socket(s.AF_INET, s.SOCK_STREAM)
-        self.socket.settimeout(1.0)
+        self._prefetched = None
+        t_start = time.monotonic()
+        # not every frame Voyager saves is in the data folder
+        if not os.path.exists(prefetch_image):
+            logging.debug(f"PREFETCH: {prefetch_image} not found, skipping")
+            return
         try:
-            self.socket.connect((self.socket_ip, self.socket_port))
-        except s.error:
-            logging.fatal('Voyager socket connect failed!')
-            logging.fatal('Check the application interface is running!')
-            traceback.print_exc()
-            sys.exit(ERROR_SOCKET)
+            if not self._frame_watcher.wait(prefetch_image):
+                logging.debug(f"PREFETCH: {prefetch_image} not complete, skipping")
+                return
+            frame = load_frame(prefetch_image)
+            shift = None
+            # only worth measuring if it looks like the sequence we are guiding
+            if self._donuts_ref is not None and \
+                frame[self.field_keyword] == self._last_field and \
+                frame[self.filter_keyword] == self._last_filter and \
+                frame[self.xbin_keyword] == self._last_xbin and \
+                frame[self.ybin_keyword] == self._last_ybin and \
+                frame[self.xsize_keyword] == self._last_xsize and \
+                frame[self.ysize_keyword] == self._last_ysize and \
+                frame[self.xorigin_keyword] == self._last_xorigin and \
+                frame[self.yorigin_keyword] == self._last_yorigin:
+                shift = self._donuts_ref.measure_shift(frame)
+            else:
+                logging.debug(f"PREFETCH: {prefetch_image} is not from the sequence we are guiding, not measuring it")
+        except (KeyError, ValueError, OSError) as error:
+            # missing header cards, a frame that doesn't fit the reference or
+            # a file Voyager is still busy with. The recenter request will tell
+            logging.info(f"PREFETCH: skipping {prefetch_image}, {error.__class__.__name__}: {error}")
+            return
+        except Exception:
+            logging.exception(f"PREFETCH: failed to prefetch {prefetch_image}")
+            return
+        self._prefetched = (prefetch_image, frame, self._donuts_ref, shift)
+        logging.debug(f"PREFETCH: {prefetch_image} took {time.monotonic() - t_start:.3f} s")
 
-    def __close_socket(self):
+    @staticmethod
+    def __reference_archived(donuts_ref, ref_path, reference_key):
         """
-        Close the socket once finished
+        Finish off a new reference once the archived copy is
+        complete. Runs on the archiver thread
+
+        The sidecar is saved next to the archived copy and tied
+        to its size and mtime, not those of the data frame it
+        was built from, so it loads after a restart. Nothing is
+        left behind if the archive fails
 
         Parameters
         ----------
-        None
+        donuts_ref : shift engine
+            the reference built from the data frame
+        ref_path : string
+            archived reference FITS file
+        reference_key : tuple
+            field, filter, binning, size, origin and flip
+            status the reference is for
 
         Returns
         -------
@@ -1121,107 +1481,214 @@ class Voyager():
         ------
         None
         """
-        self.socket.close()
+        donuts_ref.save_sidecar(f"{ref_path}{SIDECAR_SUFFIX}", ref_path)
+        vdb.set_reference_image(ref_path, *reference_key)
 
-    def __send(self, message, n_attempts=3):
+    def __process_guide_frame(self, last_image, mount_status):
         """
-        Low level message sending method. Note no listening
-        is done here.
+        Work out the guide correction for a new frame. Sort
+        out the reference image if the observing sequence has
+        changed, then measure the shift and pass it through
+        the PID loop
+
+        This runs on the guide thread and does no Voyager I/O,
+        the main thread hands over the mount status with the frame
 
         Parameters
         ----------
-        message : string
-            message to communicate to Voyager
-        n_attempts: int, optional
-            default = 3
-            max number of tries to send, before giving up
+        last_image : string
+            path to the frame to guide on
+        mount_status : tuple or None
+            (is_gem, flip_status) when the frame was handed over,
+            None if it could not be found
 
         Returns
         -------
-        sent : boolean
-            Did the message send ok?
-            True or False
+        direction : dict
+            Correction directions to apply for X and Y
+        duration : dict
+            Correction pulse guide durations to apply
+            for X and Y. Zero if no correction is needed
 
         Raises
         ------
-        None
-        """
-        sent = False
-        while not sent and n_attempts > 0:
-            n_attempts -= 1
-            try:
-                # send the command
-                self.socket.sendall(bytes(message, encoding='utf-8'))
-                sent = True
-                # update the last poll time
-                self._last_poll_time = time.time()
-                logging.debug(f"SENT: {message.rstrip()}")
-            except:
-                logging.error(f"CANNOT SEND {message} TO VOYAGER [{n_attempts}]")
-                traceback.print_exc()
-                sent = False
-
-        return sent
-
-    def __receive_until_delim(self, delim=b'\r\n'):
-        """
-        """
-        message_buffer = []
-        n_bytes = 2048
-
-        # check if there is any overflow from last time
-        logging.debug(f"Message overflow {self.message_overflow}")
-        for msg in self.message_overflow:
-            logging.debug(f"Moving {msg} to __receive_until_delim message_buffer...")
-            message_buffer.append(msg)
-
-        # reset the overflow
-        self.message_overflow = []
-        logging.debug(f"Reset message overflow to {self.message_overflow}")
-
-        continue_reading = True
-        logging.debug("Starting read until delim...")
-        while continue_reading:
-            # add emergency break on the message buffer
-            # seen issues with spamming thousands of [b'', b'' ...]
-            if len(message_buffer) > 10 or len(self.message_overflow) > 10:
-                logging.fatal("Problem with receive_until_delim, exiting")
-                logging.fatal(f"meassge_buffer: {message_buffer}")
-                logging.fatal(f"meassge_overflow: {self.message_overflow}")
-                sys.exit(ERROR_UNHANDLED)
-            # read the socket
-            try:
-                message_raw = self.socket.recv(n_bytes)
-            except s.timeout:
-                message_raw = b''
-            logging.debug(f"Message raw {message_raw}")
-
-            if delim in message_raw:
-                logging.debug("DELIM FOUND...")
-                continue_reading = False
-                message_end, message_new_start = message_raw.split(b'\r\n')
-                logging.debug(f"Message raw parts {message_end} : {message_new_start}")
-                message_buffer.append(message_end)
-                logging.debug(f"Message buffer: {message_buffer}")
-                self.message_overflow.append(message_new_start)
-                logging.debug(f"Message overflow: {self.message_overflow}")
-
+        ValueError : When guiding a GEM without knowing the flip status
+        """
+        # check if GEM
+        if self._IS_GEM:
+            if mount_status is None:
+                raise ValueError("Flip status unknown, cannot guide a GEM")
+            is_gem, current_flip_status = mount_status
+            self.__update_guiding_configuration(is_gem, current_flip_status)
+        else:
+            current_flip_status = FlipStatus.FORK
+
+        # use the work done when the frame was announced, if any
+        prefetched = self._prefetched
+        self._prefetched = None
+        if prefetched is not None and prefetched[0] == last_image:
+            _, frame, prefetch_ref, prefetch_shift = prefetched
+            logging.info(f"Using prefetched {last_image}")
+        else:
+            frame, prefetch_ref, prefetch_shift = None, None, None
+
+        # check if we're still observing the same field
+        # the frame is read once here and reused for the reference and shift below
+        if frame is None:
+            with self._frame_timer.stage("ready"):
+                if not self._frame_watcher.wait(last_image):
+                    logging.warning(f"{last_image} not complete after {self._frame_watcher.timeout} s, reading it anyway")
+        with self._frame_timer.stage("header"):
+            if frame is None:
+                frame = load_frame(last_image)
+            # current field and filter?
+            current_filter = frame[self.filter_keyword]
+            current_field = frame[self.field_keyword]
+            current_xbin = frame[self.xbin_keyword]
+            current_ybin = frame[self.ybin_keyword]
+            declination = frame[self.dec_keyword]
+            current_xsize = frame[self.xsize_keyword]
+            current_ysize = frame[self.ysize_keyword]
+            current_xorigin = frame[self.xorigin_keyword]
+            current_yorigin = frame[self.yorigin_keyword]
+            self._declination = self.__dec_str_to_deg(declination)
+
+        # if something changes or we haven't started yet, sort out a reference image
+        if current_field != self._last_field or current_filter != self._last_filter or \
+            current_xbin != self._last_xbin or current_ybin != self._last_ybin or \
+            current_xsize != self._last_xsize or current_ysize != self._last_ysize or \
+            current_xorigin != self._last_xorigin or \
+            current_yorigin != self._last_yorigin or \
+            current_flip_status != self._last_flip_status or self._donuts_ref is None:
+            logging.info("Detected change in observing sequence, reinitialising donuts...")
+            # reset PID loop to unstabilised state
+            self.__initialise_pid_loop(stabilised=False)
+            # reset the guide buffer
+            self.__initialise_guide_buffer()
+            # reset stabilised flag
+            self._stabilised = False
+
+            # replacement block using database
+            # look for a reference image for this field, filter, binx and biny
+            reference_key = (current_field, current_filter, current_xbin, current_ybin,
+                             current_xsize, current_ysize, current_xorigin, current_yorigin,
+                             current_flip_status)
+            with self._frame_timer.stage("ref_lookup"):
+                self._ref_file = vdb.get_reference_image_path(*reference_key)
+                # a reference we made recently may not be in the database yet
+                pending_ref = None
+                if self._ref_file is None:
+                    pending_ref = self._reference_archiver.pending(reference_key)
+
+            # if we have a reference, use it. Otherwise store this image as the new reference frame
+            if self._ref_file is not None or pending_ref is not None:
+                if pending_ref is not None:
+                    # read it from where it is being archived from, the copy may be incomplete.
+                    # Its sidecar is saved once the archive is done
+                    ref_frame, self._ref_file = pending_ref
+                    sidecar = None
+                else:
+                    ref_frame = self._ref_file
+                    sidecar = f"{self._ref_file}{SIDECAR_SUFFIX}"
+                ref_path = self._ref_file
+                new_reference = False
+                # we may have built it already, e.g. cycling through filters
+                cached_ref = self._reference_cache.get(reference_key, ref_path)
+                do_correction = True
+            else:
+                # set the last image as reference
+                self._ref_file = last_image
+                ref_filename = self._ref_file.split('/')[-1]
+                # it is copied to the special storage area in the background
+                # once built, see below. The sidecar is tied to the archived copy
+                long_term_ref_file = f"{self.reference_root}/{ref_filename}"
+                # set skip correction as new reference was just defined as this current image
+                ref_frame = frame
+                ref_path = long_term_ref_file
+                sidecar = None
+                new_reference = True
+                cached_ref = None
+                do_correction = False
+
+            # make this image the reference
+            t_donuts_init = time.monotonic()
+            if cached_ref is not None:
+                logging.info(f"Using cached reference {ref_path}")
+                self._donuts_ref = cached_ref
+            elif self._APPLY_IMAGE_MASK and self._full_frame_boolean_mask is not None:
+                image_pixel_mask = self.__extract_image_pixel_mask(current_xbin, current_ybin,
+                                                                   full_frame=False,
+                                                                   width_x=current_xsize,
+                                                                   height_y=current_ysize,
+                                                                   subf_start_x=current_xorigin,
+                                                                   subf_start_y=current_yorigin)
+                self._donuts_ref = self._shift_engine(ref_frame, sidecar=sidecar,
+                                                      subtract_bkg=self.donuts_subtract_bkg,
+                                                      image_pixel_mask=image_pixel_mask,
+                                                      **self.shift_engine_options)
             else:
-                logging.debug("DELIM NOT FOUND, CONTINUING READING...")
-                continue_reading = True
-                message_buffer.append(message_raw)
-                logging.debug(f"Message buffer: {message_buffer}")
+                self._donuts_ref = self._shift_engine(ref_frame, sidecar=sidecar,
+                                                      subtract_bkg=self.donuts_subtract_bkg,
+                                                      **self.shift_engine_options)
+            if cached_ref is None:
+                if self._donuts_ref.sidecar_loaded:
+                    logging.info(f"Loaded prepared reference from {ref_path}{SIDECAR_SUFFIX}")
+                self._reference_cache.put(reference_key, ref_path, self._donuts_ref)
+            self._frame_timer.mark("donuts_init", t_donuts_init)
+
+            # copy a new reference to the special storage area in the background,
+            # we guide on it from memory meanwhile. Its sidecar is saved and the
+            # database told about it only once the copy is complete
+            if new_reference:
+                with self._frame_timer.stage("ref_store"):
+                    self._reference_archiver.archive(reference_key, self._ref_file, long_term_ref_file,
+                                                     partial(self.__reference_archived, self._donuts_ref,
+                                                             long_term_ref_file, reference_key))
+        else:
+            logging.info("No change in observing sequence, donuts continuing as before...")
+            do_correction = True
+
+        # update the last field/filter values
+        self._last_field = current_field
+        self._last_filter = current_filter
+        self._last_xbin = current_xbin
+        self._last_ybin = current_ybin
+        self._last_xsize = current_xsize
+        self._last_ysize = current_ysize
+        self._last_xorigin = current_xorigin
+        self._last_yorigin = current_yorigin
+        self._last_flip_status = current_flip_status
+
+        # do the correction if required
+        if do_correction:
+            # work out shift here, unless it was measured against this reference already
+            if prefetch_shift is not None and prefetch_ref is self._donuts_ref:
+                shift = prefetch_shift
+            else:
+                with self._frame_timer.stage("measure_shift"):
+                    shift = self._donuts_ref.measure_shift(frame)
+            logging.info(f"Raw shift measured: x:{shift.x.value:.2f} y:{shift.y.value:.2f}")
+
+            # process the shifts into post-PID corrections
+            direction, duration = self.__process_guide_correction(shift, current_xbin, current_ybin)
+
+        else:
+            # return a null correction and do nothing
+            direction = {"x": self.guide_directions["+x"],
+                         "y": self.guide_directions["+y"]}
+            duration = {"x": 0, "y": 0}
 
-        logging.debug("Done reading until delim...")
-        message_str = b''.join(message_buffer)
-        logging.debug(f"Final message string: {message_str}")
-        return json.loads(message_str)
+        return direction, duration
 
-    def __keep_socket_alive(self):
+    def __open_socket(self):
         """
-        Convenience method to keep socket open.
-        Voyager's internal polling is reset upon
-        receipt of this message
+        Open a connection to Voyager. The client runs
+        its own reader, writer and keepalive tasks and
+        queues each incoming message on the inbox
+
+        This blocks until the first connection is made. If
+        Voyager goes away later the client reconnects with
+        backoff and we keep all our in memory state
 
         Parameters
         ----------
@@ -1235,87 +1702,88 @@ class Voyager():
         ------
         None
         """
-        now = str(time.time())
-        polling = {"Event": "Polling",
-                   "Timestamp": now,
-                   "Host": self.host,
-                   "Inst": self.inst}
-
-        # send the polling string
-        polling_str = json.dumps(polling) + "\r\n"
-        _ = self.__send(polling_str)
+        if self.capture_root is not None:
+            night = vutils.get_tonight()
+            tnow = datetime.utcnow().strftime("%H%M%S")
+            capture_path = f"{self.capture_root}/{night}_{tnow}_donuts.vcap.gz"
+            logging.info(f"Recording Voyager protocol to {capture_path}")
+            self._capture = CaptureWriter(capture_path)
+        self._client = VoyagerClient(self.socket_ip, self.socket_port, self.host,
+                                     on_message=self._inbox.put,
+                                     capture=self._capture)
+        self._client.start()
 
-    @staticmethod
-    def __parse_jsonrpc(response):
+    def __close_socket(self):
         """
-        Take a jsonrpc response and figure out
-        what happened. If there is an error result is
-        missing and error object is there instead
+        Close the socket once finished
 
         Parameters
         ----------
-        response : dict
-            jsonrpc response from Voyager
+        None
 
         Returns
         -------
-        rec_idd : int
-            response_id, used to match async commands/responses
-        result : int
-            result code, 0 = ok, all else = not ok
-        error_code : int
-            used to determine type of error
-        error_msg : string
-            description of any error
+        None
 
         Raises
         ------
         None
         """
-        # get the response ID
-        rec_idd = response['id']
+        self._client.stop()
+        if self._capture is not None:
+            self._capture.close()
 
-        try:
-            result = response['result']
-            error_code = None
-            error_msg = None
-        except KeyError:
-            result = -1
-            error_code = response['error']['code']
-            error_msg = response['error']['message']
+    def __send(self, message):
+        """
+        Low level message sending method. Note no listening
+        is done here. The message is queued for the client's
+        writer task
 
-        return rec_idd, result, error_code, error_msg
+        Parameters
+        ----------
+        message : bytes
+            message to communicate to Voyager
 
-    @staticmethod
-    def __parse_remote_action_result(response):
+        Returns
+        -------
+        sent : boolean
+            Was the message queued ok?
+            True or False
+
+        Raises
+        ------
+        None
         """
-        Take a remote action result and see what happened
+        return self._client.send(message)
+
+    def __receive(self, timeout=1.0):
+        """
+        Fetch the next message from Voyager. Messages
+        are returned as soon as the client receives them,
+        the timeout only bounds how long we wait when
+        Voyager is quiet
 
         Parameters
         ----------
-        response : dict
-            Voyager RemoteActionResult response
+        timeout : float, optional
+            max number of seconds to wait for a message
+            default = 1.0
 
         Returns
         -------
-        uid : string
-            unique id for the corresponding command
-        result : int
-            result code, 4 = ok, all else = not ok
-        motivo : string
-            description of any error
-        param_ret : dict
-            parameters returned by command
+        message : dict
+            json parsed message from Voyager
+            empty dict if nothing arrived
 
         Raises
         ------
         None
         """
-        result = response['ActionResultInt']
-        uid = response['UID']
-        motivo = response['Motivo']
-        param_ret = response['ParamRet']
-        return uid, result, motivo, param_ret
+        try:
+            message = self._inbox.get(timeout=timeout)
+        except queue.Empty:
+            message = {}
+        return message
 
     def __send_donuts_message_to_voyager(self, event, error=None):
         """
@@ -1339,59 +1807,90 @@ class Voyager():
         """
         now = str(time.time())
         message = {"Event": event,
-                   "Timestamp": now,
-                   "Host": self.host,
-                   "Inst": self.inst}
+                               "Timestamp": now,
+                               "Host": self.host,
+                               "Inst": self.inst}
         if error is not None:
             message['DonutsError'] = error
 
         # send the command
-        msg_str = json.dumps(message) + "\r\n"
+        msg_str = self._client.codec.dumps(message) + b"\r\n"
         _ = self.__send(msg_str)
 
-    def __send_abort_message_to_voyager(self, uid, idd):
+    def __send_two_way_message_to_voyager(self, message):
         """
-        If things go pear shaped and donuts is quitting,
-        tell Voyager to abort this UID:IDD also
+        Issue any two way command to Voyager
+
+        The client keeps a table of commands in flight and
+        resolves this command once both the initial jsonrpc
+        response and the RemoteActionResult event are in.
+        Anything else that arrives meanwhile is queued on the
+        inbox as normal, so no events are lost while we wait
+
+        The helper Message class (above) allows for easy creation
+        of the message objects (dictionaries) to pass to this method
 
         Parameters
         ----------
-        uid : string
-            unique ID for this command
-        idd : int
-            unique ID for this command
+        message : dict
+            A message object containing the relevant json info
+            for the command we want to send to Voyager
 
         Returns
         -------
-        None
+        payload : dict
+            ParamRet data returned by the command
 
         Raises
         ------
-        None
+        VoyagerCommandError : When Voyager rejects or fails the command
+        VoyagerCommandTimeout : When the command misses its deadline
+            and has been aborted
         """
-        message = {'method': 'RemoteActionAbort',
-                   'params': {'UID': uid},
-                   'id': idd}
-        msg_str = json.dumps(message) + "\r\n"
-
-        # send the command
-        _ = self.__send(msg_str)
+        future = self._client.submit(message, self._msg.OK,
+                                     timeout=self.__command_timeout(message))
+        return future.result()
 
-    def __send_two_way_message_to_voyager(self, message):
+    def __command_timeout(self, message):
         """
-        Issue any two way command to Voyager
+        Work out the deadline for a two way command. This is
+        the configured allowance for the method plus the time
+        the action itself takes (exposure or pulse length)
 
-        Wait for the initial jsonrpc response, act accordingly
-        If all good, wait for the RemoteActionResult event, act accordingly
+        Parameters
+        ----------
+        message : dict
+            A message object for the command
 
-        The helper Message class (above) allows for easy creation
-        of the message objects (dictionaries) to pass to this method
+        Returns
+        -------
+        timeout : float
+            deadline for the full round trip in seconds
+
+        Raises
+        ------
+        None
+        """
+        method = message['method']
+        params = message['params']
+        timeout = self.command_timeouts[method]
+        if method == "RemoteCameraShot":
+            timeout += params['Expo']
+        elif method == "RemotePulseGuide":
+            timeout += params['Duration'] / 1000.
+        return timeout
+
+    def __pulse_guide(self, direction, duration):
+        """
+        Send a single pulse guide command and wait
+        for it to complete
 
         Parameters
         ----------
-        message : dict
-            A message object containing the relevant json info
-            for the command we want to send to Voyager
+        direction : int
+            Voyager direction index for the pulse
+        duration : float
+            pulse duration in ms
 
         Returns
         -------
@@ -1399,122 +1898,84 @@ class Voyager():
 
         Raises
         ------
-        Exception : When unable to send message
-        """
-        # grab this message's UID and ID values
-        uid = message['params']['UID']
-        idd = message['id']
-
-        msg_str = json.dumps(message) + "\r\n"
-
-        # initialise an empty response class
-        # add the OK status we want to see returned
-        response = Response(uid, idd, self._msg.OK)
-
-        # initialise the payload that will contain param_ret data
-        # needed for commands that return data we care about
-        payload = None
-
-        # loop until both responses are received
-        cb_loop_count = 0
-        while not response.uid_recv:
-
-            # loop until we get a valid response to issuing a command
-            while not response.idd_recv:
-
-                # try sending the message and then waiting for a response
-                sent = False
-                while not sent:
-                    # send the command
-                    sent = self.__send(msg_str)
-                    if sent:
-                        logging.debug(f"CALLBACK ADD: {uid}:{idd}")
-
-
-                logging.debug(f"JSONRPC CALLBACK LOOP [{cb_loop_count+1}]: {uid}:{idd}")
-                rec = self.__receive_until_delim()
-
-                # handle the jsonrpc response (1 of 2 responses needed)
-                if "jsonrpc" in rec.keys():
-                    logging.debug(f"RECEIVED: {rec}")
-                    rec_idd, result, err_code, err_msg = self.__parse_jsonrpc(rec)
-
-                    # we only care bout IDs for the commands we just sent right now
-                    if rec_idd == idd:
-                        # result = 0 means OK, anything else is bad
-                        # leave this jsonrpc check hardcoded
-                        if result != 0:
-                            logging.error(f"Problem with command id: {idd}")
-                            logging.error(f"{err_code} {err_msg}")
-                            # Leo said if result!=0, we have a serious issue. Therefore abort.
-                            self.__send_abort_message_to_voyager(uid, idd)
-                            raise Exception(f"ERROR: Could not send message {msg_str}")
-                        else:
-                            logging.debug(f"Command id: {idd} returned correctly")
-                            # add the response if things go well. if things go badly we're quitting anyway
-                            response.idd_received(result)
-                    else:
-                        logging.warning(f"Waiting for idd: {idd}, ignoring response for idd: {rec_idd}")
-
-                # increment loop counter to keep track of how long we're waiting
-                cb_loop_count += 1
-
-            # if we exit the while loop above we can assume that
-            # we got a jsonrpc response to the pulse guide command
-            # here we start listening for it being done
-            logging.debug(f"EVENT CALLBACK LOOP [{cb_loop_count+1}]: {uid}:{idd}")
-            rec = self.__receive_until_delim()
-
-            # handle the RemoteActionResult response (2 of 2 needed)
-            if "Event" in rec.keys():
-
-                if rec['Event'] == "RemoteActionResult":
-                    logging.debug(f"RECEIVED: {rec}")
-                    rec_uid, result, _, param_ret = self.__parse_remote_action_result(rec)
-
-                    # check we have a response for the thing we want
-                    if rec_uid == uid:
-                        # result = 4 means OK, anything else is an issue
-                        if result != self._msg.OK:
-                            logging.error(f"Problem with command uid: {uid}")
-                            logging.error(f"{rec}")
-                            # TODO: Consider adding a RemoteActionAbort here if shit hits the fan
-                        else:
-                            logging.debug(f"Command uid: {uid} returned correctly")
-                            # add the response, regardless if it's good or bad, so we can end this loop
-                            response.uid_received(result)
-                            payload = param_ret
-                    else:
-                        logging.warning(f"Waiting for uid: {uid}, ignoring response for uid: {rec_uid}")
+        VoyagerCommandError : When Voyager rejects or fails the command
+        """
+        uuid_pg = str(uuid.uuid4())
+        message_pg = self._msg.pulse_guide(uuid_pg, self._comms_id, direction, duration)
+        self._comms_id += 1
+        self.__send_two_way_message_to_voyager(message_pg)
 
-                elif rec['Event'] in self._INFO_SIGNALS:
-                    logging.debug(f"RECEIVED: {rec}")
+    def __apply_guide_correction(self, direction, duration):
+        """
+        Send the X and Y pulse guide commands for a correction
 
-                else:
-                    logging.warning(f"Unknown response {rec}")
+        In parallel mode both commands are sent back to back
+        and we wait for both to complete together. If Voyager
+        rejects either of them we assume it will not accept
+        overlapping pulses, retry the rejected axis and drop
+        back to serial mode for the rest of the session.
+        Timeouts and disconnects say nothing about overlapping
+        pulses, they are raised without a retry and parallel
+        mode is kept
 
-            # no response? do nothing
-            elif not rec.keys():
-                pass
-            else:
-                logging.warning(f"Unknown response {rec}")
+        Parameters
+        ----------
+        direction : dict
+            Correction directions to apply for X and Y
+        duration : dict
+            Correction pulse guide durations to apply
+            for X and Y
 
-            # keep the connection alive while waiting
-            now = time.time()
-            time_since_last_poll = now - self._last_poll_time
-            if time_since_last_poll > 5:
-                # ping the keep alive
-                self.__keep_socket_alive()
+        Returns
+        -------
+        None
 
-            # increment event loop counter
-            cb_loop_count += 1
+        Raises
+        ------
+        VoyagerCommandError : When a correction cannot be applied
+        """
+        if not self.parallel_pulse_guide:
+            self.__pulse_guide(direction['x'], duration['x'])
+            self.__pulse_guide(direction['y'], duration['y'])
+            return
+
+        # fire off both axes
+        t0 = time.monotonic()
+        futures = {}
+        for axis in ('x', 'y'):
+            uuid_axis = str(uuid.uuid4())
+            message_axis = self._msg.pulse_guide(uuid_axis, self._comms_id, direction[axis], duration[axis])
+            self._comms_id += 1
+            futures[axis] = self._client.submit(message_axis, self._msg.OK,
+                                                timeout=self.__command_timeout(message_axis))
 
-        # check was everything ok and raise an exception if not
-        if not response.all_ok():
-            raise Exception(f"ERROR: Could not send message {msg_str}")
+        # wait for both before acting on any failure, so nothing is left in flight
+        rejected, error = [], None
+        for axis, future in futures.items():
+            try:
+                future.result()
+            except VoyagerCommandRejected:
+                logging.exception(f"Voyager rejected the parallel PulseGuide for {axis}")
+                rejected.append(axis)
+            except VoyagerCommandError as axis_error:
+                logging.error(f"Parallel PulseGuide failed for {axis}: {axis_error}")
+                if error is None:
+                    error = axis_error
+        elapsed = time.monotonic() - t0
 
-        # return the payload
-        return payload
+        if error is not None:
+            raise error
+        if rejected:
+            logging.warning("Voyager rejected overlapping PulseGuide commands, switching to serial corrections")
+            self.parallel_pulse_guide = False
+            for axis in rejected:
+                self.__pulse_guide(direction[axis], duration[axis])
+        else:
+            # the pulses overlap, so the longest one is the least this could take
+            longest = max(duration.values()) / 1000.
+            logging.info(f"PULSEGUIDE: parallel x+y took {elapsed*1000:.0f} ms, "
+                         f"longest pulse {longest*1000:.0f} ms, "
+                         f"overhead {(elapsed-longest)*1000:.0f} ms")
 
     def __calibration_filename(self, direction, pulse_time):
         """
@@ -1666,10 +2127,12 @@ class Voyager():
             image_pixel_mask = self.__extract_image_pixel_mask(self.calibration_binning,
                                                                self.calibration_binning,
                                                                full_frame=True)
-            donuts_ref = Donuts(filename_cont, subtract_bkg=self.donuts_subtract_bkg,
-                                image_pixel_mask=image_pixel_mask)
+            donuts_ref = self._shift_engine(filename_cont, subtract_bkg=self.donuts_subtract_bkg,
+                                            image_pixel_mask=image_pixel_mask,
+                                            **self.shift_engine_options)
         else:
-            donuts_ref = Donuts(filename_cont, subtract_bkg=self.donuts_subtract_bkg)
+            donuts_ref = self._shift_engine(filename_cont, subtract_bkg=self.donuts_subtract_bkg,
+                                            **self.shift_engine_options)
 
         # loop over the 4 directions for the requested number of iterations
         for _ in range(self.calibration_n_iterations):
@@ -1707,7 +2170,11 @@ class Voyager():
                     logging.error(f"ERROR CALIB: failed to send message_shot: {message_shot}")
 
                 # measure the offset and update the reference image
-                shift = donuts_ref.measure_shift(filename_cont)
+                # from the same frame, rather than reading it twice
+                if not self._frame_watcher.wait(filename_cont):
+                    logging.warning(f"CALIB: {filename_cont} not complete, reading it anyway")
+                frame = load_frame(filename_cont)
+                shift = donuts_ref.measure_shift(frame)
                 direction, magnitude = self.__determine_shift_direction_and_magnitude(shift)
                 logging.info(f"SHIFT: {direction} {magnitude}")
                 self._direction_store[i].append(direction)
@@ -1716,10 +2183,12 @@ class Voyager():
                     image_pixel_mask = self.__extract_image_pixel_mask(self.calibration_binning,
                                                                        self.calibration_binning,
                                                                        full_frame=True)
-                    donuts_ref = Donuts(filename_cont, subtract_bkg=self.donuts_subtract_bkg,
-                                        image_pixel_mask=image_pixel_mask)
+                    donuts_ref = self._shift_engine(frame, subtract_bkg=self.donuts_subtract_bkg,
+                                                    image_pixel_mask=image_pixel_mask,
+                                                    **self.shift_engine_options)
                 else:
-                    donuts_ref = Donuts(filename_cont, subtract_bkg=self.donuts_subtract_bkg)
+                    donuts_ref = self._shift_engine(frame, subtract_bkg=self.donuts_subtract_bkg,
+                                                    **self.shift_engine_options)
 
         # now do some analysis on the run from above
         # check that the directions are the same every time for each orientation
@@ -1975,8 +2444,8 @@ class Voyager():
 
     def __process_guide_correction(self, shift, xbin, ybin):
         """
-        Take a Donuts shift object. Analyse the x and y
-        components. Compare them to the recent history of
+        Take a Donuts shift object. Skip it if the correlation
+        quality is too low. Analyse the x and y components. Compare them to the recent history of
         corrections and reject outliers. Additionally, pass
         x and y corrections through a PID loop and trim results
         to the max allowed guide correction, if required
@@ -1985,7 +2454,8 @@ class Voyager():
         ----------
         shift : Donuts.shift object
             Contains the X and Y offset values for a
-            recently analysed image
+            recently analysed image, and the quality
+            of the measurement if the engine gives one
         xbin : int
             Level of image binning in x direction
         ybin : int
@@ -1998,10 +2468,31 @@ class Voyager():
         duration : dict
             Correction pulse guide durations to apply
             for X and Y
+
+        Raises
+        ------
+        DonutsRecenterError : When guiding has not stabilised
+            within n_images_to_stabilise images
         """
         # get x and y from shift object
         shift_x = shift.x.value
         shift_y = shift.y.value
+        # how confident the engine is, None if it can't say
+        quality = getattr(shift, "quality", None)
+
+        # a weak correlation peak means the shift is probably garbage, don't push the mount around
+        if self.min_shift_quality is not None and quality is not None and quality < self.min_shift_quality:
+            logging.warning(f"Shift quality {quality:.1f} below {self.min_shift_quality}: x: {shift_x} y:{shift_y}")
+            logging.warning("Skipping this correction...")
+
+            # make a shift arguments tuple to store in the database
+            shift_args = (self._ref_file, self._latest_guide_frame, self._stabilised, shift_x, shift_y,
+                          0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0, 0, quality, 1)
+            # log the culled correction to the database
+            self.__log_shifts_to_db(shift_args)
+
+            direction, duration = self.__get_null_correction()
+            return direction, duration
 
         # handle big shifts during stabilisation and when stabilised
         if (abs(shift_x) > self.max_error_pixels or abs(shift_y) > self.max_error_pixels) and self._stabilised:
@@ -2010,9 +2501,9 @@ class Voyager():
 
             # make a shift arguments tuple to store in the database
             shift_args = (self._ref_file, self._latest_guide_frame, self._stabilised, shift_x, shift_y,
-                          0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1, 1)
+                          0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1, 1, quality, 0)
             # log the culled correction to the database
-            vdb.log_shifts_to_db(shift_args)
+            self.__log_shifts_to_db(shift_args)
 
             direction, duration = self.__get_null_correction()
             return direction, duration
@@ -2044,9 +2535,12 @@ class Voyager():
         # check if we've been trying to stabilise for too long
         elif not self._stabilised and (pre_pid_x > self.stabilised_pixel_shift or pre_pid_y > self.stabilised_pixel_shift) and self._images_to_stabilise < 0:
             logging.error(f"We've been trying to stabilise to <{self.stabilised_pixel_shift} pixels for >{self.n_images_to_stabilise} images")
-            logging.error("There appears to be an error, quiting donuts")
-            self.__send_donuts_message_to_voyager("DonutsRecenterError", "Failed to stabilise guiding")
-            sys.exit(ERROR_STABILISE)
+            logging.error("There appears to be an error, starting stabilisation again from the next image")
+            # the main thread tells Voyager, this thread never talks to it
+            self._images_to_stabilise = self.n_images_to_stabilise
+            self.__initialise_pid_loop(stabilised=False)
+            self.__initialise_guide_buffer()
+            raise DonutsRecenterError("Failed to stabilise guiding")
         else:
             pass
 
@@ -2081,9 +2575,9 @@ class Voyager():
                 # make a shift arguments tuple to store in the database
                 shift_args = (self._ref_file, self._latest_guide_frame, self._stabilised, shift_x, shift_y,
                               pre_pid_x, pre_pid_y, 0.0, 0.0, 0.0, 0.0, self._buff_x_sigma, self._buff_y_sigma,
-                              1, 1)
+                              1, 1, quality, 0)
                 # log the culled correction to the database
-                vdb.log_shifts_to_db(shift_args)
+                self.__log_shifts_to_db(shift_args)
 
                 # send back empty correction
                 direction, duration = self.__get_null_correction()
@@ -2104,9 +2598,9 @@ class Voyager():
         # make a shift arguments tuple to store in the database
         shift_args = (self._ref_file, self._latest_guide_frame, self._stabilised, shift_x, shift_y,
                       pre_pid_x, pre_pid_y, post_pid_x, post_pid_y, final_x, final_y, self._buff_x_sigma,
-                      self._buff_y_sigma, 0, 0)
+                      self._buff_y_sigma, 0, 0, quality, 0)
         # log the culled correction to the database
-        vdb.log_shifts_to_db(shift_args)
+        self.__log_shifts_to_db(shift_args)
 
         # convert correction into direction/duration objects
         direction, duration = self.__determine_direction_and_duration(final_x, final_y, cos_dec, xbin, ybin)
@@ -2117,6 +2611,54 @@ class Voyager():
 
         return direction, duration
 
+    def __log_shifts_to_db(self, shift_args):
+        """
+        Log a shift measurement to the database, timing the insert
+
+        Parameters
+        ----------
+        shift_args : tuple
+            see vdb.log_shifts_to_db
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        with self._frame_timer.stage("log_shifts"):
+            vdb.log_shifts_to_db(shift_args)
+
+    def __log_frame_timing(self, comp_image_path, result):
+        """
+        Stop the frame timer, log the stage times on
+        one line and store them in the database
+
+        Parameters
+        ----------
+        comp_image_path : string
+            path to the frame that was guided on
+        result : string
+            DonutsRecenterDone or DonutsRecenterError
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        self._frame_timer.stop()
+        logging.info(f"TIMING: {comp_image_path} {result} {self._frame_timer.summary()}")
+        try:
+            vdb.log_frame_timing_to_db(comp_image_path, result, self._frame_timer.total,
+                                       self._frame_timer.stages)
+        except Exception:
+            logging.exception("Failed to log frame timing to the database")
+
 def signal_handler(signum, frame):
     """
     Handle ctrl+c
@@ -2171,6 +2713,11 @@ if __name__ == "__main__":
             logging.fatal(f"Need calibration params {expected_fork_keys} for a FORK mount, exiting")
             sys.exit(ERROR_MOUNT_TYPE)
 
+    # sanity check the shift engine
+    if 'shift_engine' in config and config['shift_engine'] not in SHIFT_ENGINES:
+        logging.fatal(f"Parameter 'shift_engine' must be one of {list(SHIFT_ENGINES)}, exiting")
+        sys.exit(ERROR_SHIFT_ENGINE)
+
     # set up Voyager/Donuts
     voyager = Voyager(config)
     # run the script
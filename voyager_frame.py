@@ -0,0 +1,1031 @@
+"""
+Read each FITS frame from disc once and share it between
+the header checks, reference building and shift measurement
+
+Donuts normally takes filenames and opens them itself, so a
+guide frame used to be opened three times. PreloadedDonuts
+takes a Frame instead. The pixel data are memory mapped and
+astropy only parses the header cards we ask for
+
+FrameWatcher waits for a frame to be completely written
+before it is loaded, waking on inotify events where the
+platform has them and polling the file size otherwise
+
+ReferenceCache keeps recently used references in memory so
+switching back to a previous filter or field doesn't
+rebuild its reference from disc
+
+References can also be saved as a sidecar file next to the
+reference FITS holding just what donuts needs to measure
+shifts against it (the projections and trim region), so
+after a restart they are loaded instead of rebuilt
+
+ReferenceArchiver copies new references to long term storage
+in the background, so guiding never waits on the copy
+"""
+import os
+import glob
+import time
+import queue
+import shutil
+import select
+import threading
+import ctypes
+import ctypes.util
+import hashlib
+import logging
+import zipfile
+from collections import OrderedDict
+import numpy as np
+from astropy.io import fits
+import donuts
+from donuts import Donuts
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# pylint: disable=logging-fstring-interpolation
+# pylint: disable=broad-except
+
+# saved reference products live next to the reference FITS
+SIDECAR_SUFFIX = ".donuts.npz"
+# bump if the sidecar contents change
+SIDECAR_VERSION = 2
+
+# ioctl to share a file's blocks with another (btrfs, xfs etc)
+FICLONE = 0x40049409
+
+# FITS files are made of 2880 byte blocks of 80 byte cards
+FITS_BLOCK = 2880
+FITS_CARD = 80
+
+# inotify events that mean a file in the watched folder has grown or landed
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+def fits_primary_size(path):
+    """
+    Work out how long the file must be to hold the whole
+    primary HDU, from the cards up to END
+
+    Parameters
+    ----------
+    path : string
+        FITS file to check
+
+    Returns
+    -------
+    size : int or None
+        bytes needed for the primary header and data, or
+        None if the header is not complete yet
+
+    Raises
+    ------
+    OSError : When the file cannot be read
+    """
+    axes = {}
+    header_size = 0
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(FITS_BLOCK)
+            if len(block) < FITS_BLOCK:
+                return None
+            header_size += FITS_BLOCK
+            for i in range(0, FITS_BLOCK, FITS_CARD):
+                keyword = block[i:i+8].rstrip()
+                if keyword == b'END':
+                    if axes.get(b'NAXIS', 0) == 0:
+                        return header_size
+                    n_pixels = 1
+                    for axis in range(1, axes[b'NAXIS'] + 1):
+                        n_pixels *= axes.get(b'NAXIS%d' % axis, 0)
+                    return header_size + n_pixels * abs(axes.get(b'BITPIX', 8)) // 8
+                if keyword == b'BITPIX' or keyword.startswith(b'NAXIS'):
+                    try:
+                        axes[keyword] = int(block[i+10:i+FITS_CARD].split(b'/')[0])
+                    except ValueError:
+                        return None
+
+def frame_complete(path):
+    """
+    Check a FITS frame has its END card and all of its data
+
+    Parameters
+    ----------
+    path : string
+        FITS file to check
+
+    Returns
+    -------
+    complete : boolean
+        True if the primary HDU can be read in full
+
+    Raises
+    ------
+    None
+    """
+    try:
+        size = fits_primary_size(path)
+        return size is not None and os.path.getsize(path) >= size
+    except OSError:
+        return False
+
+class _Inotify():
+    """
+    Minimal inotify watch on one folder through libc. Only used
+    to wake up early, so every failure falls back to polling
+    """
+    def __init__(self):
+        """
+        Create the inotify instance
+
+        Parameters
+        ----------
+        None
+
+        Raises
+        ------
+        OSError : When inotify is not available
+        """
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("libc not found")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError("inotify not available")
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.folder = None
+        self._wd = None
+
+    def watch(self, folder):
+        """
+        Move the watch to a folder, if it isn't there already
+
+        Parameters
+        ----------
+        folder : string
+            folder the frames are written to
+
+        Returns
+        -------
+        watching : boolean
+            True if the folder is being watched
+
+        Raises
+        ------
+        None
+        """
+        if folder == self.folder:
+            return True
+        if self._wd is not None:
+            self._libc.inotify_rm_watch(self.fd, self._wd)
+            self._wd = None
+            self.folder = None
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(folder), mask)
+        if wd < 0:
+            return False
+        self._wd = wd
+        self.folder = folder
+        return True
+
+    def wait(self, timeout):
+        """
+        Wait up to timeout seconds for any event in the folder
+
+        Parameters
+        ----------
+        timeout : float
+            seconds to wait
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            # we only care that something happened, throw the events away
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except (BlockingIOError, OSError):
+                pass
+
+    def close(self):
+        """
+        Close the inotify instance
+        """
+        os.close(self.fd)
+
+class FrameWatcher():
+    """
+    Wait for frames to be completely written to disc
+    """
+    def __init__(self, timeout=5.0, poll_interval=0.05, use_inotify=True):
+        """
+        Parameters
+        ----------
+        timeout : float, optional
+            longest to wait for a frame in seconds
+            default = 5.0
+        poll_interval : float, optional
+            seconds between size checks. Also caps how long
+            we wait on inotify, as events don't cross some
+            network and Docker Desktop mounts
+            default = 0.05
+        use_inotify : boolean, optional
+            wake on inotify events where available
+            default = True
+        """
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._inotify = None
+        if use_inotify:
+            try:
+                self._inotify = _Inotify()
+            except OSError:
+                logging.info("inotify not available, polling for new frames")
+
+    def wait(self, path):
+        """
+        Block until the frame is complete or the timeout expires
+
+        Parameters
+        ----------
+        path : string
+            FITS file to wait for
+
+        Returns
+        -------
+        ready : boolean
+            True if the frame is complete, False if we gave up
+
+        Raises
+        ------
+        None
+        """
+        deadline = time.monotonic() + self.timeout
+        watching = self._inotify is not None and \
+            self._inotify.watch(os.path.dirname(os.path.abspath(path)))
+        while True:
+            # cheap, only the header blocks are read
+            if frame_complete(path):
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if watching:
+                self._inotify.wait(min(remaining, self.poll_interval))
+            else:
+                time.sleep(min(remaining, self.poll_interval))
+
+    def close(self):
+        """
+        Stop watching
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+class Frame():
+    """
+    A FITS frame loaded from disc
+    """
+    def __init__(self, path, data, header):
+        """
+        Parameters
+        ----------
+        path : string
+            where the frame was loaded from
+        data : array
+            image data, memory mapped where possible
+        header : astropy.io.fits.Header
+            primary header of the frame
+        """
+        self.path = path
+        self.data = data
+        self.header = header
+
+    def __getitem__(self, keyword):
+        """
+        Look up a header keyword
+        """
+        return self.header[keyword]
+
+def load_frame(path, memmap=True):
+    """
+    Open a FITS frame once, keeping the primary header and data
+
+    Parameters
+    ----------
+    path : string
+        FITS file to load
+    memmap : boolean, optional
+        memory map the data rather than reading it in. This only
+        helps unscaled frames, scaled data (BZERO/BSCALE, e.g.
+        unsigned 16 bit cameras) is read into a scaled copy anyway
+        default = True
+
+    Returns
+    -------
+    frame : Frame
+        the loaded frame
+
+    Raises
+    ------
+    OSError : When the file cannot be read
+    """
+    # astropy keeps the memory map open for as long as the data array is alive
+    # pylint: disable=no-member
+    # memmap=True makes astropy refuse scaled data outright, None
+    # memory maps where it can and scales a copy otherwise
+    with fits.open(path, memmap=None if memmap else False, ignore_missing_end=True) as hdulist:
+        hdu = hdulist[0]
+        header = hdu.header
+        data = hdu.data
+    # pylint: enable=no-member
+    return Frame(path, data, header)
+
+class PreloadedDonuts(Donuts):
+    """
+    Donuts that builds its images from Frames already in
+    memory instead of opening the files again. Filenames
+    still work and are loaded with load_frame
+
+    If given a sidecar path the reference is loaded from
+    it when it matches, otherwise it is built as normal
+    and saved there for next time
+
+    If given a background estimator (voyager_background) it
+    replaces donuts' own background subtraction
+    """
+    def __init__(self, refimage, sidecar=None, background=None, **kwargs):
+        """
+        Build the reference image
+
+        Parameters
+        ----------
+        refimage : Frame or string
+            the reference frame or path to it
+        sidecar : string, optional
+            where to load/save the prepared reference
+            default = None, always build it
+        background : MeshBackground, optional
+            background to subtract when subtract_bkg is set
+            default = None, use donuts' tiled median background
+        kwargs : dict
+            see donuts.Donuts
+        """
+        self.sidecar = sidecar
+        self.background = background
+        self.sidecar_loaded = False
+        self._building_reference = True
+        super().__init__(refimage, **kwargs)
+        self._building_reference = False
+        # Donuts stores whatever it was given, keep the path for logging etc
+        if isinstance(refimage, Frame):
+            self.refimage_filename = refimage.path
+
+    @property
+    def nbytes(self):
+        """
+        Estimate the memory held by the reference, for ReferenceCache
+        """
+        arrays = list(vars(self.reference_image).values())
+        arrays.append(self.image_pixel_mask)
+        nbytes = 0
+        for array in arrays:
+            if isinstance(array, np.ndarray):
+                nbytes += array.nbytes
+                if isinstance(array, np.ma.MaskedArray) and array.mask is not np.ma.nomask:
+                    nbytes += array.mask.nbytes
+        return nbytes
+
+    def save_sidecar(self, sidecar, ref_path):
+        """
+        Save the built reference as a sidecar for another copy
+        of its FITS file, e.g. once a new reference built from
+        a data frame has been archived
+
+        Parameters
+        ----------
+        sidecar : string
+            where to save the prepared reference
+        ref_path : string
+            FITS file the sidecar is tied to
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        self.sidecar = sidecar
+        self.__save_sidecar(self.reference_image, ref_path)
+
+    def __settings_digest(self):
+        """
+        Hash of everything that changes how a reference is built
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        digest : string
+            hex digest of the donuts settings and pixel mask
+
+        Raises
+        ------
+        None
+        """
+        settings = (SIDECAR_VERSION, getattr(donuts, "__version__", None),
+                    self.image_class.__name__, self.image_ext, self.ntiles,
+                    self.exposure_keyname, self.normalise, self.subtract_bkg,
+                    self.downweight_edges, self.prescan_width, self.overscan_width,
+                    self.scan_direction, self.border)
+        if self.background is not None:
+            settings += (repr(self.background), )
+        digest = hashlib.sha256(repr(settings).encode())
+        if self.image_pixel_mask is not None:
+            mask = np.asarray(self.image_pixel_mask, dtype=bool)
+            digest.update(repr(mask.shape).encode())
+            digest.update(np.packbits(mask).tobytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def __checksum(arrays):
+        """
+        Checksum the contents of a sidecar
+
+        Parameters
+        ----------
+        arrays : dict
+            sidecar arrays, excluding the checksum
+
+        Returns
+        -------
+        checksum : string
+            sha256 hex digest of the arrays
+
+        Raises
+        ------
+        None
+        """
+        digest = hashlib.sha256()
+        for name in sorted(arrays):
+            digest.update(name.encode())
+            digest.update(np.ascontiguousarray(arrays[name]).tobytes())
+        return digest.hexdigest()
+
+    def __save_sidecar(self, image, ref_path):
+        """
+        Save the prepared reference next to its FITS file
+
+        Parameters
+        ----------
+        image : image_class instance
+            the built reference
+        ref_path : string
+            FITS file the reference was built from
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        # write then move into place so a crash never leaves half a sidecar
+        tmp_path = f"{self.sidecar}.tmp"
+        try:
+            # tie the sidecar to this version of the FITS file
+            ref_stat = os.stat(ref_path)
+            arrays = {"proj_x": np.ma.getdata(image.proj_x),
+                      "proj_x_mask": np.ma.getmaskarray(image.proj_x),
+                      "proj_y": np.ma.getdata(image.proj_y),
+                      "proj_y_mask": np.ma.getmaskarray(image.proj_y),
+                      "geometry": np.array([self.image_cly, self.image_cuy,
+                                            self.image_clx, self.image_cux]),
+                      "ref_size": np.array(ref_stat.st_size),
+                      "ref_mtime": np.array(ref_stat.st_mtime_ns),
+                      "settings": np.array(self.__settings_digest())}
+            arrays["checksum"] = np.array(self.__checksum(arrays))
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, self.sidecar)
+        except OSError:
+            logging.warning(f"Failed to save reference sidecar {self.sidecar}")
+
+    def __load_sidecar(self, ref_path):
+        """
+        Load the prepared reference, if the sidecar is intact
+        and was made from this file with these settings
+
+        Parameters
+        ----------
+        ref_path : string
+            FITS file the reference is for
+
+        Returns
+        -------
+        image : image_class instance or None
+            the reference, ready for shift calculations, or
+            None if it has to be built
+
+        Raises
+        ------
+        None
+        """
+        try:
+            with np.load(self.sidecar, allow_pickle=False) as npz:
+                arrays = {name: npz[name] for name in npz.files}
+            checksum = str(arrays.pop("checksum"))
+            ref_stat = os.stat(ref_path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            logging.warning(f"Unreadable reference sidecar {self.sidecar}, rebuilding")
+            return None
+        if checksum != self.__checksum(arrays):
+            logging.warning(f"Reference sidecar {self.sidecar} failed its checksum, rebuilding")
+            return None
+        if str(arrays["settings"]) != self.__settings_digest() or \
+            int(arrays["ref_size"]) != ref_stat.st_size or \
+            int(arrays["ref_mtime"]) != ref_stat.st_mtime_ns:
+            logging.info(f"Reference sidecar {self.sidecar} is out of date, rebuilding")
+            return None
+
+        # the reference only needs its projections to measure shifts against
+        image = self.image_class(np.ma.array(np.zeros((0, 0))))
+        image.proj_x = np.ma.array(arrays["proj_x"], mask=arrays["proj_x_mask"])
+        image.proj_y = np.ma.array(arrays["proj_y"], mask=arrays["proj_y_mask"])
+        cly, cuy, clx, cux = (int(corner) for corner in arrays["geometry"])
+        self.image_cly = cly
+        self.image_cuy = cuy
+        self.image_clx = clx
+        self.image_cux = cux
+        self.image_geometry_set = True
+        self.sidecar_loaded = True
+        return image
+
+    def construct_object(self, filename):
+        """
+        Build an image_class instance from a Frame. This
+        mirrors Donuts.construct_object in donuts 0.3.5
+        apart from where the data come from
+
+        Parameters
+        ----------
+        filename : Frame or string
+            the frame or path to it
+
+        Returns
+        -------
+        image : image_class instance
+            processed image, ready for shift calculations
+
+        Raises
+        ------
+        ValueError : When the mask and image shapes differ
+        """
+        use_sidecar = self._building_reference and self.sidecar is not None
+        ref_path = filename.path if isinstance(filename, Frame) else filename
+        if use_sidecar:
+            image = self.__load_sidecar(ref_path)
+            if image is not None:
+                return image
+
+        frame = filename if isinstance(filename, Frame) else load_frame(filename)
+        if self.image_ext != 0:
+            raise ValueError("PreloadedDonuts only supports the primary HDU")
+        try:
+            masked_image = np.ma.array(frame.data, mask=self.image_pixel_mask, fill_value=0)
+        except np.ma.core.MaskError as err:
+            raise ValueError(f"Wrong mask shape for image {frame.path}, image: {frame.data.shape} "
+                             f"mask: {np.shape(self.image_pixel_mask)}") from err
+
+        image = self.image_class(masked_image, frame.header)
+        image.preconstruct_hook()
+
+        if not self.image_geometry_set:
+            cly, cuy, clx, cux = image.calculate_image_geometry(prescan_width=self.prescan_width,
+                                                                overscan_width=self.overscan_width,
+                                                                scan_direction=self.scan_direction,
+                                                                border=self.border,
+                                                                ntiles=self.ntiles)
+            self.image_cly = cly
+            self.image_cuy = cuy
+            self.image_clx = clx
+            self.image_cux = cux
+            self.image_geometry_set = True
+
+        image.trim(self.image_cly, self.image_cuy, self.image_clx, self.image_cux)
+        if self.normalise and not (self.subtract_bkg and self.background is not None):
+            image.normalise(exposure_keyword=self.exposure_keyname)
+        if self.subtract_bkg and self.background is not None:
+            self.__subtract_mesh_background(image)
+            if self.downweight_edges:
+                image.downweight_edges()
+        elif self.subtract_bkg:
+            image.remove_background(ntiles=self.ntiles)
+            if self.downweight_edges:
+                image.downweight_edges()
+        image.postconstruct_hook()
+        image.compute_projections()
+        if use_sidecar:
+            self.__save_sidecar(image, ref_path)
+        return image
+
+    def __subtract_mesh_background(self, image):
+        """
+        Normalise and background subtract the trimmed region
+        in place on one float32 copy, in place of donuts'
+        normalise and remove_background which each make
+        full frame float64 copies
+
+        Parameters
+        ----------
+        image : image_class instance
+            trimmed image, backsub_region is set
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        region = np.ma.array(image.raw_region, dtype=np.float32, copy=True)
+        if self.normalise:
+            try:
+                image.exposure_time_value = image.header[self.exposure_keyname]
+            except KeyError:
+                logging.warning(f"Exposure time keyword {self.exposure_keyname} not found, assuming 1.0")
+                image.exposure_time_value = 1.0
+            np.divide(region.data, image.exposure_time_value, out=region.data)
+        self.background.subtract(region.data, np.ma.getmask(region))
+        image.backsub_region = region
+
+    def measure_shift(self, checkimage_filename):
+        """
+        Measure the shift of a frame from the reference. This
+        mirrors Donuts.measure_shift and Image.compute_offset in
+        donuts 0.3.5, keeping the cross correlations long enough
+        to say how confident the shift is
+
+        Parameters
+        ----------
+        checkimage_filename : Frame or string
+            the frame or path to it
+
+        Returns
+        -------
+        image : image_class instance
+            with x and y shifts, as from donuts, and quality,
+            the height of the weaker of the x and y correlation
+            peaks above the rest of the correlation in standard
+            deviations. Clouds etc give low values
+
+        Raises
+        ------
+        None
+        """
+        checkimage = self.construct_object(checkimage_filename)
+        # pylint: disable=protected-access
+        self.reference_image._assert_projections()
+        checkimage._assert_projections()
+        z_pos_x, z_pos_y, phi_x, phi_y = checkimage._cross_correlate(self.reference_image)
+        checkimage.x = checkimage._find_solution(z_pos_x, phi_x)
+        checkimage.y = checkimage._find_solution(z_pos_y, phi_y)
+        # pylint: enable=protected-access
+        checkimage.quality = min(self.__peak_to_noise(phi_x), self.__peak_to_noise(phi_y))
+        return checkimage
+
+    @staticmethod
+    def __peak_to_noise(correlation):
+        """
+        Height of a correlation peak above the mean in standard deviations
+        """
+        correlation = np.real(correlation)
+        std = correlation.std()
+        if std == 0:
+            return 0.
+        return float((correlation.max() - correlation.mean()) / std)
+
+class ReferenceCache():
+    """
+    Least recently used cache of built references (shift engines),
+    keyed by the observing configuration that selects a reference
+    in the database (field, filter, binning, subframe, flip status)
+    """
+    def __init__(self, max_entries=8, max_mb=512):
+        """
+        Parameters
+        ----------
+        max_entries : int, optional
+            most references to keep, 0 disables the cache
+            default = 8
+        max_mb : float, optional
+            most memory in MB the cached references may use. The
+            most recent reference is always kept
+            default = 512
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_mb * 1024 * 1024
+        self.nbytes = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        """
+        Number of cached references
+        """
+        return len(self._entries)
+
+    def get(self, key, ref_path):
+        """
+        Fetch a reference, if we have it built for this path
+
+        Parameters
+        ----------
+        key : tuple
+            observing configuration the reference is for
+        ref_path : string
+            reference path from the database. A cached reference
+            built from a different file is stale and dropped
+
+        Returns
+        -------
+        donuts_ref : Donuts or None
+            the built reference, None if not cached
+
+        Raises
+        ------
+        None
+        """
+        try:
+            cached_path, donuts_ref, nbytes = self._entries[key]
+        except KeyError:
+            return None
+        if cached_path != ref_path:
+            del self._entries[key]
+            self.nbytes -= nbytes
+            return None
+        self._entries.move_to_end(key)
+        return donuts_ref
+
+    def put(self, key, ref_path, donuts_ref):
+        """
+        Store a reference, evicting the least recently used
+        ones if we are over the size or memory limits
+
+        Parameters
+        ----------
+        key : tuple
+            observing configuration the reference is for
+        ref_path : string
+            path the reference was built from
+        donuts_ref : PreloadedDonuts or other shift engine
+            the built reference, with an nbytes estimate
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        if self.max_entries <= 0:
+            return
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)[2]
+        nbytes = donuts_ref.nbytes
+        self._entries[key] = (ref_path, donuts_ref, nbytes)
+        self.nbytes += nbytes
+        while len(self._entries) > 1 and \
+            (len(self._entries) > self.max_entries or self.nbytes > self.max_bytes):
+            evicted, (_, _, evicted_nbytes) = self._entries.popitem(last=False)
+            self.nbytes -= evicted_nbytes
+            logging.debug(f"Evicted reference for {evicted} from the cache")
+
+def remove_sidecars(ref_path):
+    """
+    Delete every sidecar saved for a reference, including
+    those for software binned or cropped versions of it
+
+    Parameters
+    ----------
+    ref_path : string
+        reference FITS file
+
+    Returns
+    -------
+    removed : list
+        paths of the sidecars deleted
+
+    Raises
+    ------
+    None
+    """
+    # software binned/cropped sidecars are <reference>.<tag>.donuts.npz
+    candidates = [f"{ref_path}{SIDECAR_SUFFIX}"] + \
+        glob.glob(f"{glob.escape(ref_path)}.*{SIDECAR_SUFFIX}")
+    removed = []
+    for sidecar in candidates:
+        try:
+            os.remove(sidecar)
+            removed.append(sidecar)
+        except FileNotFoundError:
+            pass
+    return removed
+
+def archive_file(src, dst):
+    """
+    Put a copy of src at dst as cheaply as the filesystem
+    allows. A hardlink if both are on the same filesystem,
+    then a reflink, then a plain copy. dst only ever
+    appears complete, and always keeps the source's
+    modification time, so anything keyed on the file's
+    stat (e.g. sidecars) sees the same file whichever
+    method was used
+
+    Parameters
+    ----------
+    src : string
+        file to archive
+    dst : string
+        where to archive it to, replaced if it exists
+
+    Returns
+    -------
+    method : string
+        "hardlink", "reflink" or "copy"
+
+    Raises
+    ------
+    OSError : When the file cannot be copied
+    """
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except OSError:
+        pass
+
+    tmp_path = f"{dst}.tmp"
+    method = "copy"
+    try:
+        if fcntl is None:
+            raise OSError("reflinks not supported")
+        with open(src, 'rb') as fsrc, open(tmp_path, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        method = "reflink"
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    # a new inode gets a new mtime, put the source's back
+    src_stat = os.stat(src)
+    os.utime(tmp_path, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+    os.replace(tmp_path, dst)
+    return method
+
+class ReferenceArchiver():
+    """
+    Archive new reference images on a background thread,
+    one at a time, then run a callback (e.g. to record
+    them in the database)
+    """
+    def __init__(self):
+        """
+        Start the archiving thread
+
+        Parameters
+        ----------
+        None
+        """
+        self._queue = queue.Queue()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self.__run, daemon=True)
+        self._thread.start()
+
+    def archive(self, key, src, dst, on_done=None):
+        """
+        Queue a reference for archiving
+
+        Parameters
+        ----------
+        key : tuple
+            observing configuration the reference is for
+        src : string
+            the new reference image
+        dst : string
+            where it is stored long term
+        on_done : callable, optional
+            called with no arguments once dst is complete
+            default = None
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        with self._lock:
+            self._pending[key] = (src, dst)
+        self._queue.put((key, src, dst, on_done))
+
+    def pending(self, key):
+        """
+        Find a reference still waiting to be archived
+
+        Parameters
+        ----------
+        key : tuple
+            observing configuration to look for
+
+        Returns
+        -------
+        paths : tuple or None
+            (src, dst) of the reference, None if nothing is pending
+
+        Raises
+        ------
+        None
+        """
+        with self._lock:
+            return self._pending.get(key)
+
+    def wait(self, timeout=None):
+        """
+        Wait for everything queued so far to be archived
+
+        Parameters
+        ----------
+        timeout : float, optional
+            longest to wait in seconds
+            default = None, wait forever
+
+        Returns
+        -------
+        done : boolean
+            True if nothing is left to archive
+
+        Raises
+        ------
+        None
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def __run(self):
+        """
+        Archive queued references forever
+        """
+        while True:
+            key, src, dst, on_done = self._queue.get()
+            try:
+                t_start = time.monotonic()
+                method = archive_file(src, dst)
+                logging.info(f"Archived reference {src} to {dst} by {method} "
+                             f"in {time.monotonic() - t_start:.2f} s")
+                if on_done is not None:
+                    on_done()
+            except Exception:
+                logging.exception(f"Failed to archive reference {src} to {dst}")
+            finally:
+                with self._lock:
+                    if self._pending.get(key) == (src, dst):
+                        del self._pending[key]
+                self._queue.task_done()
@@ -0,0 +1,597 @@
+"""
+Shift engines measure the offset of a frame from a reference
+
+An engine is built from the reference (a Frame or path) and
+has a measure_shift(frame) method returning an object with
+x and y astropy quantities in pixels, using the donuts sign
+convention (the shift to apply to get back to the reference).
+Voyager picks one by name from SHIFT_ENGINES with the
+shift_engine config parameter
+
+   donuts : PreloadedDonuts, projections cross correlated
+   phase  : PhaseCorrelation, 2D (partially whitened) phase
+            correlation against a reference spectrum computed once
+   tiled  : TiledShift, phase correlation of tiles or regions
+            of interest in parallel, combined robustly
+
+Extra engine options come from shift_engine_options in the config.
+Any engine can be wrapped in SoftwareBinned to crop and/or bin
+frames in memory before measuring, see software_binning and
+software_crop in the config
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from astropy import units as u
+from scipy import fft
+from voyager_frame import Frame, load_frame, PreloadedDonuts, SIDECAR_SUFFIX
+import voyager_utils as vutils
+
+# pylint: disable=logging-fstring-interpolation
+
+class ShiftResult():
+    """
+    Shift measured by an engine, quacks like donuts.image.Image
+    """
+    def __init__(self, x, y, quality=None):
+        """
+        Parameters
+        ----------
+        x : float
+            shift in x, pixels
+        y : float
+            shift in y, pixels
+        quality : float, optional
+            height of the correlation peak above the
+            noise, in standard deviations
+            default = None
+        """
+        self.x = x * u.pixel
+        self.y = y * u.pixel
+        self.quality = quality
+
+class PhaseCorrelation():
+    """
+    Measure shifts by phase correlation of the whole frame.
+    The reference spectrum is computed once, so each frame
+    costs one forward real FFT, a product and an inverse FFT
+
+    The cross power spectrum is only partly whitened (divided
+    by |cross power|**whitening). Full whitening gives a one
+    pixel wide peak which no three point fit can place to
+    better than a few hundredths of a pixel, a half whitened
+    peak is close to gaussian and fits far better
+    """
+    def __init__(self, refimage, image_pixel_mask=None, whitening=0.5, workers=-1, background=None,
+                 **kwargs):
+        """
+        Prepare the reference spectrum
+
+        Parameters
+        ----------
+        refimage : Frame or string
+            the reference frame or path to it
+        image_pixel_mask : array, optional
+            boolean mask of pixels to ignore
+            default = None
+        whitening : float, optional
+            0 is plain cross correlation, 1 pure phase correlation
+            default = 0.5
+        workers : int, optional
+            threads for the FFTs, -1 for all cores
+            default = -1
+        background : MeshBackground, optional
+            background to subtract instead of the median sky
+            default = None
+        kwargs : dict
+            other engine options (e.g. sidecar, subtract_bkg)
+            this engine ignores. The sky is always removed,
+            otherwise the tapered sky correlates with itself at zero shift
+        """
+        del kwargs
+        self.image_pixel_mask = image_pixel_mask
+        self.background = background
+        self.whitening = whitening
+        self.workers = workers
+        self.sidecar_loaded = False
+        ref_frame = refimage if isinstance(refimage, Frame) else load_frame(refimage)
+        self.refimage_filename = ref_frame.path
+        region = self.__prepare(ref_frame.data)
+        self.shape = region.shape
+        # taper the edges so the frame boundary doesn't correlate with itself
+        self._window = np.outer(np.hanning(self.shape[0]),
+                                np.hanning(self.shape[1])).astype(np.float32)
+        self._ref_spectrum_conj = np.conj(fft.rfft2(region * self._window, workers=workers))
+
+    @property
+    def nbytes(self):
+        """
+        Memory held by the reference, for ReferenceCache
+        """
+        nbytes = self._ref_spectrum_conj.nbytes + self._window.nbytes
+        if self.image_pixel_mask is not None:
+            nbytes += np.asarray(self.image_pixel_mask).nbytes
+        return nbytes
+
+    def save_sidecar(self, sidecar, ref_path):
+        """
+        Nothing to save, this engine always builds its reference
+        """
+        del sidecar, ref_path
+
+    def __prepare(self, data):
+        """
+        Sky subtract and fill masked pixels
+
+        Parameters
+        ----------
+        data : array
+            image data
+
+        Returns
+        -------
+        region : array
+            float32 image ready to transform
+
+        Raises
+        ------
+        ValueError : When the mask and image shapes differ
+        """
+        region = np.array(data, dtype=np.float32)
+        mask = None
+        if self.image_pixel_mask is not None:
+            mask = np.asarray(self.image_pixel_mask, dtype=bool)
+            if mask.shape != region.shape:
+                raise ValueError(f"Wrong mask shape, image: {region.shape} mask: {mask.shape}")
+        if self.background is not None:
+            self.background.subtract(region, mask)
+            if mask is not None:
+                region[mask] = 0
+            return region
+        if mask is not None:
+            # a sparse sample is plenty for the sky level
+            sky = np.median(region[::4, ::4][~mask[::4, ::4]])
+            region[mask] = sky
+        else:
+            sky = np.median(region[::4, ::4])
+        region -= sky
+        return region
+
+    @staticmethod
+    def __refine_peak(minus, peak, plus):
+        """
+        Sub-pixel offset of a peak from a gaussian through
+        it and its neighbours (a parabola through their logs).
+        Falls back to a parabola if the neighbours aren't positive
+
+        Parameters
+        ----------
+        minus, peak, plus : float
+            correlation either side of and at the peak
+
+        Returns
+        -------
+        offset : float
+            offset from the peak pixel, between -0.5 and 0.5
+
+        Raises
+        ------
+        None
+        """
+        if minus > 0 and plus > 0:
+            minus, peak, plus = np.log(minus), np.log(peak), np.log(plus)
+        denominator = minus - 2 * peak + plus
+        if denominator == 0:
+            return 0.
+        return float(np.clip(0.5 * (minus - plus) / denominator, -0.5, 0.5))
+
+    def measure_shift(self, checkimage):
+        """
+        Measure the shift of a frame from the reference
+
+        Parameters
+        ----------
+        checkimage : Frame or string
+            frame to measure or path to it
+
+        Returns
+        -------
+        shift : ShiftResult
+            x and y shift to apply to the frame to match the reference
+
+        Raises
+        ------
+        ValueError : When the frame is a different shape to the reference
+        """
+        frame = checkimage if isinstance(checkimage, Frame) else load_frame(checkimage)
+        region = self.__prepare(frame.data)
+        if region.shape != self.shape:
+            raise ValueError(f"Frame {frame.path} is {region.shape}, reference is {self.shape}")
+        spectrum = fft.rfft2(region * self._window, workers=self.workers)
+        cross_power = spectrum * self._ref_spectrum_conj
+        if self.whitening == 1:
+            cross_power /= np.abs(cross_power) + np.finfo(np.float32).tiny
+        elif self.whitening > 0:
+            cross_power /= (np.abs(cross_power) + np.finfo(np.float32).tiny)**self.whitening
+        correlation = fft.irfft2(cross_power, s=self.shape, workers=self.workers)
+
+        ny, nx = self.shape
+        py, px = np.unravel_index(np.argmax(correlation), self.shape)
+        dx = px + self.__refine_peak(correlation[py, (px - 1) % nx], correlation[py, px],
+                                     correlation[py, (px + 1) % nx])
+        dy = py + self.__refine_peak(correlation[(py - 1) % ny, px], correlation[py, px],
+                                     correlation[(py + 1) % ny, px])
+        # the correlation wraps, peaks past half way are negative shifts
+        if dx > nx / 2:
+            dx -= nx
+        if dy > ny / 2:
+            dy -= ny
+        # a blank frame (or reference) has a flat correlation and no peak at all
+        std = correlation.std()
+        quality = float((correlation[py, px] - correlation.mean()) / std) if std > 0 else 0.
+        # the peak is where the frame has moved to, donuts reports the way back
+        return ShiftResult(-dx, -dy, quality)
+
+class TiledShift():
+    """
+    Measure shifts in several tiles or regions of interest
+    at once and combine them, so one bright star or a
+    gradient can't drag the whole measurement. Each tile
+    is phase correlated on a shared thread pool (the FFTs
+    release the GIL). Tiles far from the median shift are
+    rejected, the rest averaged weighted by peak quality
+    """
+    _pool = None
+    _pool_lock = threading.Lock()
+
+    def __init__(self, refimage, image_pixel_mask=None, tiles=(3, 3), regions=None,
+                 n_sigma=3.0, min_tolerance=0.5, **kwargs):
+        """
+        Prepare a phase correlation reference per tile
+
+        Parameters
+        ----------
+        refimage : Frame or string
+            the reference frame or path to it
+        image_pixel_mask : array, optional
+            boolean mask of pixels to ignore
+            default = None
+        tiles : tuple, optional
+            (nx, ny) grid of tiles covering the frame
+            default = (3, 3)
+        regions : list, optional
+            [x0, y0, width, height] regions of interest in
+            frame pixels, used instead of the tile grid
+            default = None
+        n_sigma : float, optional
+            reject tiles further than this many robust standard
+            deviations from the median shift
+            default = 3
+        min_tolerance : float, optional
+            never reject tiles within this many pixels of the median
+            default = 0.5
+        kwargs : dict
+            options for PhaseCorrelation, others are ignored
+        """
+        self.image_pixel_mask = image_pixel_mask
+        self.n_sigma = n_sigma
+        self.min_tolerance = min_tolerance
+        self.sidecar_loaded = False
+        ref_frame = refimage if isinstance(refimage, Frame) else load_frame(refimage)
+        self.refimage_filename = ref_frame.path
+        self.shape = ref_frame.data.shape
+        self.regions = self.__slices(self.shape, tiles, regions)
+        if not self.regions:
+            raise ValueError(f"No tiles or regions inside the {self.shape} frame")
+        whitening = kwargs.get('whitening', 0.5)
+        background = kwargs.get('background')
+
+        def build(region):
+            ys, xs = region
+            mask = None if image_pixel_mask is None else np.asarray(image_pixel_mask)[ys, xs]
+            tile = Frame(ref_frame.path, ref_frame.data[ys, xs], ref_frame.header)
+            return PhaseCorrelation(tile, image_pixel_mask=mask, whitening=whitening, workers=1,
+                                    background=background)
+        self._engines = list(self.pool().map(build, self.regions))
+
+    @classmethod
+    def pool(cls):
+        """
+        Thread pool shared by all tiled engines, so cached
+        references don't each hold their own threads
+        """
+        with cls._pool_lock:
+            if cls._pool is None:
+                cls._pool = ThreadPoolExecutor(thread_name_prefix="tiles")
+            return cls._pool
+
+    @staticmethod
+    def __slices(shape, tiles, regions):
+        """
+        Work out the array slices to measure
+
+        Parameters
+        ----------
+        shape : tuple
+            (ny, nx) of the frame
+        tiles : tuple
+            (nx, ny) grid of tiles
+        regions : list or None
+            [x0, y0, width, height] regions, clipped to the frame
+
+        Returns
+        -------
+        slices : list
+            (y slice, x slice) per tile
+
+        Raises
+        ------
+        None
+        """
+        ny, nx = shape
+        slices = []
+        if regions:
+            for x0, y0, width, height in regions:
+                x0, y0 = max(int(x0), 0), max(int(y0), 0)
+                x1, y1 = min(x0 + int(width), nx), min(y0 + int(height), ny)
+                # too small to correlate, e.g. off the edge of a subframe
+                if x1 - x0 >= 16 and y1 - y0 >= 16:
+                    slices.append((slice(y0, y1), slice(x0, x1)))
+        else:
+            n_tiles_x, n_tiles_y = tiles
+            x_edges = np.linspace(0, nx, n_tiles_x + 1).astype(int)
+            y_edges = np.linspace(0, ny, n_tiles_y + 1).astype(int)
+            for y0, y1 in zip(y_edges[:-1], y_edges[1:]):
+                for x0, x1 in zip(x_edges[:-1], x_edges[1:]):
+                    slices.append((slice(y0, y1), slice(x0, x1)))
+        return slices
+
+    @property
+    def nbytes(self):
+        """
+        Memory held by the tile references, for ReferenceCache
+        """
+        return sum(engine.nbytes for engine in self._engines)
+
+    def save_sidecar(self, sidecar, ref_path):
+        """
+        Nothing to save, this engine always builds its reference
+        """
+        del sidecar, ref_path
+
+    def measure_shift(self, checkimage):
+        """
+        Measure every tile and combine the shifts
+
+        Parameters
+        ----------
+        checkimage : Frame or string
+            frame to measure or path to it
+
+        Returns
+        -------
+        shift : ShiftResult
+            combined x and y shift, quality is the median
+            of the tiles that were kept
+
+        Raises
+        ------
+        ValueError : When the frame is a different shape to the reference
+        """
+        frame = checkimage if isinstance(checkimage, Frame) else load_frame(checkimage)
+        if frame.data.shape != self.shape:
+            raise ValueError(f"Frame {frame.path} is {frame.data.shape}, reference is {self.shape}")
+
+        def measure(args):
+            engine, (ys, xs) = args
+            return engine.measure_shift(Frame(frame.path, frame.data[ys, xs], frame.header))
+        tile_shifts = list(self.pool().map(measure, zip(self._engines, self.regions)))
+
+        dx = np.array([shift.x.value for shift in tile_shifts])
+        dy = np.array([shift.y.value for shift in tile_shifts])
+        weights = np.clip([shift.quality for shift in tile_shifts], 0, None)
+        # reject tiles far from the median, using the MAD as a robust sigma
+        distance = np.hypot(dx - np.median(dx), dy - np.median(dy))
+        tolerance = max(self.n_sigma * 1.4826 * np.median(distance), self.min_tolerance)
+        keep = distance <= tolerance
+        if weights[keep].sum() > 0:
+            x = np.average(dx[keep], weights=weights[keep])
+            y = np.average(dy[keep], weights=weights[keep])
+        else:
+            x, y = np.median(dx[keep]), np.median(dy[keep])
+
+        rejected = [f"{i}:({dx[i]:.2f},{dy[i]:.2f})" for i in np.flatnonzero(~keep)]
+        logging.info(f"TILES: kept {keep.sum()}/{len(keep)} tolerance {tolerance:.2f} pix "
+                     f"weights [{' '.join(f'{weight:.1f}' for weight in weights)}] "
+                     f"rejected [{' '.join(rejected)}]")
+        return ShiftResult(x, y, float(np.median(weights[keep])))
+
+class SoftwareBinned():
+    """
+    Crop and/or bin frames in memory before another engine
+    measures them, so large unbinned science frames guide as
+    fast as hardware binned ones. The engine's shifts are in
+    binned pixels, they are scaled back to frame pixels here
+    so the PID loop and pulse guide calibration are unaffected
+    """
+    def __init__(self, engine_class, refimage, sidecar=None, image_pixel_mask=None,
+                 binning=(1, 1), crop=None, **kwargs):
+        """
+        Crop and bin the reference and build the engine from it
+
+        Parameters
+        ----------
+        engine_class : class
+            shift engine to measure the binned frames,
+            e.g. from SHIFT_ENGINES
+        refimage : Frame or string
+            the reference frame or path to it
+        sidecar : string, optional
+            where the engine loads/saves a prepared reference.
+            The binning and crop are added to the name so it
+            doesn't clash with an unbinned reference
+            default = None
+        image_pixel_mask : array, optional
+            boolean mask of frame pixels to ignore, cropped
+            and binned with the frame
+            default = None
+        binning : int or tuple, optional
+            (xbin, ybin) block summed in software
+            default = (1, 1)
+        crop : list, optional
+            [x0, y0, width, height] in frame pixels to keep,
+            clipped to the frame. Applied before binning
+            default = None, the whole frame
+        kwargs : dict
+            options for the engine
+        """
+        if isinstance(binning, int):
+            binning = (binning, binning)
+        self.xbin, self.ybin = (int(b) for b in binning)
+        if self.xbin < 1 or self.ybin < 1:
+            raise ValueError(f"Software binning must be at least 1, got {binning}")
+        ref_frame = refimage if isinstance(refimage, Frame) else load_frame(refimage)
+        self.shape = ref_frame.data.shape
+        self.region = self.__crop_slices(self.shape, crop)
+        ys, xs = self.region
+        if image_pixel_mask is not None:
+            image_pixel_mask = vutils.bin_boolean_mask(np.asarray(image_pixel_mask)[ys, xs],
+                                                       self.xbin, self.ybin)
+        self._sidecar_tag = f"sw{self.xbin}x{self.ybin}"
+        if crop is not None:
+            self._sidecar_tag += f"_crop{xs.start}_{ys.start}_{xs.stop - xs.start}_{ys.stop - ys.start}"
+        if sidecar is not None:
+            sidecar = self.__tagged(sidecar)
+        self._engine = engine_class(self.__prepare(ref_frame), sidecar=sidecar,
+                                    image_pixel_mask=image_pixel_mask, **kwargs)
+        self.image_pixel_mask = image_pixel_mask
+        self.refimage_filename = ref_frame.path
+
+    def __tagged(self, sidecar):
+        """
+        Add the binning and crop to a sidecar name
+        """
+        return f"{sidecar.removesuffix(SIDECAR_SUFFIX)}.{self._sidecar_tag}{SIDECAR_SUFFIX}"
+
+    @staticmethod
+    def __crop_slices(shape, crop):
+        """
+        Work out the array slices to keep
+
+        Parameters
+        ----------
+        shape : tuple
+            (ny, nx) of the frame
+        crop : list or None
+            [x0, y0, width, height] region, clipped to the frame
+
+        Returns
+        -------
+        region : tuple
+            (y slice, x slice), the whole frame if there is
+            no crop or it misses the frame (e.g. a subframe)
+
+        Raises
+        ------
+        None
+        """
+        ny, nx = shape
+        if crop is None:
+            return slice(0, ny), slice(0, nx)
+        x0, y0, width, height = crop
+        x0, y0 = max(int(x0), 0), max(int(y0), 0)
+        x1, y1 = min(x0 + int(width), nx), min(y0 + int(height), ny)
+        # too small to measure anything in
+        if x1 - x0 < 16 or y1 - y0 < 16:
+            logging.warning(f"Software crop {crop} is outside the {nx}x{ny} frame, using the whole frame")
+            return slice(0, ny), slice(0, nx)
+        return slice(y0, y1), slice(x0, x1)
+
+    def __prepare(self, frame):
+        """
+        Crop and bin a frame
+
+        Parameters
+        ----------
+        frame : Frame
+            frame as saved by Voyager
+
+        Returns
+        -------
+        binned : Frame
+            cropped and binned copy, same path and header
+
+        Raises
+        ------
+        ValueError : When the frame is a different shape to the reference
+        """
+        if frame.data.shape != self.shape:
+            raise ValueError(f"Frame {frame.path} is {frame.data.shape}, reference is {self.shape}")
+        ys, xs = self.region
+        # slicing first means only the cropped part of a memory mapped frame is read
+        data = vutils.bin_image(frame.data[ys, xs], self.xbin, self.ybin)
+        return Frame(frame.path, data, frame.header)
+
+    @property
+    def sidecar_loaded(self):
+        """
+        Whether the engine loaded its reference from a sidecar
+        """
+        return self._engine.sidecar_loaded
+
+    @property
+    def nbytes(self):
+        """
+        Memory held by the reference, for ReferenceCache
+        """
+        return self._engine.nbytes
+
+    def save_sidecar(self, sidecar, ref_path):
+        """
+        Have the engine save its binned reference as a
+        sidecar, named for the binning and crop
+
+        Parameters
+        ----------
+        sidecar : string
+            sidecar name for the unbinned reference
+        ref_path : string
+            FITS file the sidecar is tied to
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        self._engine.save_sidecar(self.__tagged(sidecar), ref_path)
+
+    def measure_shift(self, checkimage):
+        """
+        Measure the shift of a frame from the reference
+
+        Parameters
+        ----------
+        checkimage : Frame or string
+            frame to measure or path to it
+
+        Returns
+        -------
+        shift : ShiftResult
+            x and y shift in frame pixels, with the engine's quality
+
+        Raises
+        ------
+        ValueError : When the frame is a different shape to the reference
+        """
+        frame = checkimage if isinstance(checkimage, Frame) else load_frame(checkimage)
+        shift = self._engine.measure_shift(self.__prepare(frame))
+        return ShiftResult(shift.x.value * self.xbin, shift.y.value * self.ybin,
+                           getattr(shift, "quality", None))
+
+SHIFT_ENGINES = {"donuts": PreloadedDonuts,
+                 "phase": PhaseCorrelation,
+                 "tiled": TiledShift}
@@ -2,11 +2,14 @@
 Utility functions for Donuts and Voyager
 """
 import os
+import time
+from contextlib import contextmanager
 from datetime import (
     date,
     timedelta,
     datetime)
 import toml
+import numpy as np
 
 def load_config(filename):
     """
@@ -101,3 +104,174 @@ def get_data_dir(root_dir, windows=True):
     if not os.path.exists(data_loc):
         os.mkdir(data_loc)
     return data_loc
+
+def bin_boolean_mask(data, xbin, ybin):
+    """
+    Bin a boolean mask
+
+    Note:
+        A binned pixel is masked if any pixel in
+        its block is masked (max rather than sum)
+
+        Additional pixels that do not complete a
+        bin are ignored
+
+    Parameters
+    ----------
+    data : array
+        full frame boolean mask to bin
+    xbin : int
+        binning factor in x (across columns)
+    ybin : int
+        binning factor in y (across rows)
+
+    Returns
+    -------
+    binned : array
+        binned boolean mask
+
+    Raises
+    ------
+    None
+    """
+    nrows, ncols = data.shape
+    n_binned_rows = nrows//ybin
+    n_binned_cols = ncols//xbin
+    data = np.asarray(data[:n_binned_rows*ybin, :n_binned_cols*xbin], dtype=bool)
+    # OR together every xbin'th column then every ybin'th row. A handful of
+    # whole array operations, much faster than reducing over reshaped axes
+    binned_cols = data[:, 0::xbin].copy()
+    for i in range(1, xbin):
+        binned_cols |= data[:, i::xbin]
+    binned = binned_cols[0::ybin].copy()
+    for i in range(1, ybin):
+        binned |= binned_cols[i::ybin]
+    return binned
+
+def bin_image(data, xbin, ybin):
+    """
+    Bin an image by summing blocks of pixels
+
+    Note:
+        Additional pixels that do not complete a
+        bin are ignored, as for bin_boolean_mask
+
+    Parameters
+    ----------
+    data : array
+        image to bin, any numeric type
+    xbin : int
+        binning factor in x (across columns)
+    ybin : int
+        binning factor in y (across rows)
+
+    Returns
+    -------
+    binned : array
+        float32 binned image
+
+    Raises
+    ------
+    None
+    """
+    nrows, ncols = data.shape
+    n_binned_rows = nrows//ybin
+    n_binned_cols = ncols//xbin
+    data = data[:n_binned_rows*ybin, :n_binned_cols*xbin]
+    # sum every xbin'th column then every ybin'th row, as for the mask. This
+    # is several times faster than summing over reshaped axes and the float32
+    # accumulator can't overflow like the unsigned integer data would
+    binned_cols = np.array(data[:, 0::xbin], dtype=np.float32)
+    for i in range(1, xbin):
+        binned_cols += data[:, i::xbin]
+    binned = binned_cols[0::ybin].copy()
+    for i in range(1, ybin):
+        binned += binned_cols[i::ybin]
+    return binned
+
+class StageTimer():
+    """
+    Monotonic clock timing of the stages of handling one frame
+    """
+    STAGES = ("queue", "ready", "header", "mount_status", "ref_lookup", "ref_store",
+              "donuts_init", "measure_shift", "log_shifts", "pulse_guide")
+
+    def __init__(self):
+        """
+        Start the clock
+
+        Parameters
+        ----------
+        None
+        """
+        self.t0 = time.monotonic()
+        self.t_end = None
+        self.stages = {stage: 0.0 for stage in self.STAGES}
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a block of code, adding to any previous
+        time recorded for this stage
+
+        Parameters
+        ----------
+        name : string
+            name of the stage, one of StageTimer.STAGES
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        t_start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.monotonic() - t_start
+
+    def mark(self, name, t_start):
+        """
+        Record a stage that started at t_start and ends now
+
+        Parameters
+        ----------
+        name : string
+            name of the stage, one of StageTimer.STAGES
+        t_start : float
+            time.monotonic() at the start of the stage
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        self.stages[name] += time.monotonic() - t_start
+
+    def stop(self):
+        """
+        Stop the clock
+        """
+        self.t_end = time.monotonic()
+
+    @property
+    def total(self):
+        """
+        Seconds from the start to stop(), or until now if still running
+        """
+        t_end = self.t_end if self.t_end is not None else time.monotonic()
+        return t_end - self.t0
+
+    def summary(self):
+        """
+        One line key=value summary of the stage times in ms
+        """
+        stages = " ".join(f"{stage}={duration*1000:.1f}" for stage, duration in self.stages.items())
+        other = self.total - sum(self.stages.values())
+        return f"total={self.total*1000:.1f} {stages} other={other*1000:.1f}"